@@ -1,117 +1,237 @@
 ﻿# MedicalWeb.py
-from fastapi import FastAPI, Request, Form, Depends
-from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, Request, Form, Depends, Query
+from fastapi.responses import HTMLResponse, RedirectResponse, ORJSONResponse, StreamingResponse, PlainTextResponse, Response
 from starlette.middleware.sessions import SessionMiddleware
 from fastapi.templating import Jinja2Templates
-from sqlalchemy.orm import Session
+from sqlalchemy import select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, joinedload
+from markupsafe import Markup
+import asyncio
 import datetime
-from typing import Dict, List, Any
+import functools
+import importlib
+import logging
+import os
+import signal
+import sys
+import threading
+from contextlib import asynccontextmanager
+from typing import Dict, List, Any, Optional
 
 # DB imports
-from database import SessionLocal, engine
+from database import SessionLocal, AsyncSessionLocal, engine, async_engine
 import models
 from models import Patient, Doctor, History, Log, HomecareRequest, EmergencyEvent
-from database import Base
-
-app = FastAPI()
-app.add_middleware(SessionMiddleware, secret_key="your_secret_key")
-templates = Jinja2Templates(directory="templates")
-app.mount("/static", StaticFiles(directory="static"), name="static")
-
-# ----- keep original users dict for login/session -----
-users = {
-    "Patient": {"password": "AAAAAAAA", "role": "patient", "name": "Liao"},
-    "DoctorWu": {"password": "DDDDDDDD", "role": "doctor", "name": "Doctor Wu"},
-    "Manager": {"password": "XXXXXXXX", "role": "manager", "name": "Manager"}
-}
-
-# keep patient_modules in-memory for display (preserve existing content)
-patient_modules = {
-    "Liao": ["Heart Monitoring Model"]
-}
-
-# Helper: DB dependency
-def get_db():
-    db = SessionLocal()
+from paging import PageParams, rows_page_stmt, split_page, patients_page_stmt, split_patients, encode_cursor, decode_cursor
+import records
+from vitals import record_vitals, vitals_of
+import ingest
+from writer import WriteBehindQueue, QueueFull
+import changes
+from pubsub import hub
+from statecache import patient_states, get_states
+from pagecache import versions, fragments, view_key, page_etag, etag_matches, not_modified, with_etag
+from assets import FingerprintedStaticFiles
+import export
+from detector import EmergencyDetector
+import search
+import migrations
+import seed
+from accounts import authenticate
+from bus import ChangeBus
+from queries import modules_of
+import metrics
+import tiers
+import homecare
+import snapshots
+from inference import InferenceService, registered, revision
+
+log = logging.getLogger("medicalweb")
+
+# Startup only checks the schema version; `python migrations.py upgrade` (and
+# `python seed.py` for sample data) run once per deploy, before the workers.
+AUTO_MIGRATE = os.environ.get("MEDICALWEB_AUTO_MIGRATE", "0") == "1"
+WARM_TRENDS = os.environ.get("MEDICALWEB_WARM_TRENDS", "1") == "1"
+GRACEFUL_TIMEOUT = int(os.environ.get("MEDICALWEB_GRACEFUL_TIMEOUT", "10"))
+
+async def check_schema():
+    async with async_engine.connect() as conn:
+        version = await conn.run_sync(migrations.current_version)
+    if version < migrations.HEAD:
+        if not AUTO_MIGRATE:
+            raise RuntimeError(f"database schema is at version {version}, this code needs {migrations.HEAD}: "
+                               f"run `python migrations.py upgrade` first")
+        await asyncio.to_thread(migrations.upgrade, engine)
+        await asyncio.to_thread(seed.run)
+    elif version > migrations.HEAD:
+        # rolling deploy: a newer release already migrated; steps only ever add
+        log.warning("database schema %d is newer than this code (%d)", version, migrations.HEAD)
+
+# Load numpy and the trend windows in the background, so neither startup nor
+# the first dashboard request pays for them
+async def warm_up():
+    try:
+        analytics = await asyncio.to_thread(importlib.import_module, "analytics")
+        async with AsyncSessionLocal() as db:
+            await analytics.trends.refresh(db)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        log.exception("trend warm-up failed")
+
+# uvicorn (standalone or as a gunicorn worker) has installed its exit handlers
+# by the time the lifespan starts. End SSE streams first, so that a graceful
+# shutdown is not held open by them and browsers reconnect to another worker.
+def close_streams_on_exit():
+    if threading.current_thread() is not threading.main_thread():
+        return
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        handler = signal.getsignal(sig)
+        if callable(handler):
+            def on_exit(signum, frame, handler=handler):
+                hub.close()
+                handler(signum, frame)
+            signal.signal(sig, on_exit)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
     try:
+        await check_schema()
+    except Exception:
+        # aiosqlite connection threads would keep the process alive
+        await async_engine.dispose()
+        raise
+    await asyncio.to_thread(change_bus.start)
+    close_streams_on_exit()
+    warm = asyncio.create_task(warm_up()) if WARM_TRENDS else None
+    yield
+    if warm:
+        # let a cancelled warm-up let go of its connection before the engine is disposed
+        warm.cancel()
+        await asyncio.gather(warm, return_exceptions=True)
+    await shutdown_db()
+
+app = FastAPI(lifespan=lifespan)
+# the session lives in a signed cookie, so any worker can serve any request
+# as long as they all share this key
+app.add_middleware(SessionMiddleware, secret_key=os.environ.get("MEDICALWEB_SECRET_KEY", "your_secret_key"))
+# outermost, so the session cookie and every later middleware are timed too
+app.add_middleware(metrics.MetricsMiddleware)
+templates = Jinja2Templates(directory="templates")
+# fingerprinted, long-cached static files; templates link with static_url("style.css")
+static_files = FingerprintedStaticFiles(directory="static")
+app.mount("/static", static_files, name="static")
+templates.env.globals["static_url"] = static_files.url
+metrics.instrument([engine, async_engine.sync_engine], templates.env)
+
+# Helper: DB dependency (async session, so reads never block the event loop)
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
-# Helper parser (similar to original)
-def parse_latest_metrics_from_logs(logs: List[Log]) -> Dict[str, Any]:
-    if not logs:
-        return {}
-    last = logs[-1].content if isinstance(logs[-1], Log) else str(logs[-1])
-    metrics = {}
-    parts = str(last).split(": ", 1)
-    if len(parts) == 2:
-        body = parts[1]
-        if "Heart rate" in body:
-            try:
-                metrics["heart_rate"] = int(body.split("Heart rate")[1].strip())
-            except:
-                pass
-        if "BP" in body:
-            try:
-                bp = body.split("BP")[1].strip()
-                metrics["bp"] = bp
-            except:
-                pass
-        if "Temp" in body or "Temperature" in body:
-            try:
-                num = ''.join(ch for ch in body if (ch.isdigit() or ch == '.'))
-                metrics["temp"] = float(num)
-            except:
-                pass
-    return metrics
-
-# ---------- Initialize DB and seed fake data ----------
-def init_db_and_seed():
-    Base.metadata.create_all(bind=engine)
-    db = SessionLocal()
-    try:
-        # If patients empty, seed sample patients and data
-        if db.query(Patient).count() == 0:
-            # Seed patients matching your original names
-            names = ["Liao"]
-            for n in names:
-                p = Patient(name=n)
-                db.add(p)
-            db.commit()
-
-            # Add histories
-            p_liao = db.query(Patient).filter_by(name="Liao").first()
-
-            if p_liao:
-                db.add_all([
-                    History(content="2025-08-01: Diagnosis - Heart check normal", patient=p_liao),
-                    History(content="2025-08-15: ECG - Minor arrhythmia", patient=p_liao)
-                ])
-                db.add_all([
-                    Log(content="2025-09-01: Heart rate 72", patient=p_liao),
-                    Log(content="2025-09-02: Heart rate 75", patient=p_liao),
-                    Log(content="2025-09-03: Heart rate 80", patient=p_liao),
-                    Log(content="2025-10-29: Heart rate 76", patient=p_liao)
-                ])
-
-            # seed doctor
-            if db.query(Doctor).count() == 0:
-                db.add(Doctor(name="Doctor Wu"))
-            db.commit()
-
-        # seed homecare requests/emergency none by default (empty)
-    finally:
-        db.close()
-
-# run seed at import
-init_db_and_seed()
+# All request-path writes go through one background writer (group commit)
+write_queue = WriteBehindQueue(SessionLocal)
+
+# Committed writes fan out to live /events subscribers
+changes.subscribe(hub.publish)
+# ... and keep the per-patient dashboard state cache current
+changes.subscribe(patient_states.apply)
+# ... and move the data versions that page ETags / fragments are keyed on
+changes.subscribe(versions.apply)
+# ... and screen new readings for emergencies off the request path
+detector = EmergencyDetector(write_queue.submit_threadsafe)
+changes.subscribe(detector.apply, local_only=True)
+# ... and rebuild the report snapshots of patients written here
+snapshot_builder = snapshots.SnapshotBuilder(SessionLocal, write_queue.submit_threadsafe)
+changes.subscribe(snapshot_builder.apply, local_only=True)
+
+# Changes committed by other worker processes reach the same subscribers
+# through the change bus
+def reset_caches():
+    patient_states.clear()
+    fragments.clear()
+    if "analytics" in sys.modules:
+        sys.modules["analytics"].trends.reset()
+
+change_bus = ChangeBus(engine, on_seq=versions.advance, on_gap=reset_caches)
+
+# Patient module models run batched on their own worker threads, results
+# cached per patient data version
+inference_service = InferenceService(SessionLocal, versions.patient)
+
+# Helper: patient id by name, from the state cache when known
+async def patient_id_for(db: AsyncSession, name: str):
+    pid = patient_states.patient_id(name)
+    if pid is None:
+        pid = await db.scalar(select(Patient.id).where(Patient.name == name))
+    return pid
+
+# Helper: ETag of this user's view of the page. Patients depend only on their
+# own data; doctor views span patients, so any write moves them on.
+async def view_etag(request: Request, db: AsyncSession, user: Dict[str, Any]) -> str:
+    if user["role"] == "patient":
+        version = versions.patient(await patient_id_for(db, user["name"]))
+    else:
+        version = versions.global_version
+    return page_etag(request, user, version)
+
+# Page decorator: answer 304 before any query or render when the browser's
+# copy is current, otherwise tag the rendered page. Needs request and db params.
+def etag_view(route):
+    @functools.wraps(route)
+    async def wrapper(**kwargs):
+        request, db = kwargs["request"], kwargs["db"]
+        user = request.session.get("user")
+        if not user:
+            return await route(**kwargs)
+        etag = await view_etag(request, db, user)
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        response = await route(**kwargs)
+        return with_etag(response, etag) if response.status_code == 200 else response
+    return wrapper
+
+async def shutdown_db():
+    hub.close()
+    change_bus.stop()
+    detector.stop()
+    inference_service.stop()
+    snapshot_builder.stop()
+    write_queue.stop()
+    if metrics.profiler:
+        metrics.profiler.stop()
+    await async_engine.dispose()
+
+@app.exception_handler(QueueFull)
+async def write_queue_full(request: Request, exc: QueueFull):
+    return HTMLResponse("Server busy, please retry.", status_code=503, headers={"Retry-After": "1"})
+
+# Helper: one keyset page of a patient's rows -> (oldest-first rows, next cursor)
+async def fetch_page(db: AsyncSession, model, ts_col, patient_id: int, params: PageParams, before=None):
+    rows = (await db.scalars(rows_page_stmt(model, ts_col, patient_id, params, before))).all()
+    return split_page(rows, params.limit, ts_col.key)
+
+# Helper: used inside write ops (flushes so the new id is usable in the same batch)
+def get_or_create_patient(db: Session, name: str) -> Patient:
+    patient = db.query(Patient).filter_by(name=name).first()
+    if not patient:
+        patient = Patient(name=name)
+        db.add(patient)
+        db.flush()
+    return patient
+
+# Helper: trend summaries; analytics (numpy) is imported on first use
+@metrics.timed("trend_summaries")
+async def trend_summaries(db: AsyncSession, patient_ids):
+    analytics = importlib.import_module("analytics")
+    return await analytics.trend_summaries(db, patient_ids)
 
 # ---------- Routes (preserve original behavior, but use DB) ----------
 
 @app.get("/", response_class=HTMLResponse)
-async def home(request: Request, db: Session = Depends(get_db)):
+@etag_view
+async def home(request: Request, db: AsyncSession = Depends(get_db)):
     user = request.session.get("user")
     # 🚀 未登入者直接導向登入畫面
     if not user:
@@ -119,16 +239,18 @@ async def home(request: Request, db: Session = Depends(get_db)):
 
     if user["role"] == "doctor":
         pending = []
-        reqs = db.query(HomecareRequest).filter(HomecareRequest.status == "pending").all()
+        reqs = (await db.scalars(select(HomecareRequest).options(joinedload(HomecareRequest.patient)).where(HomecareRequest.status == "pending"))).all()
         for r in reqs:
             pending.append({"name": r.patient.name, "requested_at": r.requested_at.strftime("%Y-%m-%d %H:%M:%S")})
 
+        # per-patient latest state from memory; only uncached patients hit the database
+        ids = (await db.scalars(select(Patient.id).order_by(Patient.id))).all()
+        states = await get_states(db, ids)
+        trend = await trend_summaries(db, ids)
         latest_data = {}
-        patients = db.query(Patient).all()
-        for p in patients:
-            logs = db.query(Log).filter(Log.patient_id == p.id).order_by(Log.timestamp).all()
-            metrics = parse_latest_metrics_from_logs(logs)
-            latest_data[p.name] = {"metrics": metrics, "last_log": logs[-1].content if logs else None}
+        for pid in ids:
+            state = states[pid]
+            latest_data[state["name"]] = {"metrics": state["metrics"], "last_log": state["last_log"], "trends": trend[pid]}
 
         return templates.TemplateResponse("home.html", {
             "request": request,
@@ -138,17 +260,12 @@ async def home(request: Request, db: Session = Depends(get_db)):
         })
 
     elif user["role"] == "patient":
-        name = user["name"]
-        patient = db.query(Patient).filter_by(name=name).first()
-        logs = db.query(Log).filter(Log.patient_id == patient.id).order_by(Log.timestamp).all() if patient else []
-        metrics = parse_latest_metrics_from_logs(logs)
-        latest_data = {"metrics": metrics, "last_log": logs[-1].content if logs else None}
-
-        req = None
-        if patient:
-            r = db.query(HomecareRequest).filter(HomecareRequest.patient_id == patient.id).order_by(HomecareRequest.requested_at.desc()).first()
-            if r:
-                req = {"requested_at": r.requested_at.strftime("%Y-%m-%d %H:%M:%S"), "status": r.status, "reason": r.reason}
+        pid = await patient_id_for(db, user["name"])
+        state = (await get_states(db, [pid])).get(pid) if pid else None
+        latest_data = {"metrics": state["metrics"], "last_log": state["last_log"]} if state else {"metrics": {}, "last_log": None}
+        if pid:
+            latest_data["trends"] = (await trend_summaries(db, [pid]))[pid]
+        req = state["homecare"] if state else None
 
         return templates.TemplateResponse("home.html", {
             "request": request,
@@ -167,9 +284,10 @@ async def login_page(request: Request):
     return templates.TemplateResponse("login.html", {"request": request})
 
 @app.post("/login", response_class=HTMLResponse)
-async def login(request: Request, username: str = Form(...), password: str = Form(...)):
-    if username in users and users[username]["password"] == password:
-        request.session["user"] = users[username]
+async def login(request: Request, username: str = Form(...), password: str = Form(...), db: AsyncSession = Depends(get_db)):
+    user = await authenticate(db, username, password)
+    if user:
+        request.session["user"] = user
         return RedirectResponse("/", status_code=302)
     return templates.TemplateResponse("login.html", {"request": request, "error": "Invalid username or password"})
 
@@ -180,27 +298,33 @@ async def logout(request: Request):
 
 # History page
 @app.get("/history", response_class=HTMLResponse)
-async def history(request: Request, db: Session = Depends(get_db)):
+@etag_view
+async def history(request: Request, page: PageParams = Depends(), db: AsyncSession = Depends(get_db)):
     user = request.session.get("user")
     if not user:
         return templates.TemplateResponse("restricted.html", {"request": request})
 
     if user["role"] == "patient":
-        patient = db.query(Patient).filter_by(name=user["name"]).first()
-        histories = []
+        patient = await db.scalar(select(Patient).filter_by(name=user["name"]))
+        histories, cursor = [], None
         if patient:
-            rows = db.query(History).filter(History.patient_id == patient.id).order_by(History.created_at).all()
+            rows, cursor = await fetch_page(db, History, History.created_at, patient.id, page, page.before)
             histories = [h.content for h in rows]
-        return templates.TemplateResponse("history.html", {"request": request, "history": histories, "user": user})
+        return templates.TemplateResponse("history.html", {"request": request, "history": histories, "user": user,
+                                                           "page": page, "cursor": cursor})
 
     elif user["role"] == "doctor":
-        patients = [p.name for p in db.query(Patient).all()]
-        history_map = {}
-        for p in db.query(Patient).all():
-            rows = db.query(History).filter(History.patient_id == p.id).order_by(History.created_at).all()
+        # 依病患分頁，每位病患只取一頁病歷
+        all_patients, next_after = split_patients((await db.scalars(patients_page_stmt(page))).all(), page)
+        patients = [p.name for p in all_patients]
+        history_map, cursors = {}, {}
+        for p in all_patients:
+            rows, cursors[p.name] = await fetch_page(db, History, History.created_at, p.id, page,
+                                                     page.before if page.patient else None)
             history_map[p.name] = [r.content for r in rows]
-        # supply modules from in-memory mapping to preserve templates
-        return templates.TemplateResponse("history.html", {"request": request, "patients": patients, "history": history_map, "modules": patient_modules, "user": user})
+        modules = await db.run_sync(modules_of, patients)
+        return templates.TemplateResponse("history.html", {"request": request, "patients": patients, "history": history_map, "modules": modules, "user": user,
+                                                           "page": page, "cursors": cursors, "next_after": next_after})
 
 
 
@@ -213,169 +337,384 @@ async def add_history_page(request: Request, patient_name: str):
     return templates.TemplateResponse("add_history.html", {"request": request, "patient_name": patient_name})
 
 @app.post("/add_history/{patient_name}", response_class=HTMLResponse)
-async def add_history_submit(request: Request, patient_name: str, report: str = Form(...), db: Session = Depends(get_db)):
+async def add_history_submit(request: Request, patient_name: str, report: str = Form(...)):
     user = request.session.get("user")
     if not user or user["role"] != "doctor":
         return templates.TemplateResponse("restricted.html", {"request": request})
-    patient = db.query(Patient).filter_by(name=patient_name).first()
-    if not patient:
-        patient = Patient(name=patient_name)
-        db.add(patient)
-        db.commit()
-    h = History(content=report, patient_id=patient.id)
-    db.add(h)
-    db.commit()
+
+    def op(db: Session):
+        patient = get_or_create_patient(db, patient_name)
+        history = History(content=report, patient_id=patient.id)
+        db.add(history)
+        db.flush()
+        changes.record(db, "history", "add", patient.id, patient=patient.name, id=history.id, content=report,
+                       timestamp=history.created_at)
+
+    await write_queue.submit(op)
+    return RedirectResponse("/history", status_code=302)
+
+# Edit / delete history by id (doctor) - touches only the target row
+@app.post("/history/{history_id}/edit", response_class=HTMLResponse)
+async def edit_history_by_id(request: Request, history_id: int, new_text: str = Form(...)):
+    user = request.session.get("user")
+    if not user or user["role"] != "doctor":
+        return templates.TemplateResponse("restricted.html", {"request": request})
+    await write_queue.submit(lambda db: records.update_histories(db, {history_id: new_text}))
+    return RedirectResponse("/history", status_code=302)
+
+@app.post("/history/{history_id}/delete", response_class=HTMLResponse)
+async def delete_history_by_id(request: Request, history_id: int):
+    user = request.session.get("user")
+    if not user or user["role"] != "doctor":
+        return templates.TemplateResponse("restricted.html", {"request": request})
+    await write_queue.submit(lambda db: records.delete_histories(db, [history_id]))
     return RedirectResponse("/history", status_code=302)
 
-# Edit history (doctor) - inline (expects index in template)
+# Edit history (doctor) - legacy index route, resolves the index to an id first
 @app.post("/edit_history/{patient_name}/{index}", response_class=HTMLResponse)
-async def edit_history(request: Request, patient_name: str, index: int, new_text: str = Form(...), db: Session = Depends(get_db)):
+async def edit_history(request: Request, patient_name: str, index: int, new_text: str = Form(...)):
     user = request.session.get("user")
     if not user or user["role"] != "doctor":
         return templates.TemplateResponse("restricted.html", {"request": request})
-    patient = db.query(Patient).filter_by(name=patient_name).first()
-    if not patient:
-        return RedirectResponse("/history", status_code=302)
-    rows = db.query(History).filter(History.patient_id == patient.id).order_by(History.created_at).all()
-    if 0 <= index < len(rows):
-        rows[index].content = new_text
-        db.commit()
+
+    def op(db: Session):
+        patient = db.query(Patient).filter_by(name=patient_name).first()
+        history_id = records.id_at_index(db, History, History.created_at, patient.id, index) if patient else None
+        if history_id is not None:
+            records.update_histories(db, {history_id: new_text})
+
+    await write_queue.submit(op)
     return RedirectResponse("/history", status_code=302)
 
-# Delete history (doctor)
+# Delete history (doctor) - legacy index route
 @app.post("/delete_history/{patient_name}/{index}", response_class=HTMLResponse)
-async def delete_history(request: Request, patient_name: str, index: int, db: Session = Depends(get_db)):
+async def delete_history(request: Request, patient_name: str, index: int):
     user = request.session.get("user")
     if not user or user["role"] != "doctor":
         return templates.TemplateResponse("restricted.html", {"request": request})
-    patient = db.query(Patient).filter_by(name=patient_name).first()
-    if not patient:
-        return RedirectResponse("/history", status_code=302)
-    rows = db.query(History).filter(History.patient_id == patient.id).order_by(History.created_at).all()
-    if 0 <= index < len(rows):
-        db.delete(rows[index])
-        db.commit()
+
+    def op(db: Session):
+        patient = db.query(Patient).filter_by(name=patient_name).first()
+        history_id = records.id_at_index(db, History, History.created_at, patient.id, index) if patient else None
+        if history_id is not None:
+            records.delete_histories(db, [history_id])
+
+    await write_queue.submit(op)
     return RedirectResponse("/history", status_code=302)
 
+# Helper: {module name: model outputs | None} for one patient's modules
+async def predictions_for(db: AsyncSession, patient_id: int, mods: List[str]) -> Dict[str, Any]:
+    if not mods:
+        return {}
+    revisions = {name: revision(m) for name, m in (await db.run_sync(registered, mods)).items()}
+    results = await inference_service.predict({patient_id: mods}, revisions)
+    return {name: results[(patient_id, name)] for name in mods}
+
 # Modules page
 @app.get("/modules", response_class=HTMLResponse)
-async def modules_page(request: Request, db: Session = Depends(get_db)):
+async def modules_page(request: Request, db: AsyncSession = Depends(get_db)):
     user = request.session.get("user")
     if not user:
         return templates.TemplateResponse("restricted.html", {"request": request})
     if user["role"] == "patient":
-        mods = patient_modules.get(user["name"], [])
-        return templates.TemplateResponse("modules.html", {"request": request, "modules": mods, "user": user})
+        mods = (await db.run_sync(modules_of, [user["name"]])).get(user["name"], [])
+        pid = await patient_id_for(db, user["name"])
+        predictions = await predictions_for(db, pid, mods) if pid is not None else {}
+        return templates.TemplateResponse("modules.html", {"request": request, "modules": mods, "predictions": predictions,
+                                                           "user": user})
     elif user["role"] == "doctor":
-        patients = [p.name for p in db.query(Patient).all()]
-        return templates.TemplateResponse("modules.html", {"request": request, "patients": patients, "modules": patient_modules, "user": user})
+        patients = (await db.scalars(select(Patient.name))).all()
+        modules = await db.run_sync(modules_of, patients)
+        return templates.TemplateResponse("modules.html", {"request": request, "patients": patients, "modules": modules, "user": user})
 
 # Logs page
 @app.get("/logs", response_class=HTMLResponse)
-async def logs_page(request: Request, db: Session = Depends(get_db)):
+@etag_view
+async def logs_page(request: Request, page: PageParams = Depends(), db: AsyncSession = Depends(get_db)):
     user = request.session.get("user")
     if not user:
         return templates.TemplateResponse("restricted.html", {"request": request})
     if user["role"] == "patient":
-        patient = db.query(Patient).filter_by(name=user["name"]).first()
-        logs = [l.content for l in db.query(Log).filter(Log.patient_id == patient.id).order_by(Log.timestamp).all()] if patient else []
-        return templates.TemplateResponse("logs.html", {"request": request, "logs": logs, "user": user})
+        patient = await db.scalar(select(Patient).filter_by(name=user["name"]))
+        logs, cursor = [], None
+        if patient:
+            rows, cursor = await fetch_page(db, Log, Log.timestamp, patient.id, page, page.before)
+            logs = [l.content for l in rows]
+        return templates.TemplateResponse("logs.html", {"request": request, "logs": logs, "user": user,
+                                                        "page": page, "cursor": cursor})
     elif user["role"] == "doctor":
-        patients = [p.name for p in db.query(Patient).all()]
-        # logs mapping name -> list
-        logs_map = {}
-        for p in db.query(Patient).all():
-            logs_map[p.name] = [l.content for l in db.query(Log).filter(Log.patient_id == p.id).order_by(Log.timestamp).all()]
-        return templates.TemplateResponse("logs.html", {"request": request, "patients": patients, "logs": logs_map, "user": user})
+        all_patients, next_after = split_patients((await db.scalars(patients_page_stmt(page))).all(), page)
+        patients = [p.name for p in all_patients]
+        # one rendered card per patient (one page of logs each), cached until that patient's data changes
+        cards = []
+        for p in all_patients:
+            key = ("logs", p.id, versions.patient(p.id), view_key(request))
+            html = fragments.get(key)
+            if html is None:
+                rows, cursor = await fetch_page(db, Log, Log.timestamp, p.id, page,
+                                                page.before if page.patient else None)
+                html = templates.get_template("_patient_logs.html").render(
+                    request=request, page=page, patient=p.name, cursor=cursor,
+                    logs=[{"id": l.id, "content": l.content} for l in rows])
+                fragments.put(key, html)
+            cards.append(Markup(html))
+        return templates.TemplateResponse("logs.html", {"request": request, "patients": patients, "cards": cards, "user": user,
+                                                        "page": page, "next_after": next_after})
 
 
 # Add / Edit / Delete logs (doctor)
 @app.post("/add_log/{patient_name}", response_class=HTMLResponse)
-async def add_log(request: Request, patient_name: str, log_text: str = Form(...), db: Session = Depends(get_db)):
+async def add_log(request: Request, patient_name: str, log_text: str = Form(...)):
     user = request.session.get("user")
     if not user or user["role"] != "doctor":
         return templates.TemplateResponse("restricted.html", {"request": request})
-    patient = db.query(Patient).filter_by(name=patient_name).first()
-    if not patient:
-        patient = Patient(name=patient_name)
-        db.add(patient)
-        db.commit()
-    new_log = Log(content=log_text, patient_id=patient.id)
-    db.add(new_log)
-    db.commit()
+
+    def op(db: Session):
+        patient = get_or_create_patient(db, patient_name)
+        new_log = Log(content=log_text, patient_id=patient.id)
+        record_vitals(new_log)
+        db.add(new_log)
+        db.flush()
+        changes.record(db, "log", "add", patient.id, patient=patient.name, id=new_log.id,
+                       content=log_text, timestamp=new_log.timestamp, vitals=vitals_of(new_log.vitals))
+
+    await write_queue.submit(op)
+    return RedirectResponse("/logs", status_code=302)
+
+# Edit / delete a log by id (doctor) - touches only the target row
+@app.post("/logs/{log_id}/edit", response_class=HTMLResponse)
+async def edit_log_by_id(request: Request, log_id: int, new_text: str = Form(...)):
+    user = request.session.get("user")
+    if not user or user["role"] != "doctor":
+        return templates.TemplateResponse("restricted.html", {"request": request})
+    await write_queue.submit(lambda db: records.update_logs(db, {log_id: new_text}))
     return RedirectResponse("/logs", status_code=302)
 
+@app.post("/logs/{log_id}/delete", response_class=HTMLResponse)
+async def delete_log_by_id(request: Request, log_id: int):
+    user = request.session.get("user")
+    if not user or user["role"] != "doctor":
+        return templates.TemplateResponse("restricted.html", {"request": request})
+    await write_queue.submit(lambda db: records.delete_logs(db, [log_id]))
+    return RedirectResponse("/logs", status_code=302)
+
+# Legacy index routes, kept as thin shims over the id-based edits
 @app.post("/edit_log/{patient_name}/{index}", response_class=HTMLResponse)
-async def edit_log(request: Request, patient_name: str, index: int, new_text: str = Form(...), db: Session = Depends(get_db)):
+async def edit_log(request: Request, patient_name: str, index: int, new_text: str = Form(...)):
     user = request.session.get("user")
     if not user or user["role"] != "doctor":
         return templates.TemplateResponse("restricted.html", {"request": request})
-    patient = db.query(Patient).filter_by(name=patient_name).first()
-    if not patient:
-        return RedirectResponse("/logs", status_code=302)
-    rows = db.query(Log).filter(Log.patient_id == patient.id).order_by(Log.timestamp).all()
-    if 0 <= index < len(rows):
-        rows[index].content = new_text
-        db.commit()
+
+    def op(db: Session):
+        patient = db.query(Patient).filter_by(name=patient_name).first()
+        log_id = records.id_at_index(db, Log, Log.timestamp, patient.id, index) if patient else None
+        if log_id is not None:
+            records.update_logs(db, {log_id: new_text})
+
+    await write_queue.submit(op)
     return RedirectResponse("/logs", status_code=302)
 
 @app.post("/delete_log/{patient_name}/{index}", response_class=HTMLResponse)
-async def delete_log(request: Request, patient_name: str, index: int, db: Session = Depends(get_db)):
+async def delete_log(request: Request, patient_name: str, index: int):
     user = request.session.get("user")
     if not user or user["role"] != "doctor":
         return templates.TemplateResponse("restricted.html", {"request": request})
-    patient = db.query(Patient).filter_by(name=patient_name).first()
-    if not patient:
-        return RedirectResponse("/logs", status_code=302)
-    rows = db.query(Log).filter(Log.patient_id == patient.id).order_by(Log.timestamp).all()
-    if 0 <= index < len(rows):
-        db.delete(rows[index])
-        db.commit()
+
+    def op(db: Session):
+        patient = db.query(Patient).filter_by(name=patient_name).first()
+        log_id = records.id_at_index(db, Log, Log.timestamp, patient.id, index) if patient else None
+        if log_id is not None:
+            records.delete_logs(db, [log_id])
+
+    await write_queue.submit(op)
     return RedirectResponse("/logs", status_code=302)
 
-# Apply homecare (patient) and admin view (doctor)
+# Bulk edit / delete by id list (doctor), JSON:
+#   POST /api/logs/bulk_edit      {"items": [{"id": 1, "content": "..."}]}
+#   POST /api/logs/bulk_delete    {"ids": [1, 2, 3]}
+# and the same under /api/history/...
+BULK_TARGETS = {
+    "logs": (records.update_logs, records.delete_logs),
+    "history": (records.update_histories, records.delete_histories),
+}
+
+@app.post("/api/{kind}/bulk_edit")
+async def bulk_edit(request: Request, kind: str):
+    user = request.session.get("user")
+    if not user or user["role"] != "doctor":
+        return ORJSONResponse({"error": "forbidden"}, status_code=403)
+    if kind not in BULK_TARGETS:
+        return ORJSONResponse({"error": "not found"}, status_code=404)
+    try:
+        items = (await request.json())["items"]
+        contents = {int(it["id"]): str(it["content"]) for it in items}
+    except (ValueError, KeyError, TypeError):
+        return ORJSONResponse({"error": "expected {\"items\": [{\"id\": ..., \"content\": ...}]}"}, status_code=400)
+    updated = await write_queue.submit(lambda db: BULK_TARGETS[kind][0](db, contents))
+    return ORJSONResponse({"updated": updated, "missing": sorted(set(contents) - set(updated))})
+
+@app.post("/api/{kind}/bulk_delete")
+async def bulk_delete(request: Request, kind: str):
+    user = request.session.get("user")
+    if not user or user["role"] != "doctor":
+        return ORJSONResponse({"error": "forbidden"}, status_code=403)
+    if kind not in BULK_TARGETS:
+        return ORJSONResponse({"error": "not found"}, status_code=404)
+    try:
+        ids = [int(i) for i in (await request.json())["ids"]]
+    except (ValueError, KeyError, TypeError):
+        return ORJSONResponse({"error": "expected {\"ids\": [...]}"}, status_code=400)
+    deleted = await write_queue.submit(lambda db: BULK_TARGETS[kind][1](db, ids))
+    return ORJSONResponse({"deleted": deleted, "missing": sorted(set(ids) - set(deleted))})
+
+# Bulk vitals ingestion (devices or doctor session)
+# Accepts a JSON array / {"readings": [...]} or NDJSON; each reading is
+# {"patient": name, "measured_at": iso, "heart_rate", "bp" | "bp_systolic"/"bp_diastolic", "temperature"}
+# or {"patient": name, "content": "2025-09-01: Heart rate 72"}
+DEVICE_TOKEN = os.environ.get("MEDICALWEB_DEVICE_TOKEN")
+
+@app.post("/api/vitals/bulk")
+async def ingest_vitals(request: Request):
+    user = request.session.get("user")
+    token = request.headers.get("x-device-token")
+    if not (user and user["role"] == "doctor") and not (DEVICE_TOKEN and token == DEVICE_TOKEN):
+        return ORJSONResponse({"error": "forbidden"}, status_code=403)
+    try:
+        readings = ingest.parse_body(await request.body(), request.headers.get("content-type", ""))
+    except ValueError as e:
+        return ORJSONResponse({"error": f"invalid body: {e}"}, status_code=400)
+    if len(readings) > ingest.MAX_BATCH:
+        return ORJSONResponse({"error": f"batch larger than {ingest.MAX_BATCH} readings"}, status_code=413)
+    results = await write_queue.submit(lambda db: ingest.ingest_readings(db, readings))
+    accepted = sum(1 for r in results if r["status"] == "accepted")
+    return ORJSONResponse({"accepted": accepted, "rejected": len(results) - accepted, "results": results})
+
+# Live updates (Server-Sent Events) - new logs / vitals, histories, homecare
+# requests and emergency events as they are committed.
+#   /events?kind=emergency            all emergency events
+#   /events?patient=Liao&kind=log     one patient's logs
+# Doctors and managers may watch any patient; a patient only sees their own.
+@app.get("/events")
+async def events(request: Request, patient: List[str] = Query([]), kind: List[str] = Query([])):
+    user = request.session.get("user")
+    if not user:
+        return ORJSONResponse({"error": "forbidden"}, status_code=403)
+    if user["role"] == "patient":
+        patient = [user["name"]]
+    patient_ids = None
+    if patient:
+        async with AsyncSessionLocal() as db:
+            patient_ids = set(await db.scalars(select(Patient.id).where(Patient.name.in_(patient))))
+        # unknown names must not widen the filter to everyone
+        patient_ids = patient_ids or {0}
+    sub = hub.subscribe(patient_ids, kind)
+    return StreamingResponse(hub.stream(sub), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# Full-dataset export (doctor), streamed in chunks
+#   /api/export/logs?format=csv|ndjson|columnar&patient=Liao&since=2025-01-01&until=2025-12-31
+@app.get("/api/export/{dataset}")
+async def export_data(
+    request: Request,
+    dataset: str,
+    fmt: str = Query("csv", alias="format"),
+    patient: List[str] = Query([]),
+    since: Optional[datetime.date] = None,
+    until: Optional[datetime.date] = None,
+):
+    user = request.session.get("user")
+    if not user or user["role"] != "doctor":
+        return ORJSONResponse({"error": "forbidden"}, status_code=403)
+    if dataset not in export.DATASETS:
+        return ORJSONResponse({"error": f"unknown dataset, expected one of {list(export.DATASETS)}"}, status_code=404)
+    if fmt not in export.FORMATS:
+        return ORJSONResponse({"error": f"unknown format, expected one of {list(export.FORMATS)}"}, status_code=400)
+    media_type, ext = export.FORMATS[fmt]
+    return StreamingResponse(export.stream_export(dataset, fmt, patient, since, until), media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="{dataset}.{ext}"'})
+
+# Apply homecare (patient) and admin view (doctor): the request queue of one
+# status, keyset paged (?status=pending&after=<cursor>)
 @app.get("/apply_homecare", response_class=HTMLResponse)
-async def apply_homecare_page(request: Request, db: Session = Depends(get_db)):
+async def apply_homecare_page(
+    request: Request,
+    status: str = "pending",
+    after: Optional[str] = None,
+    limit: int = Query(homecare.QUEUE_PAGE_SIZE, ge=1, le=500),
+    db: AsyncSession = Depends(get_db),
+):
     user = request.session.get("user")
     if not user:
         return templates.TemplateResponse("restricted.html", {"request": request})
     if user["role"] == "patient":
-        patient = db.query(Patient).filter_by(name=user["name"]).first()
-        req = None
-        if patient:
-            r = db.query(HomecareRequest).filter(HomecareRequest.patient_id == patient.id).order_by(HomecareRequest.requested_at.desc()).first()
-            if r:
-                req = {"requested_at": r.requested_at.strftime("%Y-%m-%d %H:%M:%S"), "status": r.status, "reason": r.reason}
+        pid = await patient_id_for(db, user["name"])
+        state = (await get_states(db, [pid])).get(pid) if pid else None
+        req = state["homecare"] if state else None
         return templates.TemplateResponse("apply_homecare.html", {"request": request, "user": user, "request_info": req})
     elif user["role"] == "doctor":
-        # doctor sees all requests
-        reqs = db.query(HomecareRequest).all()
-        mapping = {}
-        for r in reqs:
-            mapping[r.patient.name] = {"requested_at": r.requested_at.strftime("%Y-%m-%d %H:%M:%S"), "status": r.status, "reason": r.reason}
-        return templates.TemplateResponse("apply_homecare_admin.html", {"request": request, "user": user, "requests": mapping})
+        if status not in models.HOMECARE_STATUSES:
+            status = "pending"
+        try:
+            rows, cursor = await db.run_sync(homecare.queue_page, status, after, limit)
+        except ValueError:
+            return HTMLResponse("invalid cursor", status_code=400)
+        counts = await db.run_sync(homecare.status_counts)
+        return templates.TemplateResponse("apply_homecare_admin.html", {
+            "request": request, "user": user, "requests": rows, "status": status, "counts": counts,
+            "cursor": cursor, "transitions": [t for t, sources in homecare.TRANSITIONS.items() if status in sources],
+        })
     else:
         return templates.TemplateResponse("restricted.html", {"request": request, "user": user})
 
 @app.post("/apply_homecare", response_class=HTMLResponse)
-async def apply_homecare_submit(request: Request, reason: str = Form(...), db: Session = Depends(get_db)):
+async def apply_homecare_submit(request: Request, reason: str = Form(...)):
     user = request.session.get("user")
     if not user or user["role"] != "patient":
         return templates.TemplateResponse("restricted.html", {"request": request})
-    patient = db.query(Patient).filter_by(name=user["name"]).first()
-    if not patient:
-        patient = Patient(name=user["name"])
-        db.add(patient)
-        db.commit()
-    # create a new request
-    req = HomecareRequest(reason=reason, status="pending", patient_id=patient.id)
-    db.add(req)
-    db.commit()
+
+    def op(db: Session):
+        patient = get_or_create_patient(db, user["name"])
+        # create a new request
+        request_row = HomecareRequest(reason=reason, status="pending", patient_id=patient.id)
+        db.add(request_row)
+        db.flush()
+        changes.record(db, "homecare", "add", patient.id, patient=patient.name, id=request_row.id,
+                       reason=reason, status=request_row.status, requested_at=request_row.requested_at)
+
+    await write_queue.submit(op)
     return RedirectResponse("/", status_code=302)
 
-# Emergency mode (doctor) - 顯示急救事件頁面
+# Batch status change of homecare requests (doctor), JSON:
+#   POST /api/homecare/transition  {"status": "approved", "items": [{"id": 1, "version": 0}], "note": "..."}
+# Requests changed since the caller read them (other version or status) come
+# back under "conflicts" with their current state, and the response is a 409.
+@app.post("/api/homecare/transition")
+async def homecare_transition(request: Request):
+    user = request.session.get("user")
+    if not user or user["role"] != "doctor":
+        return ORJSONResponse({"error": "forbidden"}, status_code=403)
+    try:
+        body = await request.json()
+        status = str(body["status"])
+        items = [(int(it["id"]), int(it["version"])) for it in body["items"]]
+        note = str(body["note"]) if body.get("note") else None
+    except (ValueError, KeyError, TypeError):
+        return ORJSONResponse({"error": "expected {\"status\": ..., \"items\": [{\"id\": ..., \"version\": ...}]}"},
+                              status_code=400)
+    if status not in homecare.TRANSITIONS:
+        return ORJSONResponse({"error": f"status must be one of {list(homecare.TRANSITIONS)}"}, status_code=400)
+    if len(items) > homecare.MAX_BATCH:
+        return ORJSONResponse({"error": f"batch larger than {homecare.MAX_BATCH} requests"}, status_code=413)
+    result = await write_queue.submit(lambda db: homecare.transition(db, items, status, user["name"], note))
+    return ORJSONResponse(result, status_code=409 if result["conflicts"] else 200)
+
+# Emergency mode (doctor) - 顯示急救事件頁面, EMERGENCY_LIST_LIMIT events per
+# page, keyset paged on (time, id) (?before=<cursor> for older events)
+EMERGENCY_LIST_LIMIT = int(os.environ.get("MEDICALWEB_EMERGENCY_LIST_LIMIT", "200"))
+
 @app.get("/emergency", response_class=HTMLResponse)
-async def emergency(request: Request, db: Session = Depends(get_db)):
+@etag_view
+async def emergency(request: Request, before: Optional[str] = None, db: AsyncSession = Depends(get_db)):
     # 取得 session 中的使用者資訊
     user = request.session.get("user")
     
@@ -387,8 +726,19 @@ async def emergency(request: Request, db: Session = Depends(get_db)):
     # 初始化事件列表
     events = []
 
-    # 從資料庫讀取所有急救事件，依時間排序 (最新在前)
-    rows = db.query(EmergencyEvent).order_by(EmergencyEvent.time.desc()).all()
+    # 從資料庫讀取最近的急救事件，依時間排序 (最新在前)
+    stmt = select(EmergencyEvent).options(joinedload(EmergencyEvent.patient))
+    if before:
+        try:
+            stmt = stmt.where(tuple_(EmergencyEvent.time, EmergencyEvent.id) < tuple_(*decode_cursor(before)))
+        except ValueError:
+            return HTMLResponse("invalid cursor", status_code=400)
+    rows = (await db.scalars(stmt.order_by(EmergencyEvent.time.desc(), EmergencyEvent.id.desc())
+                             .limit(EMERGENCY_LIST_LIMIT + 1))).all()
+    cursor = None
+    if len(rows) > EMERGENCY_LIST_LIMIT:
+        rows = rows[:EMERGENCY_LIST_LIMIT]
+        cursor = encode_cursor(rows[-1].time, rows[-1].id)
 
     # 將每個事件轉成前端可用的字典格式
     for e in rows:
@@ -400,7 +750,8 @@ async def emergency(request: Request, db: Session = Depends(get_db)):
         })
 
     # 將事件列表傳給前端模板呈現
-    return templates.TemplateResponse("emergency.html", {"request": request, "user": user, "events": events})
+    return templates.TemplateResponse("emergency.html", {"request": request, "user": user, "events": events,
+                                                         "cursor": cursor})
 
 
 # Emergency mode (doctor) - 新增急救事件
@@ -408,8 +759,7 @@ async def emergency(request: Request, db: Session = Depends(get_db)):
 async def emergency_add(
     request: Request, 
     patient: str = Form(...),   # 從表單取得病患名稱
-    event: str = Form(...),     # 從表單取得事件描述
-    db: Session = Depends(get_db)
+    event: str = Form(...)      # 從表單取得事件描述
 ):
     # 取得 session 中的使用者資訊
     user = request.session.get("user")
@@ -418,27 +768,169 @@ async def emergency_add(
     if not user or user["role"] != "doctor":
         return templates.TemplateResponse("restricted.html", {"request": request, "user": user})
 
-    # 查詢資料庫中是否已有這位病患
-    patient_obj = db.query(Patient).filter_by(name=patient).first()
+    def op(db: Session):
+        # 查詢資料庫中是否已有這位病患，若不存在則新增
+        patient_obj = get_or_create_patient(db, patient)
+        # 建立新的急救事件 (預設狀態為 "處理中")
+        emergency = EmergencyEvent(event=event, status="處理中", patient_id=patient_obj.id)
+        db.add(emergency)
+        db.flush()
+        changes.record(db, "emergency", "add", patient_obj.id, patient=patient_obj.name, id=emergency.id,
+                       event=event, status=emergency.status, time=emergency.time)
 
-    # 若病患不存在，新增病患
-    if not patient_obj:
-        patient_obj = Patient(name=patient)
-        db.add(patient_obj)
-        db.commit()  # 提交新增病患
-
-    # 建立新的急救事件 (預設狀態為 "處理中")
-    ev = EmergencyEvent(event=event, status="處理中", patient_id=patient_obj.id)
-    db.add(ev)
-    db.commit()  # 提交新增事件
+    # 急救事件走優先通道：不排隊、不因佇列滿而被拒，並以完整同步寫入磁碟後才回應
+    await write_queue.submit(op, urgent=True)
 
     # 新增完成後重新導向回 /emergency 頁面
     return RedirectResponse("/emergency", status_code=302)
 
 
+# Full-text search over logs and histories. Doctors search everyone (or the
+# given patients); a patient searches only their own notes.
+async def run_search(db: AsyncSession, user: Dict[str, Any], q: str, patient: List[str], since, until, kind, limit, offset):
+    if not search.is_supported(async_engine):
+        return None
+    names = [user["name"]] if user["role"] == "patient" else [n for n in patient if n]
+    patient_ids = None
+    if names:
+        patient_ids = list(await db.scalars(select(Patient.id).where(Patient.name.in_(names))))
+    found = await db.run_sync(search.search, q, patient_ids, since, until, kind, limit, offset)
+    ids = {r["patient_id"] for r in found["results"]}
+    names_by_id = dict((await db.execute(select(Patient.id, Patient.name).where(Patient.id.in_(ids)))).all()) if ids else {}
+    for r in found["results"]:
+        r["patient"] = names_by_id.get(r["patient_id"])
+    return found
+
+# The search form always submits every field, left blank when unused, and
+# "" is the "Logs and history" option of the kind select
+def search_filters(since: Optional[str], until: Optional[str], kind: Optional[str]):
+    since = datetime.date.fromisoformat(since[:10]) if since else None
+    until = datetime.date.fromisoformat(until[:10]) if until else None
+    if kind and kind not in search.KINDS:
+        raise ValueError(f"kind must be one of {list(search.KINDS)}")
+    return since, until, kind or None
+
+@app.get("/api/search")
+async def search_api(
+    request: Request,
+    q: str = "",
+    patient: List[str] = Query([]),
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    kind: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=200),
+    offset: int = Query(0, ge=0),
+    db: AsyncSession = Depends(get_db),
+):
+    user = request.session.get("user")
+    if not user or user["role"] not in ("doctor", "patient"):
+        return ORJSONResponse({"error": "forbidden"}, status_code=403)
+    try:
+        since, until, kind = search_filters(since, until, kind)
+    except ValueError as e:
+        return ORJSONResponse({"error": str(e)}, status_code=400)
+    found = await run_search(db, user, q, patient, since, until, kind, limit, offset)
+    if found is None:
+        return ORJSONResponse({"error": "full-text search needs SQLite FTS5"}, status_code=501)
+    return ORJSONResponse({"query": q, **found})
+
+@app.get("/search", response_class=HTMLResponse)
+async def search_page(
+    request: Request,
+    q: str = "",
+    patient: List[str] = Query([]),
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    kind: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=200),
+    offset: int = Query(0, ge=0),
+    db: AsyncSession = Depends(get_db),
+):
+    user = request.session.get("user")
+    if not user or user["role"] not in ("doctor", "patient"):
+        return templates.TemplateResponse("restricted.html", {"request": request, "user": user})
+    try:
+        since, until, kind = search_filters(since, until, kind)
+    except ValueError as e:
+        return PlainTextResponse(f"invalid search: {e}", status_code=400)
+    found = await run_search(db, user, q, patient, since, until, kind, limit, offset) if q.strip() else None
+    return templates.TemplateResponse("search.html", {"request": request, "user": user, "q": q, "found": found,
+                                                      "limit": limit, "offset": offset})
+
+# Automatic emergency detection status (doctor)
+@app.get("/api/emergency/detector")
+async def detector_status(request: Request):
+    user = request.session.get("user")
+    if not user or user["role"] != "doctor":
+        return ORJSONResponse({"error": "forbidden"}, status_code=403)
+    return ORJSONResponse({"rules": detector.rules, "stats": detector.stats, "latency": detector.latency()})
+
+# A patient's vitals over a time range, from whichever storage tier holds it
+# (raw readings for short recent ranges, else minute/hour/day rollups)
+#   /api/vitals/series?patient=Liao&since=2025-01-01&until=2025-06-30&points=500
+@app.get("/api/vitals/series")
+async def vitals_series(
+    request: Request,
+    patient: Optional[str] = None,
+    since: Optional[datetime.datetime] = None,
+    until: Optional[datetime.datetime] = None,
+    days: int = Query(7, ge=0),
+    points: int = Query(tiers.MAX_POINTS, ge=10, le=5000),
+    db: AsyncSession = Depends(get_db),
+):
+    user = request.session.get("user")
+    if not user:
+        return ORJSONResponse({"error": "forbidden"}, status_code=403)
+    if user["role"] == "patient":
+        patient = user["name"]
+    elif user["role"] != "doctor" or not patient:
+        return ORJSONResponse({"error": "patient is required"}, status_code=400)
+    pid = await patient_id_for(db, patient)
+    if pid is None:
+        return ORJSONResponse({"error": "unknown patient"}, status_code=404)
+    if since is None and days:
+        since = datetime.datetime.now() - datetime.timedelta(days=days)
+    result = await db.run_sync(tiers.series, pid, since, until, points)
+    return ORJSONResponse({"patient": patient, **result})
+
+# Latest outputs of a patient's module models
+#   /api/modules/predictions?patient=Liao
+@app.get("/api/modules/predictions")
+async def module_predictions(request: Request, patient: Optional[str] = None, db: AsyncSession = Depends(get_db)):
+    user = request.session.get("user")
+    if not user:
+        return ORJSONResponse({"error": "forbidden"}, status_code=403)
+    if user["role"] == "patient":
+        patient = user["name"]
+    elif user["role"] != "doctor" or not patient:
+        return ORJSONResponse({"error": "patient is required"}, status_code=400)
+    pid = await patient_id_for(db, patient)
+    if pid is None:
+        return ORJSONResponse({"error": "unknown patient"}, status_code=404)
+    mods = (await db.run_sync(modules_of, [patient])).get(patient, [])
+    return ORJSONResponse({"patient": patient, "predictions": await predictions_for(db, pid, mods)})
+
+# Prometheus scrape endpoint (this worker's numbers, see metrics.py)
+@app.get("/metrics")
+async def metrics_page(request: Request):
+    if not metrics.METRICS_ENABLED:
+        return PlainTextResponse("metrics disabled", status_code=404)
+    if metrics.METRICS_TOKEN:
+        allowed = request.headers.get("authorization") == f"Bearer {metrics.METRICS_TOKEN}"
+    else:
+        # no token: staff sessions, or a scraper on this host
+        user = request.session.get("user")
+        allowed = (user and user["role"] in ("doctor", "manager")) or (
+            request.client is not None and request.client.host in metrics.LOCAL_HOSTS)
+    if not allowed:
+        return PlainTextResponse("forbidden", status_code=403)
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+
 # Reports page
 @app.get("/reports", response_class=HTMLResponse)
-async def reports_page(request: Request, db: Session = Depends(get_db)):
+@etag_view
+async def reports_page(request: Request, page: PageParams = Depends(), db: AsyncSession = Depends(get_db)):
     user = request.session.get("user")
     if not user:
         return templates.TemplateResponse("restricted.html", {"request": request})
@@ -450,15 +942,21 @@ async def reports_page(request: Request, db: Session = Depends(get_db)):
     reports = {}
 
     if is_doctor:
-        # 醫師模式：整合所有病患資料
-        for p in db.query(Patient).all():
-            logs = db.query(Log).filter(Log.patient_id == p.id).order_by(Log.timestamp).all()
-            history = db.query(History).filter(History.patient_id == p.id).order_by(History.created_at).all()
+        # 醫師模式：依病患分頁整合資料，每位病患只取時間範圍內的一頁
+        patients, next_after = split_patients((await db.scalars(patients_page_stmt(page))).all(), page)
+        states = await get_states(db, [p.id for p in patients])
+        trend = await trend_summaries(db, [p.id for p in patients])
+        before = page.before if page.patient else None
+        for p in patients:
+            logs, _ = await fetch_page(db, Log, Log.timestamp, p.id, page, before)
+            history, _ = await fetch_page(db, History, History.created_at, p.id, page, before)
+            state = states[p.id]
 
             reports[p.name] = {
-                "metrics": parse_latest_metrics_from_logs(logs),
-                "last_log": logs[-1].content if logs else None,
-                "modules": patient_modules.get(p.name, []),
+                "metrics": state["metrics"],
+                "last_log": state["last_log"],
+                "modules": state["modules"],
+                "trends": trend[p.id],
                 "logs": [l.content for l in logs],
                 "history": [{"timestamp": h.created_at.strftime("%Y-%m-%d %H:%M:%S"), "summary": h.content} for h in history]
             }
@@ -468,28 +966,35 @@ async def reports_page(request: Request, db: Session = Depends(get_db)):
             "is_doctor": True,
             "reports": reports,
             "username": username,
-            "user": user
+            "user": user,
+            "page": page,
+            "next_after": next_after
         })
 
     else:
         # 病患模式：僅顯示自己的資料
-        patient = db.query(Patient).filter_by(name=username).first()
+        patient = await db.scalar(select(Patient).filter_by(name=username))
         if not patient:
             return templates.TemplateResponse("reports.html", {
                 "request": request,
                 "is_doctor": False,
                 "reports": {},
                 "username": username,
-                "user": user
+                "user": user,
+                "page": page
             })
 
-        logs = db.query(Log).filter(Log.patient_id == patient.id).order_by(Log.timestamp).all()
-        history = db.query(History).filter(History.patient_id == patient.id).order_by(History.created_at).all()
+        logs, _ = await fetch_page(db, Log, Log.timestamp, patient.id, page, page.before)
+        history, _ = await fetch_page(db, History, History.created_at, patient.id, page, page.before)
 
+        state = (await get_states(db, [patient.id]))[patient.id]
         reports[username] = {
-    "metrics": parse_latest_metrics_from_logs(logs),
-    "last_log": logs[-1].content if logs else None,
-    "modules": patient_modules.get(username, []),
+    "metrics": state["metrics"],
+    "last_log": state["last_log"],
+    "modules": state["modules"],
+    "trends": (await trend_summaries(db, [patient.id]))[patient.id],
+    # the selected range may reach past the hot window into the rollups
+    "vitals_range": tiers.summarize(await db.run_sync(tiers.series, patient.id, page.since, page.until)),
     "logs": [l.content for l in logs],
     "history": [{"timestamp": h.created_at.strftime("%Y-%m-%d %H:%M:%S"), "summary": h.content} for h in history]
 }
@@ -500,9 +1005,75 @@ async def reports_page(request: Request, db: Session = Depends(get_db)):
             "is_doctor": False,
             "reports": reports,
             "username": username,
-            "user": user
+            "user": user,
+            "page": page
         })
 
+# Patient reports as JSON, served from the materialized snapshots (snapshots.py)
+#   /api/reports?after=0&per_page=100          doctor: every patient, paged by id
+#   /api/reports?patient=P00001&fields=metrics,logs
+# fields: any of snapshots.FIELDS, plus "trends" (computed live). The body is
+# brotli / gzip compressed when the client accepts it.
+@app.get("/api/reports")
+async def reports_api(
+    request: Request,
+    patient: Optional[str] = None,
+    fields: Optional[str] = None,
+    after: int = Query(0, ge=0),
+    per_page: int = Query(100, ge=1, le=1000),
+    db: AsyncSession = Depends(get_db),
+):
+    user = request.session.get("user")
+    if not user or user["role"] not in ("doctor", "patient"):
+        return ORJSONResponse({"error": "forbidden"}, status_code=403)
+    try:
+        selected = snapshots.parse_fields(fields, also=("trends",))
+    except ValueError as e:
+        return ORJSONResponse({"error": str(e)}, status_code=400)
+    if user["role"] == "patient":
+        patient = user["name"]
+    encoding = snapshots.negotiate(request.headers.get("accept-encoding", ""))
+    etag = await view_etag(request, db, user)
+    if encoding:
+        etag = f'{etag[:-1]}-{encoding}"'
+    if etag_matches(request, etag):
+        return not_modified(etag)
+
+    stmt = select(Patient.id, Patient.name).where(Patient.id > after)
+    if patient:
+        stmt = stmt.where(Patient.name == patient)
+    rows = (await db.execute(stmt.order_by(Patient.id).limit(per_page + 1))).all()
+    next_after = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_after = rows[-1][0]
+    ids = [pid for pid, _ in rows]
+    bodies = await db.run_sync(snapshots.read, ids)
+    missing = [pid for pid in ids if pid not in bodies]
+    if missing:
+        # not built yet or behind a write: build now, store in the background
+        built = await db.run_sync(snapshots.build, missing)
+        snapshot_builder.keep(built)
+        bodies.update({pid: body for pid, (_, body) in built.items()})
+    merge = None
+    if selected and "trends" in selected:
+        trend = await trend_summaries(db, ids)
+        merge = {name: {"trends": trend[pid]} for pid, name in rows}
+    doc = snapshots.render([(name, bodies[pid]) for pid, name in rows if pid in bodies], selected,
+                           {"next_after": next_after}, merge=merge)
+    body, encoding = snapshots.compress(doc, encoding)
+    response = with_etag(Response(body, media_type="application/json"), etag)
+    response.headers["Vary"] = "Cookie, Accept-Encoding"
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    return response
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+
+    # local runs set up their own database; production runs the same two
+    # commands once per deploy and serves with gunicorn (gunicorn.conf.py)
+    migrations.upgrade(engine)
+    seed.run()
+    uvicorn.run("MedicalWeb:app", host="0.0.0.0", port=int(os.environ.get("MEDICALWEB_PORT", "8000")),
+                workers=int(os.environ.get("MEDICALWEB_WORKERS", "1")), timeout_graceful_shutdown=GRACEFUL_TIMEOUT)
@@ -0,0 +1,99 @@
+# accounts.py
+import argparse
+import asyncio
+import getpass
+import hashlib
+import hmac
+import os
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+import changes
+from models import Patient, PatientModule, User
+
+# Login accounts and per-patient modules, kept in the database so every
+# worker process sees the same ones.
+
+PBKDF2_ITERATIONS = int(os.environ.get("MEDICALWEB_PBKDF2_ITERATIONS", "200000"))
+
+
+# "pbkdf2_sha256$iterations$salt$hash"
+def hash_password(password: str, iterations: int = PBKDF2_ITERATIONS) -> str:
+    salt = os.urandom(16).hex()
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), bytes.fromhex(salt), iterations).hex()
+    return f"pbkdf2_sha256${iterations}${salt}${digest}"
+
+
+def check_password(password: str, stored: str) -> bool:
+    try:
+        scheme, iterations, salt, digest = stored.split("$")
+    except ValueError:
+        return False
+    if scheme != "pbkdf2_sha256":
+        return False
+    computed = hashlib.pbkdf2_hmac("sha256", password.encode(), bytes.fromhex(salt), int(iterations)).hex()
+    return hmac.compare_digest(computed, digest)
+
+
+def session_user(user: User) -> Dict[str, Any]:
+    return {"role": user.role, "name": user.name}
+
+
+# Session user dict for valid credentials, else None. The hash runs in a
+# thread so a login does not stall the event loop.
+async def authenticate(db: AsyncSession, username: str, password: str) -> Optional[Dict[str, Any]]:
+    user = await db.scalar(select(User).where(User.username == username))
+    if user is None or not await asyncio.to_thread(check_password, password, user.password_hash):
+        return None
+    return session_user(user)
+
+
+def add_user(db: Session, username: str, password: str, role: str, name: str) -> User:
+    user = db.scalar(select(User).where(User.username == username))
+    if user is None:
+        user = User(username=username)
+        db.add(user)
+    user.password_hash = hash_password(password)
+    user.role = role
+    user.name = name
+    return user
+
+
+# Write op: replace a patient's modules
+def set_modules(db: Session, patient_name: str, modules: List[str]):
+    patient = db.scalar(select(Patient).where(Patient.name == patient_name))
+    if patient is None:
+        raise ValueError(f"unknown patient {patient_name!r}")
+    db.execute(delete(PatientModule).where(PatientModule.patient_id == patient.id))
+    db.add_all([PatientModule(patient_id=patient.id, name=m) for m in modules])
+    changes.record(db, "modules", "edit", patient.id, patient=patient.name, modules=list(modules))
+
+
+if __name__ == "__main__":
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Manage login accounts and patient modules")
+    sub = parser.add_subparsers(dest="command", required=True)
+    au = sub.add_parser("add-user", help="create a user or reset its password")
+    au.add_argument("username")
+    au.add_argument("--role", choices=["patient", "doctor", "manager"], required=True)
+    au.add_argument("--name", required=True, help="patient or doctor name shown in the app")
+    sm = sub.add_parser("set-modules", help="replace a patient's modules")
+    sm.add_argument("patient")
+    sm.add_argument("modules", nargs="*")
+    args = parser.parse_args()
+    db = SessionLocal()
+    try:
+        if args.command == "add-user":
+            password = getpass.getpass("Password: ")
+            add_user(db, args.username, password, args.role, args.name)
+            print(f"saved user {args.username}")
+        else:
+            set_modules(db, args.patient, args.modules)
+            print(f"{args.patient}: {', '.join(args.modules) or 'no modules'}")
+        db.commit()
+    finally:
+        db.close()
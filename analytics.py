@@ -0,0 +1,237 @@
+# analytics.py
+import asyncio
+import os
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+import numpy as np
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+import changes
+from models import Vital
+
+METRICS = ("heart_rate", "bp_systolic", "bp_diastolic", "temperature")
+LABELS = {"heart_rate": "Heart rate", "bp_systolic": "Systolic BP", "bp_diastolic": "Diastolic BP", "temperature": "Temperature"}
+# 標準範圍 (same as the monitoring task list in history.html)
+NORMAL_RANGES = {"heart_rate": (60, 100), "bp_systolic": (90, 120), "bp_diastolic": (60, 80), "temperature": (36.1, 37.2)}
+
+TREND_WINDOW = int(os.environ.get("MEDICALWEB_TREND_WINDOW", "50"))  # readings per patient
+Z_THRESHOLD = float(os.environ.get("MEDICALWEB_TREND_Z", "3.0"))
+MIN_POINTS = 5  # baseline readings needed before a z-score means anything
+
+_LOW = np.array([NORMAL_RANGES[m][0] for m in METRICS], dtype=float)
+_HIGH = np.array([NORMAL_RANGES[m][1] for m in METRICS], dtype=float)
+_M = len(METRICS)
+
+
+def _epoch_seconds(datetimes: List[Any]) -> np.ndarray:
+    return np.array(datetimes, dtype="datetime64[us]").astype(np.int64) / 1e6
+
+
+# Window statistics for a block of patients, all metrics at once.
+# values: (R, M, W) readings oldest -> newest, NaN = no reading; times: (R, W) epoch seconds
+def window_stats(values: np.ndarray, times: np.ndarray) -> Dict[str, np.ndarray]:
+    mask = ~np.isnan(values)
+    n = mask.sum(-1)
+    vz = np.where(mask, values, 0.0)
+    days = np.where(mask, times[:, None, :] / 86400.0, 0.0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        total = vz.sum(-1)
+        sumsq = (vz * vz).sum(-1)
+        mean = total / n
+        std = np.sqrt(np.maximum(sumsq / n - mean * mean, 0.0))
+        vmin = np.where(mask, values, np.inf).min(-1)
+        vmax = np.where(mask, values, -np.inf).max(-1)
+
+        # least-squares slope per day
+        dt = np.where(mask, days - (days.sum(-1) / n)[..., None], 0.0)
+        dv = np.where(mask, values - mean[..., None], 0.0)
+        slope = (dt * dv).sum(-1) / (dt * dt).sum(-1)
+
+        # newest reading against the baseline of the readings before it
+        last_idx = values.shape[-1] - 1 - np.argmax(mask[..., ::-1], axis=-1)
+        latest = np.take_along_axis(values, last_idx[..., None], -1)[..., 0]
+        nb = n - 1
+        base_mean = (total - np.nan_to_num(latest)) / nb
+        base_std = np.sqrt(np.maximum((sumsq - np.nan_to_num(latest) ** 2) / nb - base_mean ** 2, 0.0))
+        z = (latest - base_mean) / base_std
+
+    empty = n == 0
+    vmin[empty] = np.nan
+    vmax[empty] = np.nan
+    latest[empty] = np.nan
+    slope[n < 2] = np.nan
+    z[(nb < MIN_POINTS) | ~(base_std > 0)] = np.nan
+    breach = (latest < _LOW) | (latest > _HIGH)
+    return {"points": n, "mean": mean, "std": std, "min": vmin, "max": vmax, "slope": slope,
+            "latest": latest, "z": z, "breach": breach, "outlier": np.abs(z) >= Z_THRESHOLD}
+
+
+def _num(x) -> Optional[float]:
+    return None if np.isnan(x) else round(float(x), 2)
+
+
+# Each patient's last TREND_WINDOW readings live in one row of a population
+# matrix (patients x metrics x window), newest in the last column. New
+# readings from the change feed shift into their patient's row; stats are
+# recomputed for all changed rows in one vectorized pass when read. Edits,
+# deletes and out-of-order readings reload that patient's window instead.
+class TrendEngine:
+    def __init__(self, window: int = TREND_WINDOW, capacity: int = 1024):
+        self.window = window
+        self._rows: Dict[int, int] = {}
+        self._values = np.full((capacity, _M, window), np.nan)
+        self._times = np.full((capacity, window), np.nan)
+        self._results: Dict[str, np.ndarray] = {}
+        self._dirty: Set[int] = set()
+        self._stale: Set[int] = set()
+        self._loaded = False
+        self._loading = False
+        self._lock = threading.Lock()
+        self._refresh_lock = asyncio.Lock()
+        self.stats = {"appends": 0, "reloads": 0, "passes": 0, "rows_computed": 0}
+
+    def _row(self, patient_id: int) -> int:
+        row = self._rows.get(patient_id)
+        if row is None:
+            row = len(self._rows)
+            if row >= len(self._values):
+                self._grow()
+            self._rows[patient_id] = row
+        return row
+
+    def _grow(self):
+        extra = len(self._values)
+        self._values = np.concatenate([self._values, np.full((extra, _M, self.window), np.nan)])
+        self._times = np.concatenate([self._times, np.full((extra, self.window), np.nan)])
+        self._results = {k: np.concatenate([v, np.zeros((extra,) + v.shape[1:], v.dtype)])
+                         for k, v in self._results.items()}
+
+    def _window_rows(self, db: Session, patient_ids: Optional[List[int]]):
+        rn = func.row_number().over(partition_by=Vital.patient_id,
+                                    order_by=(Vital.measured_at.desc(), Vital.log_id.desc())).label("rn")
+        inner = select(Vital.patient_id, Vital.measured_at, *[getattr(Vital, m) for m in METRICS], rn)
+        if patient_ids is not None:
+            inner = inner.where(Vital.patient_id.in_(patient_ids))
+        inner = inner.subquery()
+        return db.execute(select(inner).where(inner.c.rn <= self.window)).all()
+
+    # (Re)load the windows of the given patients (None = everyone) from the vitals table
+    def load(self, db: Session, patient_ids: Optional[List[int]] = None):
+        with self._lock:
+            self._loading = True
+        try:
+            rows = self._window_rows(db, patient_ids)
+        except Exception:
+            with self._lock:
+                self._loading = False
+            raise
+        with self._lock:
+            # readings committed while the query ran were marked stale, not lost
+            self._loading = False
+            targets = [self._row(pid) for pid in (patient_ids if patient_ids is not None else self._rows)]
+            self._values[targets] = np.nan
+            self._times[targets] = np.nan
+            if rows:
+                pids = np.array([r[0] for r in rows])
+                uniq, inv = np.unique(pids, return_inverse=True)
+                row_idx = np.array([self._row(int(p)) for p in uniq])[inv]
+                cols = self.window - np.array([r[-1] for r in rows])
+                self._values[row_idx, :, cols] = np.array([r[2:2 + _M] for r in rows], dtype=float)
+                self._times[row_idx, cols] = _epoch_seconds([r[1] for r in rows])
+            self._dirty.update(self._rows.values() if patient_ids is None else targets)
+            self._loaded = True
+            self.stats["reloads"] += 1
+
+    def _append(self, patient_id: int, measured_at, values: Dict[str, Any]):
+        row = self._row(patient_id)
+        t = _epoch_seconds([measured_at])[0]
+        last = self._times[row, -1]
+        if not np.isnan(last) and t < last:
+            self._stale.add(patient_id)
+            return
+        self._values[row, :, :-1] = self._values[row, :, 1:]
+        self._times[row, :-1] = self._times[row, 1:]
+        self._values[row, :, -1] = [np.nan if values.get(m) is None else values[m] for m in METRICS]
+        self._times[row, -1] = t
+        self._dirty.add(row)
+        self.stats["appends"] += 1
+
+    # changes.subscribe() listener (runs in the committing thread)
+    def apply(self, changes: List[Dict[str, Any]]):
+        with self._lock:
+            if not self._loaded and not self._loading:
+                return
+            for c in changes:
+                if c["kind"] != "log":
+                    continue
+                pid = c["patient_id"]
+                vitals = c.get("vitals") or {}
+                if self._loading or c["action"] != "add":
+                    self._stale.add(pid)
+                elif any(vitals.get(m) is not None for m in METRICS):
+                    self._append(pid, vitals["measured_at"], vitals)
+
+    # Forget every window; the next refresh reloads them all
+    def reset(self):
+        with self._lock:
+            self._loaded = False
+            self._stale.clear()
+
+    # One vectorized pass over every row that changed since the last read
+    def compute(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            rows = np.fromiter(self._dirty, dtype=np.int64)
+            self._dirty.clear()
+            stats = window_stats(self._values[rows], self._times[rows])
+            if not self._results:
+                self._results = {k: np.zeros((len(self._values),) + v.shape[1:], v.dtype) for k, v in stats.items()}
+            for k, v in stats.items():
+                self._results[k][rows] = v
+            self.stats["passes"] += 1
+            self.stats["rows_computed"] += len(rows)
+
+    # Bring the engine up to date (first use loads everyone) and recompute
+    async def refresh(self, db: AsyncSession):
+        async with self._refresh_lock:
+            if not self._loaded:
+                await db.run_sync(self.load)
+            elif self._stale:
+                with self._lock:
+                    stale, self._stale = list(self._stale), set()
+                await db.run_sync(self.load, stale)
+        self.compute()
+
+    def summary(self, patient_id: int) -> Dict[str, Any]:
+        row = self._rows.get(patient_id)
+        if row is None or not self._results:
+            return {"metrics": {}, "anomalies": []}
+        r = {k: v[row] for k, v in self._results.items()}
+        metrics, anomalies = {}, []
+        for i, m in enumerate(METRICS):
+            if not r["points"][i]:
+                continue
+            metrics[m] = {"points": int(r["points"][i]), "mean": _num(r["mean"][i]), "std": _num(r["std"][i]),
+                          "min": _num(r["min"][i]), "max": _num(r["max"][i]), "slope_per_day": _num(r["slope"][i]),
+                          "latest": _num(r["latest"][i]), "z": _num(r["z"][i]), "breach": bool(r["breach"][i])}
+            lo, hi = NORMAL_RANGES[m]
+            if r["breach"][i]:
+                anomalies.append(f"{LABELS[m]} {_num(r['latest'][i])} outside {lo}-{hi}")
+            if r["outlier"][i]:
+                anomalies.append(f"{LABELS[m]} z={_num(r['z'][i])} vs recent readings")
+        return {"metrics": metrics, "anomalies": anomalies}
+
+
+trends = TrendEngine()
+# the app imports this module on first use (it pulls in numpy), so the engine
+# joins the change feed itself
+changes.subscribe(trends.apply)
+
+
+async def trend_summaries(db: AsyncSession, patient_ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+    await trends.refresh(db)
+    return {pid: trends.summary(pid) for pid in patient_ids}
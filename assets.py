@@ -0,0 +1,39 @@
+# assets.py
+import hashlib
+import os
+from typing import Dict
+
+from fastapi.staticfiles import StaticFiles
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+# Static files served under content-hashed names (style.css -> style.3f2a1b9c.css)
+# so they can be cached for a year; a changed file gets a new name. Templates
+# link through static_url(). Plain names still work, with revalidation.
+class FingerprintedStaticFiles(StaticFiles):
+    def __init__(self, *, directory: str, url_prefix: str = "/static", **kwargs):
+        super().__init__(directory=directory, **kwargs)
+        self.url_prefix = url_prefix
+        self.manifest: Dict[str, str] = {}
+        self._originals: Dict[str, str] = {}
+        for root, _, files in os.walk(directory):
+            for name in files:
+                full = os.path.join(root, name)
+                rel = os.path.relpath(full, directory).replace(os.sep, "/")
+                with open(full, "rb") as f:
+                    digest = hashlib.blake2b(f.read(), digest_size=4).hexdigest()
+                stem, ext = os.path.splitext(rel)
+                hashed = f"{stem}.{digest}{ext}"
+                self.manifest[rel] = hashed
+                self._originals[hashed] = rel
+
+    def url(self, path: str) -> str:
+        return f"{self.url_prefix}/{self.manifest.get(path, path)}"
+
+    async def get_response(self, path: str, scope):
+        original = self._originals.get(path.replace(os.sep, "/"))
+        response = await super().get_response(original or path, scope)
+        if response.status_code == 200:
+            response.headers["Cache-Control"] = IMMUTABLE if original else "public, no-cache"
+        return response
@@ -0,0 +1,180 @@
+# benchmarks/datagen.py
+import argparse
+import datetime
+import os
+import random
+import sqlite3
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Synthetic population for benchmarks: patients with a steady stream of vitals
+# logs, clinical histories, homecare requests and emergency events at
+# configurable rates. Rows are written straight through sqlite3 executemany
+# in chunks (ids assigned here, so logs and their vitals go in together), so
+# 100M logs is a matter of disk and patience, not memory.
+#
+#   python benchmarks/datagen.py --db /tmp/bench.db --patients 10000 --logs-per-patient 10000
+
+TS_FORMAT = "%Y-%m-%d %H:%M:%S.%f"  # how SQLAlchemy stores DateTime on SQLite
+WORDS = ("stable resting after walk chest tightness mild dizziness palpitations fatigue headache "
+         "cough fever medication taken skipped dose sleep poor good appetite").split()
+CHUNK = 50000
+
+BENCH_PATIENT = ("BenchPatient", "bench", "patient")  # login for the first synthetic patient
+
+
+def _ts(dt: datetime.datetime) -> str:
+    return dt.strftime(TS_FORMAT)
+
+
+def _note(rnd: random.Random, n: int) -> str:
+    return " ".join(rnd.choice(WORDS) for _ in range(n))
+
+
+class Generator:
+    def __init__(self, conn: sqlite3.Connection, seed: int = 1, days: int = 365):
+        from models import EMERGENCY_STATUSES, HOMECARE_STATUSES
+
+        self.conn = conn
+        self.rnd = random.Random(seed)
+        self.now = datetime.datetime.now().replace(microsecond=0)
+        self.days = days
+        self.homecare_codes = {s: i for i, s in enumerate(HOMECARE_STATUSES)}
+        self.emergency_codes = {s: i for i, s in enumerate(EMERGENCY_STATUSES)}
+        self.log_id = (conn.execute("SELECT max(id) FROM logs").fetchone()[0] or 0) + 1
+        self.history_id = (conn.execute("SELECT max(id) FROM histories").fetchone()[0] or 0) + 1
+        self.buffers = {"logs": [], "vitals": [], "histories": [], "homecare_requests": [], "emergency_events": []}
+        self.counts = {k: 0 for k in self.buffers}
+
+    _SQL = {
+        "logs": "INSERT INTO logs (id, content, timestamp, patient_id) VALUES (?, ?, ?, ?)",
+        "vitals": "INSERT INTO vitals (log_id, patient_id, heart_rate, bp_systolic, bp_diastolic, temperature, "
+                  "measured_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        "histories": "INSERT INTO histories (id, content, created_at, patient_id) VALUES (?, ?, ?, ?)",
+        "homecare_requests": "INSERT INTO homecare_requests (reason, status, requested_at, patient_id) VALUES (?, ?, ?, ?)",
+        "emergency_events": "INSERT INTO emergency_events (event, status, time, patient_id) VALUES (?, ?, ?, ?)",
+    }
+
+    def _add(self, table: str, row):
+        buf = self.buffers[table]
+        buf.append(row)
+        if len(buf) >= CHUNK:
+            self._flush(table)
+
+    def _flush(self, table: str):
+        buf = self.buffers[table]
+        if buf:
+            self.conn.executemany(self._SQL[table], buf)
+            self.counts[table] += len(buf)
+            buf.clear()
+
+    def flush(self):
+        # logs before vitals, so foreign keys always point at existing rows
+        for table in self.buffers:
+            self._flush(table)
+        self.conn.commit()
+
+    def patient(self, pid: int, logs: int, histories: int, homecare_rate: float, emergency_rate: float):
+        rnd = self.rnd
+        start = self.now - datetime.timedelta(days=self.days)
+        step = datetime.timedelta(days=self.days) / max(logs, 1)
+        # per-patient baseline, readings wander around it
+        hr, sys_bp, dia_bp, temp = rnd.gauss(75, 8), rnd.gauss(120, 12), rnd.gauss(78, 8), rnd.gauss(36.7, 0.2)
+        for i in range(logs):
+            t = start + step * i + datetime.timedelta(seconds=rnd.randint(0, 600))
+            h = max(35, int(rnd.gauss(hr, 6)))
+            parts = [f"Heart rate {h}"]
+            s = d = temperature = None
+            if rnd.random() < 0.5:
+                s, d = int(rnd.gauss(sys_bp, 8)), int(rnd.gauss(dia_bp, 6))
+                parts.append(f"BP {s}/{d}")
+            if rnd.random() < 0.3:
+                temperature = round(rnd.gauss(temp, 0.3), 1)
+                parts.append(f"Temp {temperature}")
+            content = f"{t:%Y-%m-%d %H:%M}: " + ", ".join(parts) + (f". {_note(rnd, 4)}" if rnd.random() < 0.3 else "")
+            self._add("logs", (self.log_id, content, _ts(t), pid))
+            self._add("vitals", (self.log_id, pid, h, s, d, temperature, _ts(t.replace(second=0))))
+            self.log_id += 1
+            if rnd.random() < emergency_rate:
+                status = "處理中" if t > self.now - datetime.timedelta(days=1) else "已處理"
+                self._add("emergency_events", (f"心率過高 (heart_rate {h + 60} bpm)", self.emergency_codes[status],
+                                               _ts(t), pid))
+        for i in range(histories):
+            t = start + datetime.timedelta(days=rnd.uniform(0, self.days))
+            self._add("histories", (self.history_id, f"{t:%Y-%m-%d}: {_note(rnd, 8)}", _ts(t), pid))
+            self.history_id += 1
+        if rnd.random() < homecare_rate:
+            status = rnd.choices(["pending", "approved", "rejected", "completed"], [3, 4, 1, 2])[0]
+            t = self.now - datetime.timedelta(days=rnd.uniform(0, 30))
+            self._add("homecare_requests", (_note(rnd, 5), self.homecare_codes[status], _ts(t), pid))
+
+
+def generate(path: str, patients: int, logs: int, histories: int, homecare_rate: float, emergency_rate: float,
+             seed: int = 1, fts: bool = True):
+    os.environ["MEDICALWEB_DATABASE_URL"] = f"sqlite:///{path}"
+    import migrations
+    import search
+    from accounts import add_user
+    from database import SessionLocal, engine
+    from models import Patient
+
+    migrations.upgrade(engine)
+    started = time.perf_counter()
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    first = (conn.execute("SELECT max(id) FROM patients").fetchone()[0] or 0) + 1
+    rnd = random.Random(seed)
+    conn.executemany(
+        "INSERT INTO patients (id, name, blood_type, age, height, weight) VALUES (?, ?, ?, ?, ?, ?)",
+        [(pid, f"P{pid:06d}", rnd.choice(["A", "B", "AB", "O"]), rnd.randint(20, 95), rnd.randint(145, 195),
+          rnd.randint(40, 120)) for pid in range(first, first + patients)],
+    )
+    conn.executemany(
+        "INSERT INTO patient_modules (patient_id, name) VALUES (?, ?)",
+        [(pid, "Heart Monitoring Model") for pid in range(first, first + patients) if rnd.random() < 0.4],
+    )
+    gen = Generator(conn, seed, days=365)
+    for n, pid in enumerate(range(first, first + patients), 1):
+        gen.patient(pid, logs, histories, homecare_rate, emergency_rate)
+        if n % 1000 == 0:
+            gen.flush()
+            print(f"  {n}/{patients} patients, {gen.log_id - 1} logs", file=sys.stderr)
+    gen.flush()
+    conn.close()
+
+    db = SessionLocal()
+    try:
+        name = db.query(Patient.name).filter(Patient.id == first).scalar()
+        if name:
+            add_user(db, BENCH_PATIENT[0], BENCH_PATIENT[1], BENCH_PATIENT[2], name)
+        db.commit()
+    finally:
+        db.close()
+    if fts and search.is_supported(engine):
+        with engine.begin() as c:
+            search.rebuild(c)
+    with engine.begin() as c:
+        c.exec_driver_sql("ANALYZE")
+    took = time.perf_counter() - started
+    counts = {**gen.counts, "patients": patients}
+    print(f"generated {counts} in {took:.1f}s", file=sys.stderr)
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic patient population")
+    parser.add_argument("--db", required=True, help="SQLite file (created and migrated if missing)")
+    parser.add_argument("--patients", type=int, default=1000)
+    parser.add_argument("--logs-per-patient", type=int, default=100)
+    parser.add_argument("--histories-per-patient", type=int, default=10)
+    parser.add_argument("--homecare-rate", type=float, default=0.05, help="share of patients with a homecare request")
+    parser.add_argument("--emergency-rate", type=float, default=0.001, help="emergency events per log")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-fts", action="store_true", help="skip building the full-text index")
+    args = parser.parse_args()
+    generate(args.db, args.patients, args.logs_per_patient, args.histories_per_patient, args.homecare_rate,
+             args.emergency_rate, args.seed, not args.no_fts)
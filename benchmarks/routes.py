@@ -0,0 +1,320 @@
+# benchmarks/routes.py
+import argparse
+import asyncio
+import datetime
+import glob
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS = os.path.join(ROOT, "benchmarks", "results")
+sys.path.insert(0, ROOT)
+
+# Route benchmarks: drives every route in-process through an ASGI client
+# against a database made by datagen.py, and reports per route
+#   p50/p95/p99 latency (ms), queries per request, peak RSS after the route.
+# Each run is saved as results/<time>-<commit>.json; `compare` diffs two runs
+# so a regression shows up next to the commit that caused it.
+#
+#   python benchmarks/datagen.py --db /tmp/bench.db --patients 10000 --logs-per-patient 100
+#   python benchmarks/routes.py run --db /tmp/bench.db
+#   python benchmarks/routes.py compare          latest run vs the one before
+#
+# Write routes change the database; regenerate it to compare like with like.
+
+DOCTOR = ("DoctorWu", "DDDDDDDD")
+PATIENT = ("BenchPatient", "bench")  # see datagen.BENCH_PATIENT
+
+
+def _s(name: str, who: str, method: str, path, n: Optional[int] = None, **kw) -> Dict[str, Any]:
+    # path/data/json may be callables of the iteration number, for writes that
+    # need a fresh row each time
+    return {"name": name, "who": who, "method": method, "path": path, "n": n, **kw}
+
+
+def scenarios(first_log: int, first_history: int) -> List[Dict[str, Any]]:
+    now = datetime.datetime.now().isoformat()
+    recent = (datetime.datetime.now() - datetime.timedelta(hours=6)).isoformat(timespec="seconds")
+    return [
+        _s("GET /login", "anonymous", "GET", "/login"),
+        _s("POST /login (bad password)", "anonymous", "POST", "/login", n=20,
+           data={"username": DOCTOR[0], "password": "wrong"}),
+        _s("GET / doctor", "doctor", "GET", "/"),
+        _s("GET / doctor (304)", "doctor", "GET", "/", revalidate=True),
+        _s("GET / patient", "patient", "GET", "/"),
+        _s("GET /history doctor", "doctor", "GET", "/history"),
+        _s("GET /history?patient", "doctor", "GET", "/history?patient=P000002"),
+        _s("GET /history patient", "patient", "GET", "/history"),
+        _s("GET /logs doctor", "doctor", "GET", "/logs"),
+        _s("GET /logs?patient&days", "doctor", "GET", "/logs?patient=P000002&days=30"),
+        _s("GET /logs patient", "patient", "GET", "/logs"),
+        _s("GET /logs patient (304)", "patient", "GET", "/logs", revalidate=True),
+        _s("GET /modules doctor", "doctor", "GET", "/modules"),
+        _s("GET /modules patient", "patient", "GET", "/modules"),
+        _s("GET /add_history", "doctor", "GET", "/add_history/P000002"),
+        _s("GET /apply_homecare doctor", "doctor", "GET", "/apply_homecare"),
+        _s("GET /apply_homecare patient", "patient", "GET", "/apply_homecare"),
+        _s("GET /apply_homecare approved", "doctor", "GET", "/apply_homecare?status=approved"),
+        _s("GET /emergency", "doctor", "GET", "/emergency"),
+        _s("GET /reports doctor", "doctor", "GET", "/reports"),
+        _s("GET /reports patient", "patient", "GET", "/reports"),
+        _s("GET /search", "doctor", "GET", "/search?q=chest"),
+        _s("GET /api/search", "doctor", "GET", "/api/search?q=palpitations&patient=P000002"),
+        _s("GET /api/search patient", "patient", "GET", "/api/search?q=heart"),
+        _s("GET /api/emergency/detector", "doctor", "GET", "/api/emergency/detector"),
+        _s("GET /api/vitals/series raw", "doctor", "GET", "/api/vitals/series?patient=P000002&days=0&since=" + recent),
+        _s("GET /api/vitals/series 30d", "doctor", "GET", "/api/vitals/series?patient=P000002&days=30"),
+        _s("GET /api/vitals/series 1y", "patient", "GET", "/api/vitals/series?days=365"),
+        _s("GET /api/modules/predictions", "patient", "GET", "/api/modules/predictions"),
+        _s("GET /api/reports", "doctor", "GET", "/api/reports?per_page=100"),
+        _s("GET /api/reports fields", "doctor", "GET", "/api/reports?per_page=100&fields=metrics,last_log"),
+        _s("GET /api/reports patient", "patient", "GET", "/api/reports"),
+        _s("GET /metrics", "anonymous", "GET", "/metrics"),
+        _s("GET /api/export/logs?patient", "doctor", "GET", "/api/export/logs?format=ndjson&patient=P000002"),
+        _s("GET /api/export/history", "doctor", "GET", "/api/export/history?format=csv", n=3),
+        _s("GET /api/export/logs", "doctor", "GET", "/api/export/logs?format=ndjson", n=3),
+        # writes
+        _s("POST /add_log", "doctor", "POST", "/add_log/P000002",
+           data=lambda i: {"log_text": f"Heart rate {60 + i % 40}, BP 120/80"}),
+        _s("POST /add_history", "doctor", "POST", "/add_history/P000002",
+           data=lambda i: {"report": f"Follow-up visit {i}"}),
+        _s("POST /logs/{id}/edit", "doctor", "POST", lambda i: f"/logs/{first_log + i}/edit",
+           data=lambda i: {"new_text": f"Heart rate {70 + i % 20}"}),
+        _s("POST /history/{id}/edit", "doctor", "POST", lambda i: f"/history/{first_history + i}/edit",
+           data={"new_text": "Reviewed"}),
+        _s("POST /edit_log", "doctor", "POST", "/edit_log/P000002/0", data={"new_text": "Heart rate 71"}),
+        _s("POST /edit_history", "doctor", "POST", "/edit_history/P000002/0", data={"new_text": "Reviewed again"}),
+        _s("POST /api/logs/bulk_edit", "doctor", "POST", "/api/logs/bulk_edit",
+           json=lambda i: {"items": [{"id": first_log + 200 + i * 10 + k, "content": "Heart rate 72"} for k in range(10)]}),
+        _s("POST /api/vitals/bulk", "doctor", "POST", "/api/vitals/bulk",
+           json=lambda i: [{"patient": f"P{3 + k:06d}", "heart_rate": 80, "measured_at": now} for k in range(20)]),
+        _s("POST /emergency/add", "doctor", "POST", "/emergency/add", n=20,
+           data={"patient": "P000004", "event": "Fall at home"}),
+        _s("POST /apply_homecare", "patient", "POST", "/apply_homecare", n=20, data={"reason": "Need help at home"}),
+        _s("POST /logs/{id}/delete", "doctor", "POST", lambda i: f"/logs/{first_log + 1000 + i}/delete"),
+        _s("POST /delete_log", "doctor", "POST", "/delete_log/P000002/0"),
+        _s("POST /history/{id}/delete", "doctor", "POST", lambda i: f"/history/{first_history + 1000 + i}/delete"),
+        _s("POST /delete_history", "doctor", "POST", "/delete_history/P000002/0"),
+        _s("POST /api/history/bulk_delete", "doctor", "POST", "/api/history/bulk_delete",
+           json=lambda i: {"ids": [first_history + 2000 + i * 10 + k for k in range(10)]}),
+    ]
+
+
+def _arg(value, i: int):
+    return value(i) if callable(value) else value
+
+
+def _percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * q
+    lo, hi = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def _peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB on Linux
+
+
+def _git(*args) -> str:
+    try:
+        return subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def _dataset(path: str) -> Dict[str, int]:
+    import sqlite3
+
+    conn = sqlite3.connect(path)
+    try:
+        return {t: conn.execute(f"SELECT count(*) FROM {t}").fetchone()[0]
+                for t in ("patients", "logs", "histories", "homecare_requests", "emergency_events")}
+    finally:
+        conn.close()
+
+
+async def _bench(items: List[Dict[str, Any]], iterations: int, warmup: int, concurrency: int,
+                 only: Optional[str]) -> Dict[str, Dict[str, Any]]:
+    import httpx
+    from sqlalchemy import event
+
+    import MedicalWeb
+    from database import async_engine, engine
+
+    queries = [0]
+
+    # the bus poller queries on a timer, not on behalf of a request
+    def count(conn, cursor, statement, parameters, context, executemany):
+        if threading.current_thread().name != "change-bus":
+            queries[0] += 1
+
+    for e in (engine, async_engine.sync_engine):
+        event.listen(e, "before_cursor_execute", count)
+
+    results: Dict[str, Dict[str, Any]] = {}
+    async with MedicalWeb.app.router.lifespan_context(MedicalWeb.app):
+        transport = httpx.ASGITransport(app=MedicalWeb.app)
+        clients = {}
+        try:
+            for who, creds in (("doctor", DOCTOR), ("patient", PATIENT), ("anonymous", None)):
+                clients[who] = httpx.AsyncClient(transport=transport, base_url="http://bench")
+                if creds:
+                    r = await clients[who].post("/login", data={"username": creds[0], "password": creds[1]})
+                    if r.status_code != 302:
+                        raise SystemExit(f"cannot log in as {creds[0]}; was the database made by datagen.py?")
+
+            for item in items:
+                if only and only not in item["name"]:
+                    continue
+                client = clients[item["who"]]
+                headers = {}
+                if item.get("revalidate"):
+                    etag = (await client.get(item["path"])).headers.get("etag")
+                    if not etag:
+                        print(f"skip {item['name']}: no ETag", file=sys.stderr)
+                        continue
+                    headers["If-None-Match"] = etag
+                n = item["n"] or iterations
+                counter = iter(range(-warmup if item["method"] == "GET" else 0, n))
+                latencies: List[float] = []
+                statuses: Dict[int, int] = {}
+
+                async def worker():
+                    for i in counter:
+                        started = time.perf_counter()
+                        r = await client.request(item["method"], _arg(item["path"], max(i, 0)), headers=headers,
+                                                 data=_arg(item.get("data"), i), json=_arg(item.get("json"), i))
+                        await r.aread()
+                        if i >= 0:
+                            latencies.append((time.perf_counter() - started) * 1000)
+                            statuses[r.status_code] = statuses.get(r.status_code, 0) + 1
+
+                before = queries[0]
+                started = time.perf_counter()
+                await asyncio.gather(*(worker() for _ in range(concurrency)))
+                elapsed = time.perf_counter() - started
+                total = max(len(latencies), 1)
+                results[item["name"]] = {
+                    "n": len(latencies),
+                    "p50_ms": round(_percentile(latencies, 0.50), 3),
+                    "p95_ms": round(_percentile(latencies, 0.95), 3),
+                    "p99_ms": round(_percentile(latencies, 0.99), 3),
+                    "mean_ms": round(statistics.fmean(latencies), 3),
+                    "rps": round(len(latencies) / elapsed, 1),
+                    # warm-up requests included in the count, so divide by all of them
+                    "queries_per_request": round((queries[0] - before) / (total + (warmup if item["method"] == "GET" else 0)), 2),
+                    "peak_rss_mb": round(_peak_rss_mb(), 1),
+                    "statuses": statuses,
+                }
+                r = results[item["name"]]
+                print(f"{item['name']:34} p50 {r['p50_ms']:8.2f}  p95 {r['p95_ms']:8.2f}  p99 {r['p99_ms']:8.2f} ms"
+                      f"  {r['queries_per_request']:6.2f} q/req  {r['peak_rss_mb']:7.1f} MB  {statuses}")
+        finally:
+            for c in clients.values():
+                await c.aclose()
+    for e in (engine, async_engine.sync_engine):
+        event.remove(e, "before_cursor_execute", count)
+    return results
+
+
+def run(path: str, iterations: int, warmup: int, concurrency: int, only: Optional[str] = None,
+        save: bool = True) -> Dict[str, Any]:
+    os.environ["MEDICALWEB_DATABASE_URL"] = f"sqlite:///{path}"
+    os.environ.pop("MEDICALWEB_ASYNC_DATABASE_URL", None)
+    os.environ.setdefault("MEDICALWEB_SECRET_KEY", "bench")
+
+    import sqlite3
+
+    conn = sqlite3.connect(path)
+    first_log = conn.execute("SELECT min(id) FROM logs").fetchone()[0] or 1
+    first_history = conn.execute("SELECT min(id) FROM histories").fetchone()[0] or 1
+    conn.close()
+    dataset = _dataset(path)
+
+    results = asyncio.run(_bench(scenarios(first_log, first_history), iterations, warmup, concurrency, only))
+    report = {
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": _git("rev-parse", "--short", "HEAD"),
+        "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "iterations": iterations,
+        "concurrency": concurrency,
+        "dataset": dataset,
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+        "routes": results,
+    }
+    if save:
+        os.makedirs(RESULTS, exist_ok=True)
+        name = f"{datetime.datetime.now():%Y%m%d-%H%M%S}-{report['commit'] or 'nogit'}.json"
+        out = os.path.join(RESULTS, name)
+        with open(out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"saved {os.path.relpath(out, ROOT)}")
+    return report
+
+
+def compare(old_path: str, new_path: str, threshold: float = 0.2) -> int:
+    with open(old_path, encoding="utf-8") as f:
+        old = json.load(f)
+    with open(new_path, encoding="utf-8") as f:
+        new = json.load(f)
+    print(f"{old['commit']} ({old['time']}) -> {new['commit']} ({new['time']})")
+    if old.get("dataset") != new.get("dataset"):
+        print(f"note: datasets differ {old.get('dataset')} -> {new.get('dataset')}")
+    if old.get("concurrency") != new.get("concurrency"):
+        print(f"note: concurrency differs {old.get('concurrency')} -> {new.get('concurrency')}")
+    regressions = 0
+    for name, r in new["routes"].items():
+        before = old["routes"].get(name)
+        if before is None:
+            print(f"{name:34} new")
+            continue
+        p50 = r["p50_ms"] / before["p50_ms"] - 1 if before["p50_ms"] else 0.0
+        p95 = r["p95_ms"] / before["p95_ms"] - 1 if before["p95_ms"] else 0.0
+        dq = r["queries_per_request"] - before["queries_per_request"]
+        flag = ""
+        if p95 > threshold or dq >= 1:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{name:34} p50 {before['p50_ms']:8.2f} -> {r['p50_ms']:8.2f} ({p50:+.0%})"
+              f"  p95 {before['p95_ms']:8.2f} -> {r['p95_ms']:8.2f} ({p95:+.0%})"
+              f"  q/req {before['queries_per_request']:.2f} -> {r['queries_per_request']:.2f}{flag}")
+    print(f"peak RSS {old['peak_rss_mb']} -> {new['peak_rss_mb']} MB, {regressions} regressions")
+    return regressions
+
+
+def _latest(n: int) -> List[str]:
+    return sorted(glob.glob(os.path.join(RESULTS, "*.json")))[-n:]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark every route against a synthetic database")
+    sub = parser.add_subparsers(dest="command", required=True)
+    r = sub.add_parser("run", help="benchmark the routes and save the results")
+    r.add_argument("--db", required=True, help="database made by benchmarks/datagen.py (write routes modify it)")
+    r.add_argument("-n", "--iterations", type=int, default=100, help="requests per route")
+    r.add_argument("--warmup", type=int, default=5, help="untimed requests before each read route")
+    r.add_argument("-c", "--concurrency", type=int, default=1, help="requests in flight per route")
+    r.add_argument("--only", help="only routes whose name contains this text")
+    r.add_argument("--no-save", action="store_true")
+    c = sub.add_parser("compare", help="diff two saved runs (default: the latest two)")
+    c.add_argument("old", nargs="?")
+    c.add_argument("new", nargs="?")
+    c.add_argument("--threshold", type=float, default=0.2, help="p95 slowdown counted as a regression")
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args.db, args.iterations, args.warmup, args.concurrency, args.only, not args.no_save)
+    else:
+        files = [args.old, args.new] if args.old and args.new else _latest(2)
+        if len(files) < 2:
+            sys.exit("need two saved runs to compare")
+        sys.exit(1 if compare(files[0], files[1], args.threshold) else 0)
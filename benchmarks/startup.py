@@ -0,0 +1,109 @@
+# benchmarks/startup.py
+import argparse
+import http.cookiejar
+import json
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Cold start of the app, measured from outside in fresh processes:
+#   import_ms    time to import MedicalWeb (no database work happens at import)
+#   ready_ms     process spawn -> first 200 from /login
+#   shutdown_ms  SIGTERM -> exit, with an SSE client connected (rolling restarts)
+# Runs against a temporary database migrated and seeded up front.
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def import_ms(env) -> float:
+    code = "import time; t = time.perf_counter(); import MedicalWeb; print((time.perf_counter() - t) * 1000)"
+    out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=env, check=True,
+                         capture_output=True, text=True).stdout
+    return float(out.strip().splitlines()[-1])
+
+
+def _wait_ready(url: str, proc, timeout: float = 30.0):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with {proc.returncode}")
+        try:
+            with urllib.request.urlopen(url, timeout=1) as r:
+                if r.status == 200:
+                    return
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.01)
+    raise RuntimeError("server did not come up")
+
+
+# One server lifetime: spawn, wait for /login, hold an SSE stream open, SIGTERM
+def server_run(env) -> dict:
+    port = _free_port()
+    base = f"http://127.0.0.1:{port}"
+    started = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "MedicalWeb.py"], cwd=ROOT, env={**env, "MEDICALWEB_PORT": str(port)},
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _wait_ready(base + "/login", proc)
+        ready = (time.perf_counter() - started) * 1000
+
+        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        opener.open(base + "/login", urllib.parse.urlencode({"username": "DoctorWu", "password": "DDDDDDDD"}).encode())
+        stream = opener.open(base + "/events", timeout=30)
+        stream.readline()  # retry: ...
+
+        stopping = time.perf_counter()
+        proc.send_signal(signal.SIGTERM)
+        proc.wait(timeout=60)
+        shutdown = (time.perf_counter() - stopping) * 1000
+        stream.close()
+        return {"ready_ms": ready, "shutdown_ms": shutdown}
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+
+
+def _summary(values):
+    return {"median": round(statistics.median(values), 1), "min": round(min(values), 1),
+            "max": round(max(values), 1)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Startup benchmark")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {**os.environ, "MEDICALWEB_DATABASE_URL": f"sqlite:///{os.path.join(tmp, 'bench.db')}"}
+        subprocess.run([sys.executable, "migrations.py", "upgrade"], cwd=ROOT, env=env, check=True, capture_output=True)
+        subprocess.run([sys.executable, "seed.py"], cwd=ROOT, env=env, check=True, capture_output=True)
+
+        imports = [import_ms(env) for _ in range(args.runs)]
+        runs = [server_run(env) for _ in range(args.runs)]
+
+    results = {
+        "runs": args.runs,
+        "import_ms": _summary(imports),
+        "ready_ms": _summary([r["ready_ms"] for r in runs]),
+        "shutdown_ms": _summary([r["shutdown_ms"] for r in runs]),
+    }
+    for key in ("import_ms", "ready_ms", "shutdown_ms"):
+        print(f"{key:12} median {results[key]['median']:8.1f}  min {results[key]['min']:8.1f}  max {results[key]['max']:8.1f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
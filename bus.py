@@ -0,0 +1,109 @@
+# bus.py
+import datetime
+import logging
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+from sqlalchemy import delete, func, select
+
+import changes
+from models import BusEntry
+
+# Cross-process half of the change feed. Every commit appends its changes to
+# the change_bus table (changes._publish); each worker polls the table and
+# replays rows written by other processes to its own subscribers, so caches,
+# data versions and SSE streams stay in step across workers. Rows are kept
+# for BUS_RETENTION_SECONDS; a worker that falls further behind than that
+# cannot replay what it missed and resets its caches instead (on_gap).
+BUS_POLL_MS = float(os.environ.get("MEDICALWEB_BUS_POLL_MS", "100"))
+BUS_RETENTION_SECONDS = float(os.environ.get("MEDICALWEB_BUS_RETENTION_SECONDS", "300"))
+BUS_BATCH = 500
+
+log = logging.getLogger(__name__)
+
+
+class ChangeBus:
+    def __init__(self, engine, poll_ms: float = BUS_POLL_MS, retention: float = BUS_RETENTION_SECONDS,
+                 on_seq: Optional[Callable[[int], None]] = None, on_gap: Optional[Callable[[], None]] = None):
+        self.engine = engine
+        self.interval = poll_ms / 1000
+        self.retention = retention
+        self.on_seq = on_seq
+        self.on_gap = on_gap
+        self.last_seq = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._pruned_at = 0.0
+        self.stats = {"polls": 0, "replayed": 0, "own": 0, "gaps": 0, "pruned": 0, "failed": 0}
+
+    # Start from the current end of the bus: caches start empty, nothing to replay
+    def start(self) -> int:
+        if self._thread is not None:
+            return self.last_seq
+        with self.engine.connect() as conn:
+            self.last_seq = conn.execute(select(func.max(BusEntry.seq))).scalar() or 0
+        if self.on_seq:
+            self.on_seq(self.last_seq)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="change-bus", daemon=True)
+        self._thread.start()
+        return self.last_seq
+
+    def stop(self, timeout: float = 5.0):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                while self.poll() == BUS_BATCH:
+                    pass
+                if time.monotonic() - self._pruned_at > self.retention / 10:
+                    self.prune()
+            except Exception:
+                self.stats["failed"] += 1
+                log.exception("change bus poll failed")
+
+    # Replay rows after last_seq, in order; returns how many were read
+    def poll(self) -> int:
+        self.stats["polls"] += 1
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                select(BusEntry.seq, BusEntry.origin, BusEntry.payload)
+                .where(BusEntry.seq > self.last_seq)
+                .order_by(BusEntry.seq)
+                .limit(BUS_BATCH)
+            ).all()
+            if rows and self.last_seq and rows[0].seq > self.last_seq + 1:
+                # a skipped seq is either a rolled back insert (harmless) or a row
+                # pruned before we read it (replay is incomplete)
+                oldest = conn.execute(select(func.min(BusEntry.seq))).scalar()
+                if oldest is not None and oldest > self.last_seq + 1:
+                    self.stats["gaps"] += 1
+                    log.warning("change bus fell behind (seq %d -> %d), resetting caches", self.last_seq, oldest)
+                    if self.on_gap:
+                        self.on_gap()
+        for seq, origin, payload in rows:
+            if origin == changes.ORIGIN:
+                self.stats["own"] += 1  # already dispatched when it committed here
+            else:
+                batch = changes.decode(payload)
+                for c in batch:
+                    c["seq"] = seq
+                changes.dispatch(batch, remote=True)
+                self.stats["replayed"] += len(batch)
+            self.last_seq = seq
+            if self.on_seq:
+                self.on_seq(seq)
+        return len(rows)
+
+    def prune(self):
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=self.retention)
+        with self.engine.begin() as conn:
+            self.stats["pruned"] += conn.execute(delete(BusEntry).where(BusEntry.created_at < cutoff)).rowcount
+        self._pruned_at = time.monotonic()
@@ -0,0 +1,118 @@
+# changes.py
+import datetime
+import logging
+import os
+import uuid
+from typing import Any, Callable, Dict, List
+
+import orjson
+from sqlalchemy import event, insert
+from sqlalchemy.orm import Session
+
+# Write ops note what they changed on their session; once the transaction
+# commits, every subscriber gets the list (in the committing thread). Rolled
+# back changes are discarded, so a replayed op never reports twice.
+#
+# A change is a dict: {"kind": "log" | "history" | "homecare" | "emergency" | "modules",
+#                      "action": "add" | "edit" | "delete",
+#                      "patient_id": int, "seq": bus sequence number, ...kind-specific fields}
+#
+# The same list is also written to the change_bus table inside the committing
+# transaction, so other processes (workers, CLIs) see exactly the committed
+# changes; bus.py replays them to this process's subscribers.
+
+Listener = Callable[[List[Dict[str, Any]]], None]
+
+PUBLISH = os.environ.get("MEDICALWEB_CHANGE_BUS", "1") == "1"
+BUS_CHUNK = 1000  # changes per bus row
+ORIGIN = uuid.uuid4().hex  # this process
+_DATETIME_FIELDS = ("timestamp", "requested_at", "time", "measured_at")
+
+_listeners: List[Listener] = []
+_local_only: List[Listener] = []
+log = logging.getLogger(__name__)
+
+
+def record(db: Session, kind: str, action: str, patient_id, **fields):
+    db.info.setdefault("changes", []).append({"kind": kind, "action": action, "patient_id": patient_id, **fields})
+
+
+# local_only listeners only see commits made by this process (e.g. the
+# emergency detector, which must screen each reading once)
+def subscribe(fn: Listener, local_only: bool = False) -> Listener:
+    (_local_only if local_only else _listeners).append(fn)
+    return fn
+
+
+def dispatch(changes: List[Dict[str, Any]], remote: bool = False):
+    for fn in _listeners if remote else _listeners + _local_only:
+        try:
+            fn(changes)
+        except Exception:
+            log.exception("change listener %r failed", fn)
+
+
+def encode(changes: List[Dict[str, Any]]) -> bytes:
+    return orjson.dumps(changes)
+
+
+def _revive(c: Dict[str, Any]) -> Dict[str, Any]:
+    for key in _DATETIME_FIELDS:
+        if isinstance(c.get(key), str):
+            c[key] = datetime.datetime.fromisoformat(c[key])
+    if isinstance(c.get("vitals"), dict):
+        _revive(c["vitals"])
+    return c
+
+
+def decode(payload: bytes) -> List[Dict[str, Any]]:
+    return [_revive(c) for c in orjson.loads(payload)]
+
+
+@event.listens_for(Session, "before_commit")
+def _publish(session: Session):
+    changes = session.info.get("changes")
+    if not changes or not PUBLISH:
+        return
+    from models import BusEntry
+
+    conn = session.connection()
+    for i in range(0, len(changes), BUS_CHUNK):
+        chunk = changes[i:i + BUS_CHUNK]
+        seq = conn.execute(insert(BusEntry).values(origin=ORIGIN, payload=encode(chunk))).inserted_primary_key[0]
+        for c in chunk:
+            c["seq"] = seq
+
+
+# Each patient the transaction touched gets its data generation moved on in
+# the same commit, whichever process (worker or CLI) made it; derived data
+# stamped with an older generation is out of date (see snapshots.py)
+@event.listens_for(Session, "before_commit")
+def _bump_generations(session: Session):
+    changes = session.info.get("changes")
+    if not changes:
+        return
+    from database import upsert, upsert_supported
+    from models import PatientGeneration
+
+    conn = session.connection()
+    # without an upsert snapshots are never stored either (snapshots.store)
+    if not upsert_supported(conn):
+        return
+    ids = sorted({c["patient_id"] for c in changes if c["patient_id"] is not None})
+    if ids:
+        stmt = upsert(conn, PatientGeneration).on_conflict_do_update(
+            index_elements=["patient_id"], set_={"generation": PatientGeneration.generation + 1})
+        conn.execute(stmt, [{"patient_id": i, "generation": 1} for i in ids])
+
+
+@event.listens_for(Session, "after_commit")
+def _dispatch(session: Session):
+    changes = session.info.pop("changes", None)
+    if changes:
+        dispatch(changes)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard(session: Session):
+    session.info.pop("changes", None)
@@ -1,12 +1,80 @@
 # database.py
-from sqlalchemy import create_engine
+import importlib
+import os
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
-DATABASE_URL = "sqlite:///./medical_data.db"
+DATABASE_URL = os.environ.get("MEDICALWEB_DATABASE_URL", "sqlite:///./medical_data.db")
+
+
+# sqlite:// -> sqlite+aiosqlite://, postgresql:// -> postgresql+asyncpg://
+def to_async_url(url: str) -> str:
+    scheme, sep, rest = url.partition("://")
+    driver = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg"}.get(scheme.split("+")[0])
+    return f"{driver}{sep}{rest}" if driver else url
+
+
+ASYNC_DATABASE_URL = os.environ.get("MEDICALWEB_ASYNC_DATABASE_URL", to_async_url(DATABASE_URL))
+
+# Pool and SQLite tuning, overridable per deployment
+POOL_SIZE = int(os.environ.get("MEDICALWEB_POOL_SIZE", "10"))
+MAX_OVERFLOW = int(os.environ.get("MEDICALWEB_MAX_OVERFLOW", "20"))
+POOL_TIMEOUT = float(os.environ.get("MEDICALWEB_POOL_TIMEOUT", "30"))
+POOL_RECYCLE = int(os.environ.get("MEDICALWEB_POOL_RECYCLE", "-1"))
+SQLITE_MMAP_SIZE = int(os.environ.get("MEDICALWEB_SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_CACHE_KB = int(os.environ.get("MEDICALWEB_SQLITE_CACHE_KB", str(64 * 1024)))
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("MEDICALWEB_SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+
+# INSERT ... ON CONFLICT DO UPDATE, spelled the same on SQLite and PostgreSQL.
+# Callers check upsert_supported() first, like search.is_supported().
+_UPSERT_DIALECTS = {"sqlite": "sqlalchemy.dialects.sqlite", "postgresql": "sqlalchemy.dialects.postgresql"}
+
+
+def upsert_supported(bind) -> bool:
+    return bind.dialect.name in _UPSERT_DIALECTS
+
+
+def upsert(bind, table):
+    module = importlib.import_module(_UPSERT_DIALECTS[bind.dialect.name])
+    return module.insert(table)
+
+
+def _is_sqlite(url: str) -> bool:
+    return url.startswith("sqlite")
+
+
+def _engine_kwargs(url: str) -> dict:
+    kwargs = {"pool_size": POOL_SIZE, "max_overflow": MAX_OVERFLOW,
+              "pool_timeout": POOL_TIMEOUT, "pool_recycle": POOL_RECYCLE}
+    if _is_sqlite(url):
+        kwargs["connect_args"] = {"check_same_thread": False}
+    return kwargs
+
+
+# WAL lets readers run while the writer commits; synchronous=NORMAL only fsyncs
+# at checkpoints (the writer's urgent lane raises it to FULL per transaction).
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_KB}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.close()
+
+
+engine = create_engine(DATABASE_URL, **_engine_kwargs(DATABASE_URL))
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **_engine_kwargs(ASYNC_DATABASE_URL))
+
+if _is_sqlite(DATABASE_URL) and ":memory:" not in DATABASE_URL:
+    event.listen(engine, "connect", _apply_sqlite_pragmas)
+if _is_sqlite(ASYNC_DATABASE_URL) and ":memory:" not in ASYNC_DATABASE_URL:
+    event.listen(async_engine.sync_engine, "connect", _apply_sqlite_pragmas)
 
-engine = create_engine(
-    DATABASE_URL, connect_args={"check_same_thread": False}
-)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
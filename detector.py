@@ -0,0 +1,275 @@
+# detector.py
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+import changes
+from models import EmergencyEvent, Patient
+from vitals import has_time_of_day
+
+METRICS = ("heart_rate", "bp_systolic", "bp_diastolic", "temperature")
+UNITS = {"heart_rate": "bpm", "bp_systolic": "mmHg", "bp_diastolic": "mmHg", "temperature": "°C"}
+
+# Rules: {"name", "metric", and one of
+#   "above" / "below": threshold on the reading itself
+#   "rise" / "fall" + "within_minutes": change from the patient's previous reading}
+# Override with a JSON list in the file named by MEDICALWEB_ALERT_RULES.
+DEFAULT_RULES = [
+    {"name": "心率過高", "metric": "heart_rate", "above": 130},
+    {"name": "心率過低", "metric": "heart_rate", "below": 40},
+    {"name": "血壓過高", "metric": "bp_systolic", "above": 180},
+    {"name": "舒張壓過高", "metric": "bp_diastolic", "above": 120},
+    {"name": "血壓過低", "metric": "bp_systolic", "below": 80},
+    {"name": "高燒", "metric": "temperature", "above": 39.5},
+    {"name": "體溫過低", "metric": "temperature", "below": 35.0},
+    {"name": "心率驟升", "metric": "heart_rate", "rise": 40, "within_minutes": 10},
+    {"name": "血壓驟降", "metric": "bp_systolic", "fall": 40, "within_minutes": 15},
+]
+
+DEDUPE_MINUTES = float(os.environ.get("MEDICALWEB_ALERT_DEDUPE_MINUTES", "30"))
+MAX_AGE_MINUTES = float(os.environ.get("MEDICALWEB_ALERT_MAX_AGE_MINUTES", "60"))  # older readings are backfill, not alerts
+
+log = logging.getLogger(__name__)
+
+
+def load_rules() -> List[Dict[str, Any]]:
+    path = os.environ.get("MEDICALWEB_ALERT_RULES")
+    if not path:
+        return DEFAULT_RULES
+    with open(path, encoding="utf-8") as f:
+        rules = json.load(f)
+    for r in rules:
+        if r.get("metric") not in METRICS or not any(k in r for k in ("above", "below", "rise", "fall")):
+            raise ValueError(f"invalid alert rule {r!r}")
+    return rules
+
+
+def _epoch(dt: datetime.datetime) -> float:
+    return dt.timestamp()
+
+
+# When a log change's reading was taken. A date-only line ("2025-09-01: Heart
+# rate 170") is stored at midnight; written that same day it counts as taken
+# when it was written, so it is not skipped as backfill.
+def reading_time(c: Dict[str, Any]) -> datetime.datetime:
+    measured = c["vitals"]["measured_at"]
+    written = c.get("timestamp")
+    if written is not None and written.date() == measured.date() and not has_time_of_day(c.get("content")):
+        return written
+    return measured
+
+
+# Readings evaluated in one micro-batch: parallel arrays, sorted by (patient, time).
+# numpy is imported on first use, keeping it out of app startup.
+class Batch:
+    def __init__(self, items: List[Tuple[int, float, Dict[str, Any], float]]):
+        import numpy as np
+
+        items.sort(key=lambda it: (it[0], it[1]))
+        self.patient_ids = np.array([it[0] for it in items], dtype=np.int64)
+        self.times = np.array([it[1] for it in items])
+        self.values = np.array([[np.nan if it[2].get(m) is None else it[2][m] for m in METRICS] for it in items],
+                               dtype=float).reshape(len(items), len(METRICS))
+        self.enqueued = np.array([it[3] for it in items])
+
+
+# Background rule engine fed by the committed-change feed. Readings are queued
+# in the committing thread (cheap, never blocks ingest) and evaluated by one
+# worker thread in micro-batches; all the alerts of a batch are written in one
+# urgent transaction.
+class EmergencyDetector:
+    def __init__(self, submit: Callable, rules: Optional[List[Dict[str, Any]]] = None, batch_size: int = 5000,
+                 interval: float = 0.05, max_pending: int = 200000):
+        self.submit = submit
+        self.rules = rules if rules is not None else load_rules()
+        self.batch_size = batch_size
+        self.interval = interval
+        self._pending: deque = deque(maxlen=max_pending)
+        self._cond = threading.Condition()
+        self._last: Dict[int, Tuple[float, Any]] = {}  # patient -> (time, values row)
+        self._raised: Dict[Tuple[int, str], float] = {}
+        self._thread = None
+        self._running = False
+        self._latencies: deque = deque(maxlen=1000)
+        self.stats = {"readings": 0, "batches": 0, "alerts": 0, "suppressed": 0, "skipped_old": 0,
+                      "overflow": 0, "failed": 0}
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="emergency-detector", daemon=True)
+            self._thread.start()
+
+    # Evaluate what is already queued, then stop
+    def stop(self, timeout: float = 10.0):
+        with self._cond:
+            if not self._running:
+                return
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+    # changes.subscribe() listener
+    def apply(self, batch: List[Dict[str, Any]]):
+        now = time.monotonic()
+        items = []
+        for c in batch:
+            vitals = c.get("vitals")
+            if c["kind"] == "log" and c["action"] == "add" and vitals and vitals.get("measured_at"):
+                items.append((c["patient_id"], _epoch(reading_time(c)), vitals, now))
+        if not items:
+            return
+        self.start()
+        with self._cond:
+            overflow = len(self._pending) + len(items) - self._pending.maxlen
+            if overflow > 0:
+                self.stats["overflow"] += overflow
+                log.warning("emergency detector is behind, dropped %d readings", overflow)
+            self._pending.extend(items)
+            self._cond.notify()
+
+    def _take(self) -> Optional[List]:
+        with self._cond:
+            while self._running and not self._pending:
+                self._cond.wait()
+            if not self._pending:
+                return None
+            # let a micro-batch build up
+            if self._running and len(self._pending) < self.batch_size:
+                self._cond.wait(self.interval)
+            return [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+
+    def _run(self):
+        while True:
+            items = self._take()
+            if items is None:
+                return
+            try:
+                self._evaluate(Batch(items))
+            except Exception:
+                self.stats["failed"] += 1
+                log.exception("emergency detection failed")
+
+    # Rule hits for one batch -> [(row, rule, value, previous value)]
+    def _hits(self, b: Batch) -> List[Tuple[int, Dict[str, Any], float, Optional[float]]]:
+        import numpy as np
+
+        n = len(b.patient_ids)
+        # previous reading of the same patient: the row before within the batch,
+        # or the last reading seen in an earlier batch
+        same = np.zeros(n, dtype=bool)
+        same[1:] = b.patient_ids[1:] == b.patient_ids[:-1]
+        prev_values = np.full_like(b.values, np.nan)
+        prev_times = np.full(n, np.nan)
+        prev_values[1:][same[1:]] = b.values[:-1][same[1:]]
+        prev_times[1:][same[1:]] = b.times[:-1][same[1:]]
+        for i in np.flatnonzero(~same):
+            last = self._last.get(int(b.patient_ids[i]))
+            if last is not None:
+                prev_times[i], prev_values[i] = last
+        ends = np.flatnonzero(np.append(b.patient_ids[1:] != b.patient_ids[:-1], True))
+        for i in ends:
+            self._last[int(b.patient_ids[i])] = (b.times[i], b.values[i].copy())
+
+        fresh = b.times >= time.time() - MAX_AGE_MINUTES * 60
+        self.stats["skipped_old"] += int((~fresh).sum())
+        hits = []
+        with np.errstate(invalid="ignore"):
+            for rule in self.rules:
+                m = METRICS.index(rule["metric"])
+                v, pv = b.values[:, m], prev_values[:, m]
+                if "above" in rule:
+                    mask = v > rule["above"]
+                elif "below" in rule:
+                    mask = v < rule["below"]
+                else:
+                    recent = (b.times - prev_times) <= rule.get("within_minutes", 10) * 60
+                    delta = v - pv if "rise" in rule else pv - v
+                    mask = recent & (delta >= rule.get("rise", rule.get("fall")))
+                for i in np.flatnonzero(mask & fresh):
+                    hits.append((int(i), rule, float(v[i]), None if np.isnan(pv[i]) else float(pv[i])))
+        return hits
+
+    def _evaluate(self, b: Batch):
+        self.stats["batches"] += 1
+        self.stats["readings"] += len(b.patient_ids)
+        alerts = []
+        for i, rule, value, prev in self._hits(b):
+            pid, t = int(b.patient_ids[i]), float(b.times[i])
+            key = (pid, rule["name"])
+            if key in self._raised and t - self._raised[key] < DEDUPE_MINUTES * 60:
+                self.stats["suppressed"] += 1
+                continue
+            self._raised[key] = t
+            alerts.append({"patient_id": pid, "event": describe(rule, value, prev), "rule": rule["name"],
+                           "enqueued": float(b.enqueued[i])})
+        if len(self._raised) > 100000:
+            cutoff = time.time() - DEDUPE_MINUTES * 60
+            self._raised = {k: t for k, t in self._raised.items() if t >= cutoff}
+        if not alerts:
+            return
+        fut = self.submit(lambda db: raise_events(db, alerts), urgent=True)
+        fut.add_done_callback(lambda f: self._committed(f, alerts))
+
+    def _committed(self, fut, alerts: List[Dict[str, Any]]):
+        if fut.exception() is not None:
+            self.stats["failed"] += 1
+            log.error("could not record emergency events: %s", fut.exception())
+            return
+        done = time.monotonic()
+        self.stats["alerts"] += fut.result()
+        self._latencies.extend(done - a["enqueued"] for a in alerts)
+
+    # Reading committed -> emergency event committed, over the last 1000 alerts
+    def latency(self) -> Dict[str, Any]:
+        import numpy as np
+
+        lat = np.array(self._latencies)
+        if not len(lat):
+            return {"count": 0}
+        p50, p95, p99 = np.percentile(lat, [50, 95, 99]) * 1000
+        return {"count": len(lat), "p50_ms": round(p50, 2), "p95_ms": round(p95, 2), "p99_ms": round(p99, 2),
+                "max_ms": round(float(lat.max()) * 1000, 2)}
+
+
+def describe(rule: Dict[str, Any], value: float, prev: Optional[float]) -> str:
+    m = rule["metric"]
+    unit = UNITS[m]
+    shown = f"{value:g} {unit}"
+    if prev is not None and ("rise" in rule or "fall" in rule):
+        shown = f"{prev:g} → {value:g} {unit}"
+    return f"{rule['name']} ({m} {shown})"
+
+
+# Write op: one EmergencyEvent (status 處理中) per alert, skipping any already
+# raised for the same patient and rule within the dedupe window (covers restarts)
+def raise_events(db: Session, alerts: List[Dict[str, Any]]) -> int:
+    since = datetime.datetime.now() - datetime.timedelta(minutes=DEDUPE_MINUTES)
+    pids = {a["patient_id"] for a in alerts}
+    recent = set(db.execute(
+        select(EmergencyEvent.patient_id, EmergencyEvent.event)
+        .where(EmergencyEvent.patient_id.in_(pids), EmergencyEvent.time >= since)
+    ).all())
+    recent_rules = {(pid, event.split(" (")[0]) for pid, event in recent}
+    names = dict(db.execute(select(Patient.id, Patient.name).where(Patient.id.in_(pids))).all())
+    created = 0
+    for a in alerts:
+        if (a["patient_id"], a["rule"]) in recent_rules:
+            continue
+        ev = EmergencyEvent(event=a["event"], status="處理中", patient_id=a["patient_id"])
+        db.add(ev)
+        db.flush()
+        changes.record(db, "emergency", "add", a["patient_id"], patient=names.get(a["patient_id"]), id=ev.id,
+                       event=ev.event, status=ev.status, time=ev.time, source="detector")
+        created += 1
+    return created
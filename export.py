@@ -0,0 +1,199 @@
+# export.py
+import argparse
+import csv
+import datetime
+import gzip
+import io
+import os
+import sys
+import zlib
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence
+
+import orjson
+from sqlalchemy import select
+
+from database import AsyncSessionLocal, SessionLocal
+from models import History, Log, Patient, Vital
+from vitals import parse_vitals
+
+# Full-dataset exports. Rows come off a server-side cursor in chunks of
+# EXPORT_CHUNK (yield_per) and are encoded chunk by chunk, so memory stays
+# flat however many rows are exported.
+EXPORT_CHUNK = int(os.environ.get("MEDICALWEB_EXPORT_CHUNK", "2000"))
+
+DATASETS = ("logs", "history")
+FORMATS = {
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    # gzip of one schema line, then one JSON line of column arrays per chunk
+    "columnar": ("application/gzip", "columns.json.gz"),
+}
+
+
+def export_stmt(dataset: str, patients: Sequence[str] = (), since: Optional[datetime.date] = None,
+                until: Optional[datetime.date] = None):
+    if dataset == "logs":
+        ts = Log.timestamp
+        stmt = (
+            select(Log.id, Patient.name.label("patient"), Log.timestamp, Log.content,
+                   Vital.heart_rate, Vital.bp_systolic, Vital.bp_diastolic, Vital.temperature)
+            .join(Patient, Log.patient_id == Patient.id)
+            .outerjoin(Vital, Vital.log_id == Log.id)
+            .order_by(Log.id)
+        )
+    elif dataset == "history":
+        ts = History.created_at
+        stmt = (
+            select(History.id, Patient.name.label("patient"), History.created_at, History.content)
+            .join(Patient, History.patient_id == Patient.id)
+            .order_by(History.id)
+        )
+    else:
+        raise ValueError(f"unknown dataset {dataset!r}")
+    if patients:
+        stmt = stmt.where(Patient.name.in_(list(patients)))
+    if since:
+        stmt = stmt.where(ts >= datetime.datetime.combine(since, datetime.time()))
+    if until:
+        # until is inclusive
+        stmt = stmt.where(ts < datetime.datetime.combine(until, datetime.time()) + datetime.timedelta(days=1))
+    return stmt.execution_options(yield_per=EXPORT_CHUNK)
+
+
+# Log rows whose reading was archived by tiers.py have no vitals row left;
+# their readings are parsed from the text, as they were when first stored
+def fill_vitals(rows: Sequence[Sequence[Any]]) -> List[Sequence[Any]]:
+    out = []
+    for row in rows:
+        if all(v is None for v in row[4:]):
+            values = parse_vitals(row[3])
+            if values:
+                row = (*row[:4], *(values.get(m) for m in ("heart_rate", "bp_systolic", "bp_diastolic", "temperature")))
+        out.append(row)
+    return out
+
+
+# Encoders: feed() takes one chunk of row tuples and returns the bytes to send
+class CsvEncoder:
+    def __init__(self, columns: List[str]):
+        self.columns = columns
+        self._buf = io.StringIO()
+        self._writer = csv.writer(self._buf)
+
+    def start(self) -> bytes:
+        self._writer.writerow(self.columns)
+        return self._take()
+
+    def feed(self, rows: Iterable[Sequence[Any]]) -> bytes:
+        self._writer.writerows(rows)
+        return self._take()
+
+    def finish(self) -> bytes:
+        return b""
+
+    def _take(self) -> bytes:
+        data = self._buf.getvalue().encode("utf-8")
+        self._buf.seek(0)
+        self._buf.truncate()
+        return data
+
+
+class NdjsonEncoder:
+    def __init__(self, columns: List[str]):
+        self.columns = columns
+
+    def start(self) -> bytes:
+        return b""
+
+    def feed(self, rows: Iterable[Sequence[Any]]) -> bytes:
+        return b"".join(orjson.dumps(dict(zip(self.columns, row))) + b"\n" for row in rows)
+
+    def finish(self) -> bytes:
+        return b""
+
+
+class ColumnarEncoder:
+    def __init__(self, columns: List[str], dataset: str = ""):
+        self.columns = columns
+        self.dataset = dataset
+        self._gz = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    def start(self) -> bytes:
+        return self._gz.compress(orjson.dumps({"dataset": self.dataset, "columns": self.columns}) + b"\n")
+
+    def feed(self, rows: Iterable[Sequence[Any]]) -> bytes:
+        rows = list(rows)
+        block = {"rows": len(rows), "data": {c: [r[i] for r in rows] for i, c in enumerate(self.columns)}}
+        return self._gz.compress(orjson.dumps(block) + b"\n")
+
+    def finish(self) -> bytes:
+        return self._gz.flush()
+
+
+def make_encoder(fmt: str, columns: List[str], dataset: str):
+    if fmt == "csv":
+        return CsvEncoder(columns)
+    if fmt == "ndjson":
+        return NdjsonEncoder(columns)
+    if fmt == "columnar":
+        return ColumnarEncoder(columns, dataset)
+    raise ValueError(f"unknown format {fmt!r}")
+
+
+# Response body for the export endpoint (own session: it outlives the handler)
+async def stream_export(dataset: str, fmt: str, patients: Sequence[str] = (),
+                        since: Optional[datetime.date] = None, until: Optional[datetime.date] = None):
+    stmt = export_stmt(dataset, patients, since, until)
+    async with AsyncSessionLocal() as db:
+        result = await db.stream(stmt)
+        encoder = make_encoder(fmt, list(result.keys()), dataset)
+        yield encoder.start()
+        async for chunk in result.partitions():
+            data = encoder.feed(fill_vitals(chunk) if dataset == "logs" else chunk)
+            if data:
+                yield data
+        yield encoder.finish()
+
+
+def export_to(out, dataset: str, fmt: str, patients: Sequence[str] = (),
+              since: Optional[datetime.date] = None, until: Optional[datetime.date] = None) -> int:
+    stmt = export_stmt(dataset, patients, since, until)
+    count = 0
+    db = SessionLocal()
+    try:
+        result = db.execute(stmt)
+        encoder = make_encoder(fmt, list(result.keys()), dataset)
+        out.write(encoder.start())
+        for chunk in result.partitions():
+            out.write(encoder.feed(fill_vitals(chunk) if dataset == "logs" else chunk))
+            count += len(chunk)
+        out.write(encoder.finish())
+    finally:
+        db.close()
+    return count
+
+
+# Read a columnar export back as {"dataset", "columns", "data": {column: [...]}} blocks
+def iter_columnar(fileobj) -> Iterator[Dict[str, Any]]:
+    with gzip.open(fileobj, "rb") as f:
+        header = orjson.loads(f.readline())
+        for line in f:
+            block = orjson.loads(line)
+            yield {**header, **block}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export logs or histories")
+    parser.add_argument("dataset", choices=DATASETS)
+    parser.add_argument("--format", choices=list(FORMATS), default="csv")
+    parser.add_argument("--patient", action="append", default=[], help="repeat for several patients")
+    parser.add_argument("--since", type=datetime.date.fromisoformat)
+    parser.add_argument("--until", type=datetime.date.fromisoformat, help="inclusive")
+    parser.add_argument("-o", "--output", help="file to write (default stdout)")
+    args = parser.parse_args()
+    if args.output:
+        with open(args.output, "wb") as f:
+            n = export_to(f, args.dataset, args.format, args.patient, args.since, args.until)
+        print(f"exported {n} {args.dataset} rows to {args.output}", file=sys.stderr)
+    else:
+        export_to(sys.stdout.buffer, args.dataset, args.format, args.patient, args.since, args.until)
@@ -0,0 +1,28 @@
+# gunicorn.conf.py
+# Multi-process serving: gunicorn -c gunicorn.conf.py MedicalWeb:app
+#
+# Run `python migrations.py upgrade` (and `python seed.py` for sample data)
+# before starting; workers only check the schema version. Workers share
+# logins, modules and cache invalidation through the database (see bus.py),
+# and sessions through the signed cookie (MEDICALWEB_SECRET_KEY).
+import multiprocessing
+import os
+
+bind = os.environ.get("MEDICALWEB_BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("MEDICALWEB_WORKERS", str(multiprocessing.cpu_count())))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# SSE connections are long-lived; the worker timeout only covers a stuck event loop
+timeout = int(os.environ.get("MEDICALWEB_WORKER_TIMEOUT", "60"))
+graceful_timeout = int(os.environ.get("MEDICALWEB_GRACEFUL_TIMEOUT", "10"))
+keepalive = 5
+
+# Each worker opens its own engines, writer and bus threads after the fork
+preload_app = False
+
+# Recycle workers now and then so memory growth can't build up; jitter keeps
+# them from restarting together
+max_requests = int(os.environ.get("MEDICALWEB_MAX_REQUESTS", "0"))
+max_requests_jitter = max_requests // 10
+
+accesslog = os.environ.get("MEDICALWEB_ACCESS_LOG")  # "-" for stdout
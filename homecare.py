@@ -0,0 +1,112 @@
+# homecare.py
+import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import func, select, tuple_, update
+from sqlalchemy.orm import Session
+
+import changes
+from models import HOMECARE_STATUSES, HomecareRequest, Patient
+from paging import decode_cursor, encode_cursor
+
+# Doctor-side homecare queue. Listing is one status at a time, keyset paged on
+# (requested_at, id) through ix_homecare_status_requested, so a page costs the
+# same with 100 or 100k historical requests. Pending is worked oldest first,
+# the other statuses read newest first.
+#
+# Status changes are batched: one UPDATE ... WHERE (id, version) IN (...) per
+# batch. Each request carries a version that every change bumps, and the
+# client sends back the version it saw, so when two doctors act on the same
+# request only the first one lands; the second gets it back as a conflict
+# with the current status.
+
+QUEUE_PAGE_SIZE = 50
+MAX_BATCH = 1000  # requests per transition call (three bound values each)
+
+# target status -> statuses it can be reached from
+TRANSITIONS = {
+    "approved": ("pending",),
+    "rejected": ("pending",),
+    "completed": ("approved",),
+    "cancelled": ("pending", "approved"),
+}
+
+
+def _oldest_first(status: str) -> bool:
+    return status == "pending"
+
+
+# One page of requests in `status` after the cursor, as plain dicts
+# (+ cursor of the next page, None on the last one)
+def queue_page(db: Session, status: str, after: Optional[str] = None,
+               limit: int = QUEUE_PAGE_SIZE) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    key = tuple_(HomecareRequest.requested_at, HomecareRequest.id)
+    stmt = (
+        select(HomecareRequest.id, Patient.name, HomecareRequest.reason, HomecareRequest.status,
+               HomecareRequest.requested_at, HomecareRequest.version, HomecareRequest.reviewed_by,
+               HomecareRequest.reviewed_at, HomecareRequest.note)
+        .join(Patient, Patient.id == HomecareRequest.patient_id)
+        .where(HomecareRequest.status == status)
+    )
+    if _oldest_first(status):
+        if after:
+            stmt = stmt.where(key > tuple_(*decode_cursor(after)))
+        stmt = stmt.order_by(HomecareRequest.requested_at, HomecareRequest.id)
+    else:
+        if after:
+            stmt = stmt.where(key < tuple_(*decode_cursor(after)))
+        stmt = stmt.order_by(HomecareRequest.requested_at.desc(), HomecareRequest.id.desc())
+    rows = [dict(r._mapping) for r in db.execute(stmt.limit(limit + 1)).all()]
+    cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        cursor = encode_cursor(rows[-1]["requested_at"], rows[-1]["id"])
+    return rows, cursor
+
+
+# status -> number of requests, every status present (index-only count)
+def status_counts(db: Session) -> Dict[str, int]:
+    counts = dict.fromkeys(HOMECARE_STATUSES, 0)
+    counts.update(db.execute(select(HomecareRequest.status, func.count()).group_by(HomecareRequest.status)).all())
+    return counts
+
+
+# Move the given requests to `status` if they are still at the version the
+# caller saw and in a status the transition allows. items: [(id, version)].
+# Returns {"updated": [...], "conflicts": [...], "missing": [ids]}; updated and
+# conflicts entries are {"id", "status", "version"} as now stored.
+# Called from a write op; the writer commits.
+def transition(db: Session, items: List[Tuple[int, int]], status: str, doctor: str,
+               note: Optional[str] = None) -> Dict[str, Any]:
+    if status not in TRANSITIONS:
+        raise ValueError(f"cannot move requests to {status!r}, expected one of {list(TRANSITIONS)}")
+    result: Dict[str, Any] = {"updated": [], "conflicts": [], "missing": []}
+    if not items:
+        return result
+    table = HomecareRequest.__table__
+    now = datetime.datetime.now()
+    stmt = (
+        update(table)
+        # plain id list first: SQLite seeks row values by primary key only through it
+        .where(table.c.id.in_([i for i, _ in items]))
+        .where(tuple_(table.c.id, table.c.version).in_(items))
+        .where(table.c.status.in_(TRANSITIONS[status]))
+        .values(status=status, version=table.c.version + 1, reviewed_by=doctor, reviewed_at=now, note=note)
+        .returning(table.c.id, table.c.patient_id, table.c.version)
+    )
+    updated = db.execute(stmt).all()
+    for i, patient_id, version in updated:
+        result["updated"].append({"id": i, "status": status, "version": version})
+        changes.record(db, "homecare", "status", patient_id, id=i, status=status, version=version,
+                       reviewed_by=doctor, reviewed_at=now)
+    done = {i for i, _, _ in updated}
+    rest = [i for i, _ in items if i not in done]
+    if rest:
+        current = {i: (s, v) for i, s, v in db.execute(
+            select(table.c.id, table.c.status, table.c.version).where(table.c.id.in_(rest))).all()}
+        for i in rest:
+            if i in current:
+                result["conflicts"].append({"id": i, "status": current[i][0], "version": current[i][1]})
+            else:
+                result["missing"].append(i)
+    return result
@@ -0,0 +1,452 @@
+# inference.py
+import argparse
+import asyncio
+import concurrent.futures
+import datetime
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import orjson
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+import metrics
+from models import MonitoringModel, PatientModule, Vital
+
+# Execution of the patient "modules" (monitoring models). A model is a
+# safetensors file registered by module name in monitoring_models; a patient
+# runs the models named in their patient_modules rows.
+#
+# Requests are queued and picked up by a small pool of worker threads, which
+# micro-batch everything waiting (up to INFERENCE_BATCH) into one query for
+# the patients' recent vitals and one CPU forward pass per model. The event
+# loop only checks the result cache and awaits a future. Results are cached
+# per (patient, model revision, patient data version), so a page view after
+# no new readings costs nothing.
+#
+# torch is imported by the worker on first use, never at app startup. Weights
+# are tensors over a copy-on-write mapping of the safetensors file (no pickle,
+# no copy into the process): every worker loading the same file shares its
+# page-cache pages. Mapped once per registry revision.
+#
+# Model file: Linear layers "layers.{i}.weight" / "layers.{i}.bias" with ReLU
+# between them and a sigmoid on the output, plus metadata
+#   window    readings per patient fed to the model (newest last)
+#   features  comma list of vitals columns
+#   mean, std comma lists, to normalize each feature
+#   outputs   comma list of output names
+# Input per patient: normalized readings (missing = 0) followed by the 0/1
+# mask of which readings were present, flattened to window * features * 2.
+#
+#   python inference.py demo                       write + register the demo heart model
+#   python inference.py register NAME FILE
+#   python inference.py run NAME                   whole population, batched
+MODEL_DIR = os.environ.get("MEDICALWEB_MODEL_DIR", "weights")
+INFERENCE_BATCH = int(os.environ.get("MEDICALWEB_INFERENCE_BATCH", "256"))
+INFERENCE_WAIT_MS = float(os.environ.get("MEDICALWEB_INFERENCE_WAIT_MS", "5"))
+INFERENCE_WORKERS = int(os.environ.get("MEDICALWEB_INFERENCE_WORKERS", "1"))
+TORCH_THREADS = int(os.environ.get("MEDICALWEB_TORCH_THREADS", "0"))  # 0 = torch's default
+INFERENCE_CACHE_ENTRIES = int(os.environ.get("MEDICALWEB_INFERENCE_CACHE", "20000"))
+POPULATION_CHUNK = 4096  # patients per window query in run_population
+
+log = logging.getLogger(__name__)
+
+
+class ModelError(Exception):
+    pass
+
+
+def _floats(text: str) -> List[float]:
+    return [float(x) for x in text.split(",")]
+
+
+# safetensors dtype -> torch dtype
+_DTYPES = {"F64": "float64", "F32": "float32", "F16": "float16", "BF16": "bfloat16"}
+
+
+# (metadata, {name: tensor}, mapping) of a safetensors file: an 8-byte header
+# size, a JSON header of dtype / shape / data_offsets per tensor, then the
+# data. The tensors are views into the mapping, which they keep alive; it is
+# private (ACCESS_COPY) so torch gets a writable buffer, but pages are only
+# copied if written, and inference never writes them.
+def map_tensors(path: str):
+    import torch
+
+    with open(path, "rb") as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        except ValueError as e:  # empty file
+            raise ModelError(f"{path}: {e}")
+    try:
+        (size,) = struct.unpack("<Q", buf[:8])
+        header = orjson.loads(buf[8:8 + size])
+    except (struct.error, orjson.JSONDecodeError) as e:
+        raise ModelError(f"{path}: not a safetensors file ({e})")
+    meta = header.pop("__metadata__", None) or {}
+    tensors = {}
+    for name, info in header.items():
+        if info.get("dtype") not in _DTYPES:
+            raise ModelError(f"{path}: {name} has unsupported dtype {info.get('dtype')}")
+        dtype = getattr(torch, _DTYPES[info["dtype"]])
+        try:
+            start, end = info["data_offsets"]
+            if 8 + size + end > len(buf):
+                raise ModelError(f"{path}: {name} runs past the end of the file")
+            if end > start:
+                t = torch.frombuffer(buf, dtype=dtype, count=(end - start) // dtype.itemsize, offset=8 + size + start)
+            else:
+                t = torch.empty(0, dtype=dtype)
+            tensors[name] = t.reshape(info["shape"])
+        except (KeyError, TypeError, ValueError, RuntimeError) as e:
+            raise ModelError(f"{path}: bad entry for {name} ({e})")
+    return meta, tensors, buf
+
+
+class LoadedModel:
+    def __init__(self, name: str, path: str):
+        import numpy as np
+        import torch
+
+        if TORCH_THREADS:
+            torch.set_num_threads(TORCH_THREADS)
+        meta, tensors, self._mapping = map_tensors(path)
+        try:
+            self.window = int(meta["window"])
+            self.features = meta["features"].split(",")
+            self.outputs = meta["outputs"].split(",")
+            self.mean = np.array(_floats(meta["mean"]), dtype=np.float32)
+            self.std = np.array(_floats(meta["std"]), dtype=np.float32)
+        except (KeyError, ValueError) as e:
+            raise ModelError(f"{path}: bad or missing metadata ({e})")
+        self.layers = []
+        while f"layers.{len(self.layers)}.weight" in tensors:
+            i = len(self.layers)
+            self.layers.append((tensors[f"layers.{i}.weight"], tensors[f"layers.{i}.bias"]))
+        if not self.layers or self.layers[0][0].shape[1] != self.window * len(self.features) * 2:
+            raise ModelError(f"{path}: first layer does not take window * features * 2 inputs")
+        if self.layers[-1][0].shape[0] != len(self.outputs):
+            raise ModelError(f"{path}: last layer does not match the outputs")
+        self.name = name
+        self.path = path
+
+    # (B, window, features) readings with NaN gaps -> (B, inputs) float32
+    def inputs(self, windows):
+        import numpy as np
+
+        present = ~np.isnan(windows)
+        z = np.where(present, (windows - self.mean) / self.std, 0.0)
+        return np.concatenate([z, present], axis=-1).reshape(len(windows), -1).astype(np.float32)
+
+    def forward(self, x):
+        import torch
+
+        with torch.inference_mode():
+            h = torch.from_numpy(x)
+            for i, (w, b) in enumerate(self.layers):
+                h = torch.nn.functional.linear(h, w, b)
+                if i < len(self.layers) - 1:
+                    h = torch.relu(h)
+            return torch.sigmoid(h).numpy()
+
+    def results(self, out) -> List[Dict[str, float]]:
+        return [{name: round(float(v), 4) for name, v in zip(self.outputs, row)} for row in out]
+
+
+# Last `window` readings of each patient as a (len(patient_ids), window, features)
+# array, oldest first; patients with fewer readings are NaN-padded at the front
+def load_windows(db: Session, patient_ids: List[int], window: int, features: List[str]):
+    import numpy as np
+
+    out = np.full((len(patient_ids), window, len(features)), np.nan, dtype=np.float32)
+    if not patient_ids:
+        return out
+    rn = func.row_number().over(partition_by=Vital.patient_id,
+                                order_by=(Vital.measured_at.desc(), Vital.log_id.desc())).label("rn")
+    inner = (select(Vital.patient_id, *[getattr(Vital, f) for f in features], rn)
+             .where(Vital.patient_id.in_(patient_ids)).subquery())
+    rows = db.execute(select(inner).where(inner.c.rn <= window)).all()
+    index = {pid: i for i, pid in enumerate(patient_ids)}
+    for r in rows:
+        out[index[r[0]], window - r[-1]] = [np.nan if v is None else v for v in r[1:-1]]
+    return out
+
+
+def registered(db: Session, names: Optional[Iterable[str]] = None) -> Dict[str, MonitoringModel]:
+    stmt = select(MonitoringModel)
+    if names is not None:
+        stmt = stmt.where(MonitoringModel.name.in_(list(names)))
+    return {m.name: m for m in db.scalars(stmt).all()}
+
+
+def revision(m: MonitoringModel) -> Tuple[str, str]:
+    return (m.path, m.updated_at.isoformat() if m.updated_at else "")
+
+
+class InferenceService:
+    def __init__(self, session_factory, version_of: Optional[Callable[[int], Any]] = None,
+                 batch_size: int = INFERENCE_BATCH, wait_ms: float = INFERENCE_WAIT_MS,
+                 workers: int = INFERENCE_WORKERS, cache_entries: int = INFERENCE_CACHE_ENTRIES):
+        self.session_factory = session_factory
+        self.version_of = version_of or (lambda pid: None)
+        self.batch_size = batch_size
+        self.wait = wait_ms / 1000
+        self.workers = workers
+        self.cache_entries = cache_entries
+        self._queue: deque = deque()
+        self._cond = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._running = False
+        self._models: Dict[str, Tuple[Tuple[str, str], LoadedModel]] = {}
+        self._model_lock = threading.Lock()
+        self._cache: "OrderedDict[Tuple, Dict[str, float]]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.stats = {"requests": 0, "cache_hits": 0, "batches": 0, "rows": 0, "model_loads": 0, "failed": 0}
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            self._threads = [threading.Thread(target=self._run, name=f"inference-{i}", daemon=True)
+                             for i in range(self.workers)]
+            for t in self._threads:
+                t.start()
+
+    # Finish what is queued, then stop
+    def stop(self, timeout: float = 10.0):
+        with self._cond:
+            if not self._running:
+                return
+            self._running = False
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    # ---------- worker side ----------
+
+    # Loaded model for the registry row, or None when its file cannot be used
+    # (not retried until the row changes)
+    def _model(self, m: MonitoringModel) -> Optional[LoadedModel]:
+        rev = revision(m)
+        with self._model_lock:
+            cached = self._models.get(m.name)
+            if cached is not None and cached[0] == rev:
+                return cached[1]
+        try:
+            model = LoadedModel(m.name, m.path)  # outside the lock: another model may be loading
+        except (ModelError, ImportError, OSError):
+            log.exception("cannot load model %r from %s", m.name, m.path)
+            model = None
+        with self._model_lock:
+            self._models[m.name] = (rev, model)
+        if model is None:
+            return None
+        self.stats["model_loads"] += 1
+        log.info("loaded model %r from %s", m.name, m.path)
+        return model
+
+    def _take(self) -> List[Tuple]:
+        with self._cond:
+            while self._running and not self._queue:
+                self._cond.wait()
+            if not self._queue:
+                return []
+        time.sleep(self.wait)  # let concurrent requests join the batch
+        with self._cond:
+            n = min(len(self._queue), self.batch_size)
+            return [self._queue.popleft() for _ in range(n)]
+
+    def _run(self):
+        while True:
+            items = self._take()
+            if not items:
+                return
+            try:
+                self._batch(items)
+            except Exception as e:
+                self.stats["failed"] += 1
+                log.exception("inference batch failed")
+                for *_, fut in items:
+                    if not fut.done():
+                        fut.set_exception(e)
+
+    @metrics.timed("inference_batch")
+    def _batch(self, items: List[Tuple]):
+        # items: (model name, patient id, data version, future)
+        by_model: Dict[str, List[Tuple]] = {}
+        for item in items:
+            by_model.setdefault(item[0], []).append(item)
+        db: Session = self.session_factory()
+        try:
+            rows = registered(db, by_model)
+            for name, group in by_model.items():
+                m = rows.get(name)
+                model = self._model(m) if m is not None else None
+                if model is None:
+                    for *_, fut in group:
+                        fut.set_result(None)
+                    continue
+                pids = sorted({pid for _, pid, _, _ in group})
+                windows = load_windows(db, pids, model.window, model.features)
+                results = dict(zip(pids, model.results(model.forward(model.inputs(windows)))))
+                db.rollback()  # end the read transaction before the next model
+                rev = revision(m)
+                with self._cache_lock:
+                    for _, pid, version, fut in group:
+                        self._cache[(pid, name, rev, version)] = results[pid]
+                    while len(self._cache) > self.cache_entries:
+                        self._cache.popitem(last=False)
+                for _, pid, _, fut in group:
+                    fut.set_result(results[pid])
+                self.stats["batches"] += 1
+                self.stats["rows"] += len(pids)
+        finally:
+            db.close()
+
+    # ---------- request side ----------
+
+    def submit(self, name: str, patient_id: int, version) -> concurrent.futures.Future:
+        fut: concurrent.futures.Future = concurrent.futures.Future()
+        self.start()
+        with self._cond:
+            self._queue.append((name, patient_id, version, fut))
+            self._cond.notify()
+        return fut
+
+    # {(patient id, module name): outputs | None (no registered model)}.
+    # revisions: module name -> revision() of its registry row.
+    async def predict(self, wanted: Dict[int, List[str]], revisions: Dict[str, Tuple[str, str]]
+                      ) -> Dict[Tuple[int, str], Optional[Dict[str, float]]]:
+        results: Dict[Tuple[int, str], Optional[Dict[str, float]]] = {}
+        pending = []
+        with self._cache_lock:
+            for pid, names in wanted.items():
+                version = self.version_of(pid)
+                for name in names:
+                    self.stats["requests"] += 1
+                    rev = revisions.get(name)
+                    if rev is None:
+                        results[(pid, name)] = None
+                        continue
+                    hit = self._cache.get((pid, name, rev, version))
+                    if hit is not None:
+                        self._cache.move_to_end((pid, name, rev, version))
+                        self.stats["cache_hits"] += 1
+                        results[(pid, name)] = hit
+                    else:
+                        pending.append((pid, name, version))
+        futures = [self.submit(name, pid, version) for pid, name, version in pending]
+        done = await asyncio.gather(*(asyncio.wrap_future(f) for f in futures))
+        for (pid, name, _), r in zip(pending, done):
+            results[(pid, name)] = r
+        return results
+
+    def clear(self):
+        with self._cache_lock:
+            self._cache.clear()
+
+
+# Every patient with the module, in large batches, outside the web app
+def run_population(db: Session, name: str, chunk: int = POPULATION_CHUNK) -> Dict[int, Dict[str, float]]:
+    m = registered(db, [name]).get(name)
+    if m is None:
+        raise ModelError(f"no model registered for {name!r}")
+    model = LoadedModel(m.name, m.path)
+    pids = db.scalars(select(PatientModule.patient_id).where(PatientModule.name == name)
+                      .distinct().order_by(PatientModule.patient_id)).all()
+    results: Dict[int, Dict[str, float]] = {}
+    for i in range(0, len(pids), chunk):
+        part = list(pids[i:i + chunk])
+        windows = load_windows(db, part, model.window, model.features)
+        results.update(zip(part, model.results(model.forward(model.inputs(windows)))))
+    return results
+
+
+def register(db: Session, name: str, path: str) -> MonitoringModel:
+    model = LoadedModel(name, path)  # refuse files the service could not run
+    row = db.scalar(select(MonitoringModel).where(MonitoringModel.name == name))
+    if row is None:
+        row = MonitoringModel(name=name)
+        db.add(row)
+    row.path = os.path.abspath(path)
+    row.window = model.window
+    row.outputs = ",".join(model.outputs)
+    row.updated_at = datetime.datetime.now()
+    return row
+
+
+# Demo weights for "Heart Monitoring Model": each risk is a sigmoid of how far
+# the window's average reading sits above a threshold (hand-set, not trained)
+def write_demo(path: str, window: int = 32):
+    import torch
+    from safetensors.torch import save_file
+
+    features = ["heart_rate", "bp_systolic", "bp_diastolic", "temperature"]
+    mean, std = [75.0, 120.0, 80.0, 36.8], [12.0, 15.0, 10.0, 0.5]
+    # threshold (normalized units above mean) per risk, from feature i
+    risks = [("tachycardia", 0, 25 / 12), ("hypertension", 1, 20 / 15), ("fever", 3, 1.2 / 0.5)]
+    f = len(features)
+    hidden = torch.zeros(f, window * f * 2)
+    for w in range(window):
+        for i in range(f):
+            hidden[i, w * f * 2 + i] = 1.0 / window  # normalized value columns come first per reading
+    # ReLU(avg) only keeps above-mean averages, which is all the risks need
+    out_w = torch.zeros(len(risks), f)
+    out_b = torch.zeros(len(risks))
+    for k, (_, i, threshold) in enumerate(risks):
+        out_w[k, i] = 4.0
+        out_b[k] = -4.0 * threshold
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    save_file({"layers.0.weight": hidden, "layers.0.bias": torch.zeros(f),
+               "layers.1.weight": out_w, "layers.1.bias": out_b},
+              path, metadata={"window": str(window), "features": ",".join(features),
+                              "mean": ",".join(map(str, mean)), "std": ",".join(map(str, std)),
+                              "outputs": ",".join(r[0] for r in risks)})
+
+
+if __name__ == "__main__":
+    from database import SessionLocal
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(description="Monitoring model registry and batch runs")
+    sub = parser.add_subparsers(dest="command", required=True)
+    d = sub.add_parser("demo", help='write and register demo weights for "Heart Monitoring Model"')
+    d.add_argument("--out", default=os.path.join(MODEL_DIR, "heart_monitoring.safetensors"))
+    r = sub.add_parser("register", help="register (or replace) the model file for a module name")
+    r.add_argument("name")
+    r.add_argument("path")
+    sub.add_parser("list", help="registered models")
+    p = sub.add_parser("run", help="run a model over every patient with the module")
+    p.add_argument("name")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        if args.command == "demo":
+            write_demo(args.out)
+            register(db, "Heart Monitoring Model", args.out)
+            db.commit()
+            print(f"registered Heart Monitoring Model -> {args.out}")
+        elif args.command == "register":
+            register(db, args.name, args.path)
+            db.commit()
+            print(f"registered {args.name} -> {args.path}")
+        elif args.command == "list":
+            for m in registered(db).values():
+                print(f"{m.name}: {m.path} (window {m.window}, outputs {m.outputs}, {m.updated_at:%Y-%m-%d %H:%M})")
+        else:
+            started = time.perf_counter()
+            results = run_population(db, args.name)
+            took = time.perf_counter() - started
+            print(f"{len(results)} patients in {took:.2f}s")
+            for pid, out in list(results.items())[:10]:
+                print(pid, out)
+    finally:
+        db.close()
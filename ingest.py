@@ -0,0 +1,143 @@
+# ingest.py
+import datetime
+import threading
+from typing import Any, Dict, Iterable, List, Optional
+
+import orjson
+from sqlalchemy import insert, select
+from sqlalchemy.orm import Session
+
+import changes
+from models import Log, Patient, Vital
+from vitals import parse_vitals, vital_row, vitals_of
+
+MAX_BATCH = 50000
+
+
+# name -> patient id, shared by every ingest request. Unknown names are looked
+# up with one IN query per batch and only found ids are remembered.
+class PatientIdCache:
+    def __init__(self):
+        self._ids: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, db: Session, names: Iterable[str]) -> Dict[str, int]:
+        wanted = set(names)
+        with self._lock:
+            found = {n: self._ids[n] for n in wanted if n in self._ids}
+        missing = wanted - found.keys()
+        if missing:
+            rows = db.execute(select(Patient.name, Patient.id).where(Patient.name.in_(missing))).all()
+            fresh = {name: pid for name, pid in rows}
+            with self._lock:
+                self._ids.update(fresh)
+            found.update(fresh)
+        return found
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+
+
+patient_ids = PatientIdCache()
+
+
+# Body is either a JSON array, {"readings": [...]}, or NDJSON (one reading per line)
+def parse_body(body: bytes, content_type: str) -> List[Any]:
+    if "ndjson" in content_type or "jsonl" in content_type:
+        return [orjson.loads(line) for line in body.splitlines() if line.strip()]
+    data = orjson.loads(body)
+    if isinstance(data, dict):
+        data = data.get("readings")
+    if not isinstance(data, list):
+        raise ValueError("expected a JSON array of readings")
+    return data
+
+
+def _parse_time(value) -> Optional[datetime.datetime]:
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return datetime.datetime.fromtimestamp(value)
+    t = datetime.datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    # the app stores naive local time (datetime.now()); convert offsets to it
+    return t.astimezone().replace(tzinfo=None) if t.tzinfo else t
+
+
+# Log line for a structured reading, in the same "<date>: <readings>" form doctors type
+def format_content(measured_at: datetime.datetime, r: Dict[str, Any]) -> str:
+    parts = []
+    if r.get("heart_rate") is not None:
+        parts.append(f"Heart rate {int(r['heart_rate'])}")
+    if r.get("bp_systolic") is not None and r.get("bp_diastolic") is not None:
+        parts.append(f"BP {int(r['bp_systolic'])}/{int(r['bp_diastolic'])}")
+    if r.get("temperature") is not None:
+        parts.append(f"Temp {float(r['temperature'])}")
+    return f"{measured_at:%Y-%m-%d %H:%M:%S}: " + ", ".join(parts)
+
+
+def _normalize(r: Any) -> Dict[str, Any]:
+    if not isinstance(r, dict):
+        raise ValueError("reading must be an object")
+    name = r.get("patient")
+    if not name or not isinstance(name, str):
+        raise ValueError("missing patient")
+    measured_at = _parse_time(r.get("measured_at")) or datetime.datetime.now()
+    fields = {k: r.get(k) for k in ("heart_rate", "bp_systolic", "bp_diastolic", "temperature")}
+    bp = r.get("bp")
+    if bp and fields["bp_systolic"] is None:
+        sys_, _, dia = str(bp).partition("/")
+        fields["bp_systolic"], fields["bp_diastolic"] = int(sys_), int(dia)
+    if (fields["bp_systolic"] is None) != (fields["bp_diastolic"] is None):
+        raise ValueError("bp_systolic and bp_diastolic must be sent together")
+    content = r.get("content")
+    if content:
+        content = str(content)
+        if not parse_vitals(content):
+            raise ValueError("no vitals found in content")
+    elif any(v is not None for v in fields.values()):
+        content = format_content(measured_at, fields)
+    else:
+        raise ValueError("reading has no content or vitals")
+    return {"patient": name, "content": content, "measured_at": measured_at}
+
+
+# Validate, resolve and insert a batch; the caller commits, so the whole batch
+# lands in one transaction. Returns one result per input row, in input order.
+def ingest_readings(db: Session, readings: List[Any]) -> List[Dict[str, Any]]:
+    results: List[Dict[str, Any]] = [None] * len(readings)
+    pending = []
+    for i, r in enumerate(readings):
+        try:
+            pending.append((i, _normalize(r)))
+        except (ValueError, TypeError, OverflowError, OSError) as e:
+            results[i] = {"index": i, "status": "rejected", "error": str(e)}
+
+    ids = patient_ids.resolve(db, {r["patient"] for _, r in pending})
+    rows, order = [], []
+    for i, r in pending:
+        pid = ids.get(r["patient"])
+        if pid is None:
+            results[i] = {"index": i, "status": "rejected", "error": "unknown patient"}
+            continue
+        rows.append({"content": r["content"], "timestamp": r["measured_at"], "patient_id": pid})
+        order.append(i)
+
+    if rows:
+        log_ids = db.scalars(
+            insert(Log.__table__).returning(Log.__table__.c.id, sort_by_parameter_order=True),
+            rows,
+        ).all()
+        names = {pid: name for name, pid in ids.items()}
+        vital_rows = []
+        for lid, row in zip(log_ids, rows):
+            v = vital_row(lid, row["patient_id"], row["content"], row["timestamp"])
+            if v:
+                vital_rows.append(v)
+            changes.record(db, "log", "add", row["patient_id"], patient=names[row["patient_id"]], id=lid,
+                           content=row["content"], timestamp=row["timestamp"], vitals=vitals_of(v))
+        if vital_rows:
+            db.execute(insert(Vital.__table__), vital_rows)
+        for i, lid in zip(order, log_ids):
+            results[i] = {"index": i, "status": "accepted", "log_id": lid}
+    return results
@@ -0,0 +1,369 @@
+# metrics.py
+import asyncio
+import contextvars
+import functools
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from typing import Any, Dict, Optional, Tuple
+
+import jinja2
+from sqlalchemy import event
+from sqlalchemy.orm import Mapper
+
+# Per-request instrumentation, exposed in Prometheus text format on /metrics:
+# latency, SQL statements and time (engine events), ORM objects loaded,
+# template render time, response size, and named phases (see timed()).
+# Numbers are per worker process; scrape every worker or label by instance.
+#
+# MEDICALWEB_PROFILE_SLOW_MS turns on a sampling profiler: while requests are
+# in flight every thread's stack is sampled, and a request slower than the
+# threshold gets its samples written to MEDICALWEB_PROFILE_DIR as folded
+# stacks (flamegraph.pl, speedscope). Requests share the event loop thread,
+# so a dump also shows whatever else ran during that request.
+METRICS_ENABLED = os.environ.get("MEDICALWEB_METRICS", "1") == "1"
+# If set, /metrics needs "Authorization: Bearer <token>". Without it only
+# doctor/manager sessions and clients on this host may read it; behind a
+# reverse proxy on the same host every client looks local, so set a token.
+METRICS_TOKEN = os.environ.get("MEDICALWEB_METRICS_TOKEN")
+LOCAL_HOSTS = ("127.0.0.1", "::1")
+PROFILE_SLOW_MS = float(os.environ.get("MEDICALWEB_PROFILE_SLOW_MS", "0"))  # 0 = profiler off
+PROFILE_INTERVAL_MS = float(os.environ.get("MEDICALWEB_PROFILE_INTERVAL_MS", "5"))
+PROFILE_DIR = os.environ.get("MEDICALWEB_PROFILE_DIR", "profiles")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+# name -> (type, help)
+METRICS = {
+    "medicalweb_requests_total": ("counter", "Requests by route, method and status"),
+    "medicalweb_request_duration_seconds": ("histogram", "Request latency, until the last body byte is sent"),
+    "medicalweb_request_sql_queries": ("histogram", "SQL statements executed per request"),
+    "medicalweb_request_sql_seconds_total": ("counter", "Time spent executing SQL on behalf of requests"),
+    "medicalweb_request_orm_objects_total": ("counter", "ORM objects loaded on behalf of requests"),
+    "medicalweb_request_render_seconds_total": ("counter", "Jinja2 template render time"),
+    "medicalweb_response_bytes": ("histogram", "Response body size"),
+    "medicalweb_phase_seconds_total": ("counter", "Time spent in named phases"),
+    "medicalweb_phase_calls_total": ("counter", "Calls of named phases"),
+    "medicalweb_background_sql_queries_total": ("counter", "SQL statements run outside requests, by thread"),
+    "medicalweb_background_sql_seconds_total": ("counter", "SQL time outside requests, by thread"),
+    "medicalweb_slow_request_profiles_total": ("counter", "Slow request profiles written"),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        self._histograms: Dict[Tuple[str, Labels], Histogram] = {}
+
+    def inc(self, name: str, labels: Labels, value: float = 1.0):
+        with self._lock:
+            key = (name, labels)
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def observe(self, name: str, labels: Labels, value: float, buckets):
+        with self._lock:
+            h = self._histograms.get((name, labels))
+            if h is None:
+                h = self._histograms[(name, labels)] = Histogram(buckets)
+            h.observe(value)
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self) -> str:
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((k, (h.buckets, list(h.counts), h.sum, h.count)) for k, h in self._histograms.items())
+        series: Dict[str, list] = {}
+        for (name, labels), value in counters:
+            series.setdefault(name, []).append(f"{name}{_labels(labels)} {_num(value)}")
+        for (name, labels), (buckets, counts, total, count) in histograms:
+            lines = series.setdefault(name, [])
+            cumulative = 0
+            for le, n in zip(buckets, counts):
+                cumulative += n
+                lines.append(f"{name}_bucket{_labels(labels + (('le', _num(le)),))} {cumulative}")
+            lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_labels(labels)} {_num(total)}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+        out = []
+        for name, (kind, text) in METRICS.items():
+            if name in series:
+                out += [f"# HELP {name} {text}", f"# TYPE {name} {kind}", *series[name]]
+        return "\n".join(out) + "\n"
+
+
+def _num(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+registry = Registry()
+
+# Counters of the request being handled; None outside requests (writer,
+# detector and bus threads)
+_request: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar("metrics_request", default=None)
+
+
+def _new_stats() -> Dict[str, Any]:
+    return {"queries": 0, "sql": 0.0, "objects": 0, "render": 0.0}
+
+
+# ---------- SQL, ORM and template hooks ----------
+
+def _before_cursor(conn, cursor, statement, parameters, context, executemany):
+    conn.info["metrics_started"] = time.perf_counter()
+
+
+def _after_cursor(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop("metrics_started", None)
+    elapsed = time.perf_counter() - started if started is not None else 0.0
+    stats = _request.get()
+    if stats is not None:
+        stats["queries"] += 1
+        stats["sql"] += elapsed
+    else:
+        labels = (("thread", threading.current_thread().name),)
+        registry.inc("medicalweb_background_sql_queries_total", labels)
+        registry.inc("medicalweb_background_sql_seconds_total", labels, elapsed)
+
+
+def _on_load(target, context):
+    stats = _request.get()
+    if stats is not None:
+        stats["objects"] += 1
+
+
+class TimedTemplate(jinja2.Template):
+    def render(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            stats = _request.get()
+            if stats is not None:
+                stats["render"] += time.perf_counter() - started
+
+
+def instrument(engines, env: jinja2.Environment):
+    if not METRICS_ENABLED:
+        return
+    for e in engines:
+        if not event.contains(e, "before_cursor_execute", _before_cursor):
+            event.listen(e, "before_cursor_execute", _before_cursor)
+            event.listen(e, "after_cursor_execute", _after_cursor)
+    if not event.contains(Mapper, "load", _on_load):
+        event.listen(Mapper, "load", _on_load)
+    env.template_class = TimedTemplate
+    if env.cache is not None:
+        env.cache.clear()  # templates loaded so far were built from the old class
+
+
+# Decorator: time a function (sync or async) as a named phase
+#   @metrics.timed("patient_states")
+def timed(phase: str):
+    labels = (("phase", phase),)
+
+    def record(started: float):
+        registry.inc("medicalweb_phase_seconds_total", labels, time.perf_counter() - started)
+        registry.inc("medicalweb_phase_calls_total", labels)
+
+    def wrap(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    record(started)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                record(started)
+        return wrapper
+    return wrap
+
+
+# ---------- sampling profiler ----------
+
+class SlowRequestProfiler:
+    def __init__(self, slow_ms: float, interval_ms: float, out_dir: str, keep_seconds: float = 60.0):
+        self.slow = slow_ms / 1000
+        self.interval = interval_ms / 1000
+        self.out_dir = out_dir
+        self.keep = max(keep_seconds, self.slow * 2)
+        self._samples = deque()  # (time, folded stack)
+        self._inflight = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def enter(self):
+        with self._lock:
+            self._inflight += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def leave(self):
+        with self._lock:
+            self._inflight -= 1
+            if self._inflight == 0:
+                self._wake.clear()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(1.0)
+            self._thread = None
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.is_set():
+            self._wake.wait()
+            if self._stop.wait(self.interval):
+                return
+            now = time.perf_counter()
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self._samples.append((now, _fold(names.get(ident, str(ident)), frame)))
+            while self._samples and self._samples[0][0] < now - self.keep:
+                self._samples.popleft()
+
+    # Folded stacks sampled between started and ended; returns the file or None
+    def dump(self, route: str, method: str, started: float, ended: float) -> Optional[str]:
+        counts: Dict[str, int] = {}
+        for t, stack in list(self._samples):
+            if started <= t <= ended:
+                counts[stack] = counts.get(stack, 0) + 1
+        if not counts:
+            return None
+        os.makedirs(self.out_dir, exist_ok=True)
+        slug = "".join(c if c.isalnum() else "_" for c in route).strip("_") or "root"
+        path = os.path.join(self.out_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{method}-{slug}-{int((ended - started) * 1000)}ms.folded")
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, n in sorted(counts.items()):
+                f.write(f"{stack} {n}\n")
+        registry.inc("medicalweb_slow_request_profiles_total", (("route", route),))
+        return path
+
+
+def _fold(thread: str, frame) -> str:
+    parts = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+        frame = frame.f_back
+    parts.append(thread)
+    return ";".join(reversed(parts))
+
+
+profiler = SlowRequestProfiler(PROFILE_SLOW_MS, PROFILE_INTERVAL_MS, PROFILE_DIR) if PROFILE_SLOW_MS > 0 else None
+
+
+# ---------- middleware ----------
+
+def _route_of(scope, root_path: str) -> str:
+    # the route template, never the raw path, so label values stay bounded
+    route = scope.get("route")
+    if route is not None and getattr(route, "path", None):
+        return route.path
+    if scope.get("root_path", "") != root_path:
+        return scope["root_path"][len(root_path):]  # a mount, e.g. /static
+    return "unmatched"
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            return await self.app(scope, receive, send)
+        root_path = scope.get("root_path", "")
+        stats = _new_stats()
+        token = _request.set(stats)
+        response = {"status": 500, "bytes": 0, "stream": False}
+        profiling = profiler is not None
+        if profiling:
+            profiler.enter()
+
+        async def send_wrapper(message):
+            nonlocal profiling
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                for k, v in message.get("headers", ()):
+                    if k.lower() == b"content-type" and v.startswith(b"text/event-stream"):
+                        # SSE stays open for minutes: neither a latency nor a profile
+                        response["stream"] = True
+                        if profiling:
+                            profiler.leave()
+                            profiling = False
+            elif message["type"] == "http.response.body":
+                response["bytes"] += len(message.get("body", b""))
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            ended = time.perf_counter()
+            _request.reset(token)
+            if profiling:
+                profiler.leave()
+            route, method = _route_of(scope, root_path), scope["method"]
+            self.record(route, method, response, stats, ended - started)
+            if profiling and ended - started >= profiler.slow:
+                await asyncio.to_thread(profiler.dump, route, method, started, ended)
+
+    @staticmethod
+    def record(route: str, method: str, response: Dict[str, Any], stats: Dict[str, Any], elapsed: float):
+        labels = (("route", route), ("method", method))
+        registry.inc("medicalweb_requests_total", labels + (("status", str(response["status"])),))
+        if response["stream"]:
+            return
+        registry.observe("medicalweb_request_duration_seconds", labels, elapsed, LATENCY_BUCKETS)
+        registry.observe("medicalweb_request_sql_queries", labels, stats["queries"], QUERY_BUCKETS)
+        registry.observe("medicalweb_response_bytes", labels, response["bytes"], SIZE_BUCKETS)
+        registry.inc("medicalweb_request_sql_seconds_total", labels, stats["sql"])
+        registry.inc("medicalweb_request_orm_objects_total", labels, stats["objects"])
+        registry.inc("medicalweb_request_render_seconds_total", labels, stats["render"])
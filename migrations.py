@@ -0,0 +1,246 @@
+# migrations.py
+import argparse
+import logging
+import sys
+from typing import Callable, Dict, List, Tuple
+
+from sqlalchemy import Column, Integer, MetaData, Table, bindparam, inspect, select, text, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateTable
+
+import models  # registers every table on Base.metadata
+from database import Base
+
+# Versioned schema changes. The applied version lives in a one-row
+# schema_version table; `python migrations.py upgrade` runs every newer step,
+# each in its own transaction together with its version bump. The app itself
+# only reads the version at startup (see lifespan in MedicalWeb.py), so import
+# and boot never touch the schema.
+#
+# Steps are written to be safe on databases created before this table existed
+# (checkfirst / if-missing), which start at version 0. Never edit a released
+# step: add a new one.
+
+log = logging.getLogger(__name__)
+
+_meta = MetaData()
+schema_version = Table(
+    "schema_version", _meta,
+    Column("id", Integer, primary_key=True),
+    Column("version", Integer, nullable=False),
+)
+
+MIGRATIONS: List[Tuple[int, str, Callable]] = []
+
+
+def migration(version: int, description: str):
+    def register(fn):
+        MIGRATIONS.append((version, description, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return register
+
+
+def _create_tables(conn, *names: str):
+    for name in names:
+        Base.metadata.tables[name].create(conn, checkfirst=True)
+
+
+def _create_indexes(conn, *names: str):
+    for name in names:
+        for index in Base.metadata.tables[name].indexes:
+            index.create(conn, checkfirst=True)
+
+
+# For later steps that add a column to an existing table
+def add_column_if_missing(conn, table: str, column: Column):
+    if column.name in {c["name"] for c in inspect(conn).get_columns(table)}:
+        return
+    ddl = column.type.compile(conn.dialect)
+    if column.server_default is not None:
+        # SQLite only adds a NOT NULL column together with a default
+        ddl += f" DEFAULT {column.server_default.arg}" + ("" if column.nullable else " NOT NULL")
+    conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column.name} {ddl}")
+
+
+@migration(1, "base tables")
+def _base_tables(conn):
+    _create_tables(conn, "patients", "doctors", "histories", "logs", "homecare_requests", "emergency_events")
+
+
+@migration(2, "per-patient time indexes on logs and histories")
+def _time_indexes(conn):
+    _create_indexes(conn, "logs", "histories")
+
+
+@migration(3, "vitals table, parsed from existing logs")
+def _vitals(conn):
+    from vitals import backfill_chunk
+
+    _create_tables(conn, "vitals")
+    _create_indexes(conn, "vitals")
+    last_id = 0
+    while last_id is not None:
+        last_id, _ = backfill_chunk(conn, last_id, 1000)
+
+
+@migration(4, "full-text index over log and history notes")
+def _notes_fts(conn):
+    import search
+
+    if search.is_supported(conn) and not search.index_exists(conn):
+        search.rebuild(conn)
+
+
+# Logins and modules that used to be hard-coded in MedicalWeb.py
+_BUILTIN_USERS = [
+    ("Patient", "AAAAAAAA", "patient", "Liao"),
+    ("DoctorWu", "DDDDDDDD", "doctor", "Doctor Wu"),
+    ("Manager", "XXXXXXXX", "manager", "Manager"),
+]
+_BUILTIN_MODULES = {"Liao": ["Heart Monitoring Model"]}
+
+
+@migration(5, "users, patient modules and the cross-worker change bus")
+def _shared_state(conn):
+    from accounts import hash_password
+
+    _create_tables(conn, "users", "patient_modules", "change_bus")
+    users = Base.metadata.tables["users"]
+    if conn.execute(select(users.c.id).limit(1)).first() is None:
+        conn.execute(users.insert(), [{"username": u, "password_hash": hash_password(p), "role": r, "name": n}
+                                      for u, p, r, n in _BUILTIN_USERS])
+    patients, modules = Base.metadata.tables["patients"], Base.metadata.tables["patient_modules"]
+    if conn.execute(select(modules.c.id).limit(1)).first() is None:
+        for name, names in _BUILTIN_MODULES.items():
+            pid = conn.execute(select(patients.c.id).where(patients.c.name == name)).scalar()
+            if pid is not None:
+                conn.execute(modules.insert(), [{"patient_id": pid, "name": m} for m in names])
+
+
+# Rebuild `table` with its status column holding codes instead of text
+# (SQLite can't change a column's type in place). NULL becomes the default.
+def _recode_status(conn, name: str):
+    table = Base.metadata.tables[name]
+    values = table.c.status.type.values
+    old = inspect(conn)
+    status_type = next(c["type"] for c in old.get_columns(name) if c["name"] == "status")
+    if isinstance(status_type, Integer):
+        return
+    unknown = conn.execute(
+        text(f"SELECT DISTINCT status FROM {name} WHERE status NOT IN :values")
+        .bindparams(bindparam("values", expanding=True)),
+        {"values": list(values)},
+    ).scalars().all()
+    if unknown:
+        raise RuntimeError(f"{name}: status values {unknown} have no code; add them to models.py first")
+    columns = [c["name"] for c in old.get_columns(name) if c["name"] in table.c]
+    for index in old.get_indexes(name):
+        conn.exec_driver_sql(f"DROP INDEX {index['name']}")
+    conn.exec_driver_sql(f"ALTER TABLE {name} RENAME TO {name}_old")
+    table.create(conn)
+    cases = " ".join(f"WHEN '{v}' THEN {i}" for i, v in enumerate(values))
+    select_list = ", ".join(f"CASE status {cases} ELSE 0 END" if c == "status" else c for c in columns)
+    conn.exec_driver_sql(f"INSERT INTO {name} ({', '.join(columns)}) SELECT {select_list} FROM {name}_old")
+    conn.exec_driver_sql(f"DROP TABLE {name}_old")
+
+
+@migration(6, "status codes and indexes for homecare requests and emergency events")
+def _status_codes(conn):
+    for name in ("homecare_requests", "emergency_events"):
+        _recode_status(conn, name)
+        _create_indexes(conn, name)
+
+
+@migration(7, "vitals rollups and archive segments for tiered storage")
+def _vitals_tiers(conn):
+    _create_tables(conn, "vital_rollups", "archive_segments")
+    _create_indexes(conn, "archive_segments")
+
+
+@migration(8, "monitoring model registry")
+def _monitoring_models(conn):
+    _create_tables(conn, "monitoring_models")
+
+
+@migration(9, "homecare review columns and request versions")
+def _homecare_review(conn):
+    table = Base.metadata.tables["homecare_requests"]
+    for name in ("version", "reviewed_by", "reviewed_at", "note"):
+        add_column_if_missing(conn, "homecare_requests", table.c[name])
+
+
+@migration(10, "patient data generations and report snapshots")
+def _report_snapshots(conn):
+    _create_tables(conn, "patient_generations", "report_snapshots")
+
+
+HEAD = MIGRATIONS[-1][0]
+
+
+def current_version(conn) -> int:
+    if not inspect(conn).has_table("schema_version"):
+        return 0
+    return conn.execute(select(schema_version.c.version)).scalar() or 0
+
+
+def _ensure_version_table(engine):
+    with engine.begin() as conn:
+        conn.execute(CreateTable(schema_version, if_not_exists=True))
+    try:
+        with engine.begin() as conn:
+            if conn.execute(select(schema_version.c.id)).first() is None:
+                conn.execute(schema_version.insert().values(id=1, version=0))
+    except IntegrityError:
+        pass  # another process inserted it first
+
+
+# Apply every step newer than the database. Safe to run from several processes
+# at once: each step first takes the write lock on schema_version, then
+# re-reads the version, so a step runs exactly once.
+def upgrade(engine, target: int = HEAD) -> List[int]:
+    _ensure_version_table(engine)
+    applied = []
+    for version, description, fn in MIGRATIONS:
+        if version > target:
+            break
+        with engine.begin() as conn:
+            conn.execute(update(schema_version).values(version=schema_version.c.version))
+            if current_version(conn) >= version:
+                continue
+            log.info("migration %04d: %s", version, description)
+            fn(conn)
+            conn.execute(update(schema_version).values(version=version))
+        applied.append(version)
+    return applied
+
+
+def pending(conn) -> Dict[int, str]:
+    v = current_version(conn)
+    return {version: description for version, description, _ in MIGRATIONS if version > v}
+
+
+if __name__ == "__main__":
+    from database import engine
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(description="Database schema migrations")
+    sub = parser.add_subparsers(dest="command", required=True)
+    up = sub.add_parser("upgrade", help="apply pending migrations")
+    up.add_argument("--to", type=int, default=HEAD, help="stop at this version")
+    sub.add_parser("current", help="print the database's schema version")
+    sub.add_parser("check", help="exit 1 if migrations are pending")
+    args = parser.parse_args()
+    if args.command == "upgrade":
+        done = upgrade(engine, args.to)
+        with engine.connect() as conn:
+            print(f"applied {len(done)} migrations, schema at {current_version(conn)}")
+    elif args.command == "current":
+        with engine.connect() as conn:
+            print(f"{current_version(conn)} (head {HEAD})")
+    else:
+        with engine.connect() as conn:
+            todo = pending(conn)
+        for version, description in todo.items():
+            print(f"pending {version:04d}: {description}")
+        sys.exit(1 if todo else 0)
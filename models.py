@@ -1,9 +1,36 @@
 ﻿# -*- coding: utf-8 -*-
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, Float, String, Text, DateTime, ForeignKey, Index, LargeBinary, SmallInteger
+from sqlalchemy.types import TypeDecorator
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from database import Base
 
+# Status values, stored as their index (small integer) in the table
+HOMECARE_STATUSES = ("pending", "approved", "rejected", "completed", "cancelled")
+EMERGENCY_STATUSES = ("處理中", "已處理")
+
+# Status column: the app reads and writes the strings above, the table holds
+# their codes. Unknown values are rejected instead of being stored.
+class StatusCode(TypeDecorator):
+    impl = SmallInteger
+    cache_ok = True
+
+    def __init__(self, values):
+        super().__init__()
+        self.values = tuple(values)
+        self._codes = {v: i for i, v in enumerate(self.values)}
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        try:
+            return self._codes[value]
+        except KeyError:
+            raise ValueError(f"unknown status {value!r}, expected one of {self.values}")
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else self.values[value]
+
 class Patient(Base):
     __tablename__ = "patients"
     id = Column(Integer, primary_key=True, index=True)
@@ -17,6 +44,7 @@ class Patient(Base):
     logs = relationship("Log", back_populates="patient", cascade="all, delete-orphan")
     requests = relationship("HomecareRequest", back_populates="patient", cascade="all, delete-orphan")
     emergencies = relationship("EmergencyEvent", back_populates="patient", cascade="all, delete-orphan")
+    modules = relationship("PatientModule", back_populates="patient", cascade="all, delete-orphan")
 
 class Doctor(Base):
     __tablename__ = "doctors"
@@ -25,6 +53,10 @@ class Doctor(Base):
 
 class History(Base):
     __tablename__ = "histories"
+    __table_args__ = (
+        # per-patient keyset paging on (created_at, id)
+        Index("ix_histories_patient_created", "patient_id", "created_at"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     content = Column(Text)
     created_at = Column(DateTime, default=datetime.now)
@@ -33,27 +65,155 @@ class History(Base):
 
 class Log(Base):
     __tablename__ = "logs"
+    __table_args__ = (
+        # latest-log-per-patient lookups and per-patient ordering
+        Index("ix_logs_patient_timestamp", "patient_id", "timestamp"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     content = Column(Text)
     timestamp = Column(DateTime, default=datetime.now)
     patient_id = Column(Integer, ForeignKey("patients.id"))
     patient = relationship("Patient", back_populates="logs")
+    vitals = relationship("Vital", back_populates="log", uselist=False, cascade="all, delete-orphan")
+
+# Typed readings parsed once from Log.content when the log is written
+class Vital(Base):
+    __tablename__ = "vitals"
+    __table_args__ = (
+        Index("ix_vitals_patient_measured", "patient_id", "measured_at"),
+    )
+    log_id = Column(Integer, ForeignKey("logs.id"), primary_key=True)
+    patient_id = Column(Integer, ForeignKey("patients.id"))
+    heart_rate = Column(Integer, nullable=True)
+    bp_systolic = Column(Integer, nullable=True)
+    bp_diastolic = Column(Integer, nullable=True)
+    temperature = Column(Float, nullable=True)
+    measured_at = Column(DateTime)
+    log = relationship("Log", back_populates="vitals")
 
 class HomecareRequest(Base):
     __tablename__ = "homecare_requests"
+    __table_args__ = (
+        # pending list on the doctor dashboard, oldest first
+        Index("ix_homecare_status_requested", "status", "requested_at"),
+        # newest request per patient
+        Index("ix_homecare_patient_requested", "patient_id", "requested_at"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     reason = Column(Text)
-    status = Column(String, default="pending")
+    status = Column(StatusCode(HOMECARE_STATUSES), default="pending", nullable=False)
     requested_at = Column(DateTime, default=datetime.now)
     patient_id = Column(Integer, ForeignKey("patients.id"))
+    # bumped by every status change (optimistic concurrency, see homecare.py)
+    version = Column(Integer, nullable=False, default=0, server_default="0")
+    reviewed_by = Column(String, nullable=True)
+    reviewed_at = Column(DateTime, nullable=True)
+    note = Column(Text, nullable=True)
     patient = relationship("Patient", back_populates="requests")
 
 class EmergencyEvent(Base):
     __tablename__ = "emergency_events"
+    __table_args__ = (
+        # newest-first event list
+        Index("ix_emergency_time", "time"),
+        # per-patient recent events (detector dedupe)
+        Index("ix_emergency_patient_time", "patient_id", "time"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     event = Column(Text)
-    status = Column(String, default="處理中")   # ✅ 重新輸入中文
+    status = Column(StatusCode(EMERGENCY_STATUSES), default="處理中", nullable=False)   # ✅ 重新輸入中文
     time = Column(DateTime, default=datetime.now)
     patient_id = Column(Integer, ForeignKey("patients.id"))
     patient = relationship("Patient", back_populates="emergencies")
 
+# Login accounts (password_hash from accounts.hash_password)
+class User(Base):
+    __tablename__ = "users"
+    id = Column(Integer, primary_key=True, index=True)
+    username = Column(String, unique=True, index=True, nullable=False)
+    password_hash = Column(String, nullable=False)
+    role = Column(String, nullable=False)  # patient / doctor / manager
+    name = Column(String, nullable=False)
+
+# Monitoring models assigned to a patient (shown on the modules page)
+class PatientModule(Base):
+    __tablename__ = "patient_modules"
+    id = Column(Integer, primary_key=True, index=True)
+    patient_id = Column(Integer, ForeignKey("patients.id"), index=True)
+    name = Column(String, nullable=False)
+    patient = relationship("Patient", back_populates="modules")
+
+# Committed changes for the other worker processes (see bus.py)
+class BusEntry(Base):
+    __tablename__ = "change_bus"
+    __table_args__ = {"sqlite_autoincrement": True}  # seq is never reused, even after pruning
+    seq = Column(Integer, primary_key=True)
+    origin = Column(String, nullable=False)
+    payload = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime, default=datetime.now, index=True)
+
+# Downsampled vitals of readings that left the hot vitals table (see tiers.py):
+# one row per patient per bucket at each resolution (bucket length in seconds).
+# Counts and sums, not averages, so buckets can be merged exactly.
+class VitalRollup(Base):
+    __tablename__ = "vital_rollups"
+    resolution = Column(Integer, primary_key=True)
+    patient_id = Column(Integer, ForeignKey("patients.id"), primary_key=True)
+    bucket = Column(DateTime, primary_key=True)
+    readings = Column(Integer, nullable=False, default=0)
+    heart_rate_n = Column(Integer, nullable=False, default=0)
+    heart_rate_sum = Column(Float, nullable=False, default=0)
+    heart_rate_min = Column(Float, nullable=True)
+    heart_rate_max = Column(Float, nullable=True)
+    bp_systolic_n = Column(Integer, nullable=False, default=0)
+    bp_systolic_sum = Column(Float, nullable=False, default=0)
+    bp_systolic_min = Column(Float, nullable=True)
+    bp_systolic_max = Column(Float, nullable=True)
+    bp_diastolic_n = Column(Integer, nullable=False, default=0)
+    bp_diastolic_sum = Column(Float, nullable=False, default=0)
+    bp_diastolic_min = Column(Float, nullable=True)
+    bp_diastolic_max = Column(Float, nullable=True)
+    temperature_n = Column(Integer, nullable=False, default=0)
+    temperature_sum = Column(Float, nullable=False, default=0)
+    temperature_min = Column(Float, nullable=True)
+    temperature_max = Column(Float, nullable=True)
+
+# Compressed file of archived raw readings (logs + vitals rows), for re-reading
+class ArchiveSegment(Base):
+    __tablename__ = "archive_segments"
+    __table_args__ = (
+        Index("ix_archive_segments_range", "first_at", "last_at"),
+    )
+    id = Column(Integer, primary_key=True, index=True)
+    path = Column(String, nullable=False)
+    first_at = Column(DateTime, nullable=False)
+    last_at = Column(DateTime, nullable=False)
+    min_patient_id = Column(Integer, nullable=False)
+    max_patient_id = Column(Integer, nullable=False)
+    rows = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.now)
+
+# Safetensors weights behind a patient module name (see inference.py)
+class MonitoringModel(Base):
+    __tablename__ = "monitoring_models"
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, unique=True, nullable=False)
+    path = Column(String, nullable=False)
+    window = Column(Integer, nullable=False)
+    outputs = Column(String, nullable=False)  # comma separated output names
+    updated_at = Column(DateTime, default=datetime.now)
+
+# Per-patient counter that every committed change moves on (changes.py), so
+# any process can tell whether something derived from a patient's rows is current
+class PatientGeneration(Base):
+    __tablename__ = "patient_generations"
+    patient_id = Column(Integer, ForeignKey("patients.id"), primary_key=True)
+    generation = Column(Integer, nullable=False, default=0)
+
+# A patient's materialized report (snapshots.py): orjson body as of `generation`
+class ReportSnapshot(Base):
+    __tablename__ = "report_snapshots"
+    patient_id = Column(Integer, ForeignKey("patients.id"), primary_key=True)
+    generation = Column(Integer, nullable=False, default=0)
+    built_at = Column(DateTime, default=datetime.now)
+    body = Column(LargeBinary, nullable=False)
@@ -0,0 +1,153 @@
+# pagecache.py
+import datetime
+import glob
+import hashlib
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple, Union
+
+from fastapi import Request
+from starlette.responses import Response
+
+FRAGMENT_CACHE_ENTRIES = int(os.environ.get("MEDICALWEB_FRAGMENT_CACHE_ENTRIES", "5000"))
+
+# Process id, for versions only this process can vouch for
+BOOT_ID = uuid.uuid4().hex[:8]
+
+
+# Code and templates fingerprint: a deploy changes pages without changing data
+def _release() -> str:
+    if os.environ.get("MEDICALWEB_RELEASE"):
+        return os.environ["MEDICALWEB_RELEASE"]
+    root = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.blake2b(digest_size=6)
+    for path in sorted(glob.glob(os.path.join(root, "*.py")) + glob.glob(os.path.join(root, "templates", "*.html"))):
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+RELEASE = _release()
+
+
+# Data versions from the committed-change feed, as change bus sequence numbers
+# so every worker names the same data the same way: a global version
+# (anything changed) and one per patient (its last change). `applied` is how
+# far this process has replayed the bus in order; a change committed here
+# ahead of that may be missing earlier changes from other workers, so until
+# the bus catches up its versions are marked as this process's own.
+class DataVersions:
+    def __init__(self):
+        self._base: Optional[int] = None  # bus position at startup
+        self._applied = 0
+        self._latest = 0
+        self._local = 0  # changes without a bus seq (bus disabled)
+        self._patients: Dict[int, Tuple[int, int]] = {}
+        self._lock = threading.Lock()
+
+    def _name(self, seq: int, local: int) -> Union[int, str]:
+        if seq <= self._applied and not local:
+            return seq
+        return f"{seq}.{local}@{BOOT_ID}"
+
+    @property
+    def global_version(self) -> Union[int, str]:
+        return self._name(max(self._latest, self._applied), self._local)
+
+    def patient(self, patient_id: Optional[int]) -> Union[int, str]:
+        seq, local = self._patients.get(patient_id, (self._base or 0, 0))
+        return self._name(seq, local)
+
+    # Bus replay position (ChangeBus on_seq)
+    def advance(self, seq: int):
+        with self._lock:
+            if self._base is None:
+                self._base = seq
+            self._applied = max(self._applied, seq)
+
+    # changes.subscribe() listener
+    def apply(self, changes: List[Dict[str, Any]]):
+        with self._lock:
+            for c in changes:
+                seq = c.get("seq")
+                if seq is None:
+                    self._local += 1
+                    seq = self._latest
+                self._latest = max(self._latest, seq)
+                self._patients[c["patient_id"]] = (seq, self._local)
+
+
+# Rendered HTML fragments keyed on (what, patient, version, view); a write
+# moves the patient's version on, so stale fragments are never looked up
+# again and simply age out of the LRU.
+class FragmentCache:
+    def __init__(self, max_entries: int = FRAGMENT_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[str]:
+        with self._lock:
+            html = self._entries.get(key)
+            if html is None:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return html
+
+    def put(self, key: Hashable, html: str):
+        with self._lock:
+            self._entries[key] = html
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+versions = DataVersions()
+fragments = FragmentCache()
+
+
+# Relative windows (?days=7) move with the clock, so views keyed on them
+# also roll over at least once a day
+def view_key(request: Request) -> str:
+    return f"{request.url.path}?{request.url.query}|{datetime.date.today().isoformat()}"
+
+
+# Strong ETag for one user's view of a page at a data version
+def page_etag(request: Request, user: Dict[str, Any], version: Union[int, str]) -> str:
+    raw = f"{RELEASE}|{user.get('role')}|{user.get('name')}|{view_key(request)}|{version}"
+    return '"' + hashlib.blake2b(raw.encode(), digest_size=12).hexdigest() + '"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = [t.strip() for t in header.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+# Pages are per user (session cookie) and must be revalidated on every view
+def _cache_headers(etag: str) -> Dict[str, str]:
+    return {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Cookie"}
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers=_cache_headers(etag))
+
+
+def with_etag(response: Response, etag: str) -> Response:
+    response.headers.update(_cache_headers(etag))
+    return response
@@ -0,0 +1,101 @@
+# paging.py
+import datetime
+from typing import Any, List, Optional, Tuple
+
+from fastapi import HTTPException, Query
+from sqlalchemy import select, tuple_
+
+from models import Patient
+
+DEFAULT_WINDOW_DAYS = 7
+DEFAULT_PAGE_SIZE = 50
+DEFAULT_PATIENTS_PER_PAGE = 20
+
+
+# Cursor = "<iso timestamp>_<id>" of the oldest row already shown
+def encode_cursor(ts: datetime.datetime, row_id: int) -> str:
+    return f"{ts.isoformat()}_{row_id}"
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime.datetime, int]:
+    ts, _, row_id = cursor.rpartition("_")
+    return datetime.datetime.fromisoformat(ts), int(row_id)
+
+
+# Query parameters shared by /logs, /history and /reports:
+#   patient  - only this patient
+#   days     - window ending now (default 7, 0 = all time); ignored when since is given
+#   since / until - explicit date range (until is inclusive)
+#   before   - row cursor from the previous page
+#   limit    - rows per patient per page
+#   after / per_page - patient paging for the doctor views (patient id cursor)
+class PageParams:
+    def __init__(
+        self,
+        patient: Optional[str] = None,
+        days: int = Query(DEFAULT_WINDOW_DAYS, ge=0),
+        since: Optional[datetime.date] = None,
+        until: Optional[datetime.date] = None,
+        before: Optional[str] = None,
+        limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=500),
+        after: int = Query(0, ge=0),
+        per_page: int = Query(DEFAULT_PATIENTS_PER_PAGE, ge=1, le=200),
+    ):
+        self.patient = patient
+        self.days = days
+        if since:
+            self.since = datetime.datetime.combine(since, datetime.time())
+        elif days:
+            self.since = datetime.datetime.now() - datetime.timedelta(days=days)
+        else:
+            self.since = None
+        self.until = datetime.datetime.combine(until, datetime.time()) + datetime.timedelta(days=1) if until else None
+        try:
+            self.before = decode_cursor(before) if before else None
+        except ValueError:
+            raise HTTPException(status_code=400, detail="invalid cursor")
+        self.limit = limit
+        self.after = after
+        self.per_page = per_page
+
+    # a default window is hiding older rows (offer an "all time" link)
+    @property
+    def windowed(self) -> bool:
+        return self.since is not None
+
+
+# Newest-first page of one patient's rows, fetching limit + 1 to detect a next page.
+# Served by the (patient_id, <ts column>) index, so cost follows the page size.
+def rows_page_stmt(model, ts_col, patient_id: int, params: PageParams, before=None):
+    stmt = select(model).where(model.patient_id == patient_id)
+    if params.since is not None:
+        stmt = stmt.where(ts_col >= params.since)
+    if params.until is not None:
+        stmt = stmt.where(ts_col < params.until)
+    if before is not None:
+        stmt = stmt.where(tuple_(ts_col, model.id) < tuple_(*before))
+    return stmt.order_by(ts_col.desc(), model.id.desc()).limit(params.limit + 1)
+
+
+# Split a limit + 1 fetch into (oldest-first rows, cursor for the next older page)
+def split_page(rows: List[Any], limit: int, ts_attr: str) -> Tuple[List[Any], Optional[str]]:
+    more = len(rows) > limit
+    rows = list(rows[:limit])
+    cursor = encode_cursor(getattr(rows[-1], ts_attr), rows[-1].id) if more else None
+    rows.reverse()
+    return rows, cursor
+
+
+# One page of patients by id; a patient filter narrows it to that name
+def patients_page_stmt(params: PageParams):
+    stmt = select(Patient)
+    if params.patient:
+        stmt = stmt.where(Patient.name == params.patient)
+    return stmt.where(Patient.id > params.after).order_by(Patient.id).limit(params.per_page + 1)
+
+
+def split_patients(patients: List[Patient], params: PageParams) -> Tuple[List[Patient], Optional[int]]:
+    if len(patients) > params.per_page:
+        patients = list(patients[:params.per_page])
+        return patients, patients[-1].id
+    return list(patients), None
@@ -0,0 +1,106 @@
+# pubsub.py
+import asyncio
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+import orjson
+
+
+class Subscriber:
+    def __init__(self, loop: asyncio.AbstractEventLoop, patient_ids: Optional[Set[int]], kinds: Optional[Set[str]], size: int):
+        self.loop = loop
+        self.patient_ids = patient_ids
+        self.kinds = kinds
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=size)
+        self.dropped = False
+
+    def wants(self, change: Dict[str, Any]) -> bool:
+        if self.kinds and change["kind"] not in self.kinds:
+            return False
+        return not self.patient_ids or change.get("patient_id") in self.patient_ids
+
+
+# In-process fan-out of committed changes to long-lived SSE connections.
+# publish() is called from the writer thread; delivery happens on each
+# subscriber's event loop. A subscriber whose queue fills up is dropped (its
+# stream ends and the browser reconnects) instead of slowing everyone else.
+class Hub:
+    def __init__(self, queue_size: int = 256, heartbeat: float = 15.0):
+        self.queue_size = queue_size
+        self.heartbeat = heartbeat
+        self._subs: Set[Subscriber] = set()
+        self._lock = threading.Lock()
+        self.stats = {"published": 0, "delivered": 0, "dropped_subscribers": 0}
+
+    def subscribe(self, patient_ids: Optional[Iterable[int]] = None, kinds: Optional[Iterable[str]] = None) -> Subscriber:
+        sub = Subscriber(asyncio.get_running_loop(), set(patient_ids) if patient_ids else None,
+                         set(kinds) if kinds else None, self.queue_size)
+        with self._lock:
+            self._subs.add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscriber):
+        with self._lock:
+            self._subs.discard(sub)
+
+    def subscriber_count(self) -> int:
+        return len(self._subs)
+
+    # Thread-safe; one loop callback per subscriber per commit
+    def publish(self, changes: List[Dict[str, Any]]):
+        self.stats["published"] += len(changes)
+        with self._lock:
+            subs = list(self._subs)
+        for sub in subs:
+            wanted = [c for c in changes if sub.wants(c)]
+            if wanted:
+                sub.loop.call_soon_threadsafe(self._deliver, sub, wanted)
+
+    def _deliver(self, sub: Subscriber, changes: List[Dict[str, Any]]):
+        if sub.dropped:
+            return
+        for c in changes:
+            try:
+                sub.queue.put_nowait(c)
+                self.stats["delivered"] += 1
+            except asyncio.QueueFull:
+                self._drop(sub)
+                return
+
+    # End every open stream (browsers reconnect, to another worker on a
+    # restart) so a graceful shutdown is not held open by idle SSE clients.
+    # Thread-safe, callable from a signal handler.
+    def close(self):
+        with self._lock:
+            subs = list(self._subs)
+        for sub in subs:
+            sub.loop.call_soon_threadsafe(self._drop, sub)
+
+    def _drop(self, sub: Subscriber):
+        if sub.dropped:
+            return
+        sub.dropped = True
+        self.stats["dropped_subscribers"] += 1
+        self.unsubscribe(sub)
+        while not sub.queue.empty():
+            sub.queue.get_nowait()
+        sub.queue.put_nowait(None)
+
+    # Server-Sent Events body for one subscriber, with heartbeat comments
+    async def stream(self, sub: Subscriber):
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    change = await asyncio.wait_for(sub.queue.get(), timeout=self.heartbeat)
+                except asyncio.TimeoutError:
+                    yield ": heartbeat\n\n"
+                    continue
+                if change is None:
+                    return
+                yield f"event: {change['kind']}\ndata: {orjson.dumps(change).decode()}\n\n"
+        finally:
+            self.unsubscribe(sub)
+
+
+hub = Hub()
@@ -0,0 +1,78 @@
+# queries.py
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session, aliased, joinedload
+
+from models import HomecareRequest, Log, Patient, PatientModule
+
+
+# Id of the newest log for the outer patient row. Ordered on (timestamp, id) so
+# SQLite answers it from ix_logs_patient_timestamp with a single index seek per
+# patient, no matter how many logs that patient has.
+def latest_log_id_for(patient_id_col):
+    newer = aliased(Log)
+    return (
+        select(newer.id)
+        .where(newer.patient_id == patient_id_col)
+        .order_by(newer.timestamp.desc(), newer.id.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+
+
+# All patients paired with their latest log (or None) in one query; the log's
+# parsed vitals come along in the same join
+def patients_with_latest_log(db: Session) -> List[Tuple[Patient, Optional[Log]]]:
+    stmt = (
+        select(Patient, Log)
+        .outerjoin(Log, Log.id == latest_log_id_for(Patient.id))
+        .options(joinedload(Log.vitals))
+        .order_by(Patient.id)
+    )
+    return [(p, l) for p, l in db.execute(stmt).all()]
+
+
+# patient_id -> latest Log for the given patients in one query
+def latest_logs(db: Session, patient_ids: Iterable[int]) -> Dict[int, Log]:
+    ids = list(patient_ids)
+    if not ids:
+        return {}
+    stmt = (
+        select(Log)
+        .join(Patient, Log.id == latest_log_id_for(Patient.id))
+        .where(Patient.id.in_(ids))
+        .options(joinedload(Log.vitals))
+    )
+    return {l.patient_id: l for l in db.execute(stmt).scalars().all()}
+
+
+# patient_id -> newest HomecareRequest for the given patients (None = every
+# patient with a request) in one query
+def latest_homecare(db: Session, patient_ids: Optional[Iterable[int]] = None) -> Dict[int, HomecareRequest]:
+    ids = None if patient_ids is None else list(patient_ids)
+    if ids == []:
+        return {}
+    newer = aliased(HomecareRequest)
+    newest_id = (
+        select(newer.id)
+        .where(newer.patient_id == Patient.id)
+        .order_by(newer.requested_at.desc(), newer.id.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+    stmt = select(HomecareRequest).join(Patient, HomecareRequest.id == newest_id)
+    if ids is not None:
+        stmt = stmt.where(Patient.id.in_(ids))
+    return {r.patient_id: r for r in db.execute(stmt).scalars().all()}
+
+
+# patient name -> module names, for the given patients (None = all)
+def modules_of(db: Session, names: Optional[Iterable[str]] = None) -> Dict[str, List[str]]:
+    stmt = select(Patient.name, PatientModule.name).join(PatientModule.patient).order_by(PatientModule.id)
+    if names is not None:
+        stmt = stmt.where(Patient.name.in_(list(names)))
+    modules: Dict[str, List[str]] = {}
+    for patient, module in db.execute(stmt).all():
+        modules.setdefault(patient, []).append(module)
+    return modules
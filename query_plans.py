@@ -0,0 +1,236 @@
+# query_plans.py
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+from typing import Any, Dict, List, Optional, Tuple
+
+# Query plan regression check: runs every route against a throwaway SQLite
+# database, records each SQL statement the app executes (request handlers and
+# the background writer), then asks SQLite for its plan. Any statement that
+# scans a whole table instead of searching an index fails the check, unless
+# the route is in EXPECTED_SCANS.
+#
+#   python query_plans.py            exit 1 if a route scans a table
+#   python query_plans.py -v         also print every plan
+
+# route -> why a full scan is the right plan there
+EXPECTED_SCANS = {
+    "GET /api/export/logs": "exports every row by design (streamed)",
+    "GET /api/export/history": "exports every row by design (streamed)",
+}
+
+_SCAN = re.compile(r"^SCAN (\w+)(.*)$")
+
+
+def _routes(log_id: int, history_id: int) -> List[Tuple[str, str, str, Any]]:
+    # (who, method, path, form / json body)
+    return [
+        ("doctor", "GET", "/", None),
+        ("doctor", "GET", "/history", None),
+        ("doctor", "GET", "/history?patient=P00001", None),
+        ("doctor", "GET", "/logs", None),
+        ("doctor", "GET", "/logs?patient=P00001&days=30", None),
+        ("doctor", "GET", "/modules", None),
+        ("doctor", "GET", "/apply_homecare", None),
+        ("doctor", "GET", "/apply_homecare?status=approved", None),
+        ("doctor", "GET", f"/apply_homecare?after={datetime.datetime.now().isoformat()}_1", None),
+        ("doctor", "GET", "/emergency", None),
+        ("doctor", "GET", f"/emergency?before={datetime.datetime.now().isoformat()}_1", None),
+        ("doctor", "GET", "/reports", None),
+        ("doctor", "GET", "/search?q=heart", None),
+        ("doctor", "GET", "/api/search?q=chest*&patient=P00002", None),
+        ("doctor", "GET", "/api/export/logs?format=ndjson&patient=P00003", None),
+        ("doctor", "GET", "/api/emergency/detector", None),
+        ("doctor", "GET", "/api/vitals/series?patient=P00001&days=1", None),
+        ("doctor", "GET", "/api/vitals/series?patient=P00001&days=365", None),
+        ("doctor", "GET", "/api/modules/predictions?patient=P00001", None),
+        ("doctor", "GET", "/api/reports", None),
+        ("doctor", "GET", "/api/reports?patient=P00002&fields=metrics,trends", None),
+        ("doctor", "POST", "/add_history/P00001", {"report": "Follow-up: chest pain resolved"}),
+        ("doctor", "POST", "/add_log/P00001", {"log_text": "Heart rate 88, BP 130/85"}),
+        ("doctor", "POST", f"/logs/{log_id}/edit", {"new_text": "Heart rate 70"}),
+        ("doctor", "POST", f"/history/{history_id}/edit", {"new_text": "Reviewed"}),
+        ("doctor", "POST", "/edit_log/P00002/0", {"new_text": "Heart rate 71"}),
+        ("doctor", "POST", "/edit_history/P00002/0", {"new_text": "Reviewed again"}),
+        ("doctor", "POST", "/api/logs/bulk_edit", {"json": {"items": [{"id": log_id + 1, "content": "Heart rate 72"}]}}),
+        ("doctor", "POST", "/api/history/bulk_delete", {"json": {"ids": [history_id + 1]}}),
+        ("doctor", "POST", "/api/vitals/bulk", {"json": [{"patient": "P00004", "heart_rate": 150,
+                                                          "measured_at": datetime.datetime.now().isoformat()}]}),
+        ("doctor", "POST", "/api/homecare/transition", {"json": {"status": "cancelled", "items": [{"id": 1, "version": 0},
+                                                                                              {"id": 99999, "version": 0}]}}),
+        ("doctor", "POST", "/emergency/add", {"patient": "P00005", "event": "Fall at home"}),
+        ("doctor", "POST", f"/logs/{log_id}/delete", {}),
+        ("doctor", "POST", "/delete_log/P00002/0", {}),
+        ("doctor", "POST", f"/history/{history_id}/delete", {}),
+        ("doctor", "POST", "/delete_history/P00002/0", {}),
+        ("patient", "GET", "/", None),
+        ("patient", "GET", "/history", None),
+        ("patient", "GET", "/logs", None),
+        ("patient", "GET", "/modules", None),
+        ("patient", "GET", "/apply_homecare", None),
+        ("patient", "GET", "/reports", None),
+        ("patient", "GET", "/api/search?q=heart", None),
+        ("patient", "GET", "/api/modules/predictions", None),
+        ("patient", "GET", "/api/reports", None),
+        ("patient", "GET", "/api/vitals/series?days=30", None),
+        ("patient", "POST", "/apply_homecare", {"reason": "Need help at home"}),
+        ("anonymous", "POST", "/login", {"username": "DoctorWu", "password": "wrong"}),
+    ]
+
+
+def _fill(session_factory, patients: int, rows: int) -> Tuple[int, int]:
+    import changes
+    from models import EmergencyEvent, History, HomecareRequest, Log, Patient, PatientModule
+    from vitals import record_vitals
+
+    words = "heart chest pain arrhythmia stable fever cough dizziness fatigue".split()
+    rnd = random.Random(17)
+    now = datetime.datetime.now()
+    publish, changes.PUBLISH = changes.PUBLISH, False  # no bus rows for the bulk load
+    db = session_factory()
+    try:
+        for n in range(1, patients + 1):
+            p = Patient(name=f"P{n:05d}")
+            db.add(p)
+            db.add(PatientModule(patient=p, name="Heart Monitoring Model"))
+            logs = []
+            for i in range(rows):
+                t = now - datetime.timedelta(hours=rows - i)
+                logs.append(Log(patient=p, timestamp=t,
+                                content=f"Heart rate {rnd.randint(55, 120)} " + " ".join(rnd.sample(words, 3))))
+                db.add(History(patient=p, created_at=t, content="Visit: " + " ".join(rnd.sample(words, 3))))
+            db.add_all(logs)
+            db.flush()
+            for log in logs:
+                record_vitals(log)
+            db.add(HomecareRequest(patient=p, reason="check", status=rnd.choice(["pending", "approved"]), requested_at=now))
+            db.add(EmergencyEvent(patient=p, event="Fall", status="已處理", time=now - datetime.timedelta(days=2)))
+        db.commit()
+        first_log = db.query(Log.id).order_by(Log.id).first()[0]
+        first_history = db.query(History.id).order_by(History.id).first()[0]
+    finally:
+        db.close()
+        changes.PUBLISH = publish
+    return first_log, first_history
+
+
+def _plan(conn: sqlite3.Connection, statement: str, params) -> List[str]:
+    if isinstance(params, (list, tuple)) and params and isinstance(params[0], (list, tuple, dict)):
+        params = params[0]  # executemany: one row is enough
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + statement, params or ())]
+
+
+def _full_scans(plan: List[str], tables) -> List[str]:
+    scans = []
+    for detail in plan:
+        m = _SCAN.match(detail)
+        if not m or "USING" in m.group(2) or "VIRTUAL TABLE" in m.group(2):
+            continue
+        name = re.sub(r"_\d+$", "", m.group(1))  # aliased tables show up as logs_1
+        if name in tables:
+            scans.append(detail)
+    return scans
+
+
+async def _run(routes, verbose: bool) -> Dict[str, List[Tuple[str, Any]]]:
+    import httpx
+    from sqlalchemy import event
+
+    import MedicalWeb
+    from database import async_engine, engine
+
+    current = {"route": None}
+    seen: Dict[str, List[Tuple[str, Any]]] = {}
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if current["route"] and statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE", "INSERT", "WITH")):
+            seen.setdefault(current["route"], []).append((statement, parameters))
+
+    for e in (engine, async_engine.sync_engine):
+        event.listen(e, "before_cursor_execute", capture)
+
+    transport = httpx.ASGITransport(app=MedicalWeb.app)
+    clients = {}
+    try:
+        for who, username, password in (("doctor", "DoctorWu", "DDDDDDDD"), ("patient", "Patient", "AAAAAAAA"),
+                                        ("anonymous", None, None)):
+            clients[who] = httpx.AsyncClient(transport=transport, base_url="http://check")
+            if username:
+                await clients[who].post("/login", data={"username": username, "password": password})
+        for who, method, path, body in routes:
+            current["route"] = f"{method} {path.split('?')[0]}"
+            if isinstance(body, dict) and "json" in body:
+                r = await clients[who].request(method, path, json=body["json"])
+            else:
+                r = await clients[who].request(method, path, data=body)
+            if r.status_code >= 400:
+                print(f"warning: {who} {method} {path} -> {r.status_code}", file=sys.stderr)
+            if verbose:
+                print(f"{who:9} {method} {path} -> {r.status_code}")
+            if method == "POST":
+                await asyncio.sleep(0.1)  # detector writes land under the route that caused them
+        MedicalWeb.detector.stop()
+        MedicalWeb.write_queue.stop()
+    finally:
+        current["route"] = None
+        for c in clients.values():
+            await c.aclose()
+        await MedicalWeb.shutdown_db()
+    return seen
+
+
+def check(patients: int, rows: int, verbose: bool = False) -> int:
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, "plans.db")
+    os.environ["MEDICALWEB_DATABASE_URL"] = f"sqlite:///{path}"
+    os.environ.pop("MEDICALWEB_ASYNC_DATABASE_URL", None)
+
+    import migrations
+    import seed
+    from database import Base, SessionLocal, engine
+
+    migrations.upgrade(engine)
+    seed.run()
+    log_id, history_id = _fill(SessionLocal, patients, rows)
+
+    seen = asyncio.run(_run(_routes(log_id, history_id), verbose))
+
+    tables = set(Base.metadata.tables) | {"notes_fts"}
+    conn = sqlite3.connect(path)
+    failures = 0
+    for route, statements in seen.items():
+        checked = set()
+        for statement, params in statements:
+            if statement in checked:
+                continue
+            checked.add(statement)
+            plan = _plan(conn, statement, params)
+            scans = _full_scans(plan, tables)
+            if verbose or scans:
+                print(f"\n{route}\n  {' '.join(statement.split())[:300]}")
+                for detail in plan:
+                    print(f"    {detail}")
+            if scans and route not in EXPECTED_SCANS:
+                failures += 1
+                print(f"  FULL SCAN: {'; '.join(scans)}")
+            elif scans:
+                print(f"  expected: {EXPECTED_SCANS[route]}")
+    conn.close()
+    print(f"\n{len(seen)} routes, {sum(len(set(s for s, _ in v)) for v in seen.values())} statements, "
+          f"{failures} unexpected full scans")
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that every route's queries use an index")
+    parser.add_argument("--patients", type=int, default=200)
+    parser.add_argument("--rows", type=int, default=20, help="logs and histories per patient")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+    sys.exit(1 if check(args.patients, args.rows, args.verbose) else 0)
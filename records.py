@@ -0,0 +1,90 @@
+# records.py
+from typing import Dict, Iterable, List
+
+from sqlalchemy import bindparam, delete, insert, select, update
+from sqlalchemy.orm import Session
+
+import changes
+import tiers
+from models import History, Log, Vital
+from vitals import vital_row
+
+# Id-addressed edits and deletes for logs and histories. Each touches only the
+# target rows (primary-key UPDATE / DELETE ... WHERE id IN), never a patient's
+# whole history. Called from write ops; the writer commits.
+
+
+def _update_contents(db: Session, model, kind: str, contents: Dict[int, str]) -> List[int]:
+    if not contents:
+        return []
+    table = model.__table__
+    existing = db.execute(select(table.c.id, table.c.patient_id).where(table.c.id.in_(list(contents)))).all()
+    if existing:
+        db.execute(
+            update(table).where(table.c.id == bindparam("b_id")).values(content=bindparam("b_content")),
+            [{"b_id": i, "b_content": contents[i]} for i, _ in existing],
+        )
+    for i, patient_id in existing:
+        changes.record(db, kind, "edit", patient_id, id=i, content=contents[i])
+    return [i for i, _ in existing]
+
+
+def _delete_rows(db: Session, model, kind: str, ids: List[int]) -> List[int]:
+    deleted = db.execute(delete(model).where(model.id.in_(ids)).returning(model.id, model.patient_id)).all()
+    for i, patient_id in deleted:
+        changes.record(db, kind, "delete", patient_id, id=i)
+    return [i for i, _ in deleted]
+
+
+# Readings already moved out by tiers.compact() stay out: their edits and
+# deletes rebuild the rollups of the days involved instead
+def update_logs(db: Session, contents: Dict[int, str]) -> List[int]:
+    archived = tiers.archived_readings(db, list(contents)) if contents else {}
+    ids = _update_contents(db, Log, "log", contents)
+    if ids:
+        # re-parse the edited lines into their vitals rows
+        db.execute(delete(Vital).where(Vital.log_id.in_(ids)))
+        rows = db.execute(select(Log.id, Log.patient_id, Log.content, Log.timestamp).where(Log.id.in_(ids))).all()
+        vital_rows = [v for v in (vital_row(*r) for r in rows if r.id not in archived) if v]
+        if vital_rows:
+            db.execute(insert(Vital), vital_rows)
+        if archived:
+            days = {(pid, t.date()) for pid, t in archived.values()}
+            days |= {(v["patient_id"], v["measured_at"].date())
+                     for v in (vital_row(*r) for r in rows if r.id in archived) if v}
+            tiers.rebuild_rollups(db, days)
+    return ids
+
+
+def delete_logs(db: Session, ids: Iterable[int]) -> List[int]:
+    ids = list(ids)
+    if not ids:
+        return []
+    archived = tiers.archived_readings(db, ids)
+    db.execute(delete(Vital).where(Vital.log_id.in_(ids)))
+    deleted = _delete_rows(db, Log, "log", ids)
+    if archived:
+        tiers.rebuild_rollups(db, {(pid, t.date()) for pid, t in archived.values()})
+    return deleted
+
+
+def update_histories(db: Session, contents: Dict[int, str]) -> List[int]:
+    return _update_contents(db, History, "history", contents)
+
+
+def delete_histories(db: Session, ids: Iterable[int]) -> List[int]:
+    ids = list(ids)
+    if not ids:
+        return []
+    return _delete_rows(db, History, "history", ids)
+
+
+# Legacy index addressing: id of the index-th row (oldest first) of a patient's
+# logs or histories, read from the (patient_id, ts) index without loading rows
+def id_at_index(db: Session, model, ts_col, patient_id: int, index: int):
+    if index < 0:
+        return None
+    return db.scalar(
+        select(model.id).where(model.patient_id == patient_id)
+        .order_by(ts_col, model.id).offset(index).limit(1)
+    )
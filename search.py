@@ -0,0 +1,156 @@
+# search.py
+import argparse
+import datetime
+import html
+import itertools
+import time
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+# Full-text index over log and history notes: one SQLite FTS5 table, where
+# rowid = id * 2 for logs and id * 2 + 1 for histories, so an edit or delete
+# touches its index row by rowid. The index is updated from the same change
+# list the write ops record, inside their transaction (before_commit), so it
+# can never disagree with the rows it indexes.
+
+FTS_TABLE = "notes_fts"
+KINDS = {"log": 0, "history": 1}
+_KIND_OF = {v: k for k, v in KINDS.items()}
+TS_FORMAT = "%Y-%m-%d %H:%M:%S.%f"  # same text SQLAlchemy stores for DateTime on SQLite
+
+_CREATE = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+    "content, patient_id UNINDEXED, ts UNINDEXED, tokenize = 'unicode61 remove_diacritics 2')"
+)
+_MARK_OPEN, _MARK_CLOSE = "\x02", "\x03"
+
+
+def _rowid(kind: str, source_id: int) -> int:
+    return source_id * 2 + KINDS[kind]
+
+
+def _ts(value) -> Optional[str]:
+    return value.strftime(TS_FORMAT) if isinstance(value, datetime.datetime) else value
+
+
+def is_supported(bind) -> bool:
+    return bind.dialect.name == "sqlite"
+
+
+def index_exists(conn) -> bool:
+    return conn.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (FTS_TABLE,)
+    ).first() is not None
+
+
+# Rebuild the whole index from logs and histories (one INSERT ... SELECT each)
+def rebuild(conn) -> int:
+    conn.exec_driver_sql(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+    conn.exec_driver_sql(_CREATE)
+    conn.exec_driver_sql(
+        f"INSERT INTO {FTS_TABLE} (rowid, content, patient_id, ts) "
+        f"SELECT id * 2, content, patient_id, timestamp FROM logs WHERE content IS NOT NULL"
+    )
+    conn.exec_driver_sql(
+        f"INSERT INTO {FTS_TABLE} (rowid, content, patient_id, ts) "
+        f"SELECT id * 2 + 1, content, patient_id, created_at FROM histories WHERE content IS NOT NULL"
+    )
+    conn.exec_driver_sql(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')")
+    return conn.exec_driver_sql(f"SELECT count(*) FROM {FTS_TABLE}").scalar()
+
+
+# Create the index on first start, filled from whatever data already exists
+def ensure_index(engine):
+    if not is_supported(engine):
+        return
+    with engine.begin() as conn:
+        if not index_exists(conn):
+            rebuild(conn)
+
+
+_SYNC_SQL = {
+    "add": f"INSERT INTO {FTS_TABLE} (rowid, content, patient_id, ts) VALUES (:r, :content, :pid, :ts)",
+    "edit": f"UPDATE {FTS_TABLE} SET content = :content WHERE rowid = :r",
+    "delete": f"DELETE FROM {FTS_TABLE} WHERE rowid = :r",
+}
+
+
+@event.listens_for(Session, "before_commit")
+def _sync_index(session: Session):
+    notes = [c for c in session.info.get("changes", ()) if c["kind"] in KINDS]
+    if not notes:
+        return
+    conn = session.connection()
+    if not is_supported(conn):
+        return
+    # in commit order, one executemany per run of the same action
+    for action, run in itertools.groupby(notes, key=lambda c: c["action"]):
+        params = [{"r": _rowid(c["kind"], c["id"]), "content": c.get("content"), "pid": c["patient_id"],
+                   "ts": _ts(c.get("timestamp"))} for c in run]
+        conn.execute(text(_SYNC_SQL[action]), params)
+
+
+# User text -> FTS5 query: every word must match; "word*" is a prefix search.
+# Quoting each term keeps FTS syntax characters from turning into errors.
+def to_match(q: str) -> str:
+    terms = []
+    for word in q.split():
+        prefix = word.endswith("*")
+        word = word.rstrip("*").replace('"', '""')
+        if word:
+            terms.append(f'"{word}"' + ("*" if prefix else ""))
+    return " ".join(terms)
+
+
+def _highlight(snippet: str) -> str:
+    escaped = html.escape(snippet)
+    return escaped.replace(_MARK_OPEN, "<mark>").replace(_MARK_CLOSE, "</mark>")
+
+
+# Ranked (bm25) matches with highlighted snippets
+def search(db: Session, q: str, patient_ids: Optional[List[int]] = None, since: Optional[datetime.date] = None,
+           until: Optional[datetime.date] = None, kind: Optional[str] = None, limit: int = 20,
+           offset: int = 0) -> Dict[str, Any]:
+    match = to_match(q)
+    if not match:
+        return {"results": [], "took_ms": 0.0}
+    where = [f"{FTS_TABLE} MATCH :match"]
+    params: Dict[str, Any] = {"match": match, "limit": limit, "offset": offset}
+    if patient_ids is not None:
+        where.append(f"patient_id IN ({','.join(str(int(p)) for p in patient_ids) or 'NULL'})")
+    if since:
+        where.append("ts >= :since")
+        params["since"] = since.strftime("%Y-%m-%d")
+    if until:
+        where.append("ts < :until")
+        params["until"] = (until + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+    if kind:
+        where.append("rowid % 2 = :kind")
+        params["kind"] = KINDS[kind]
+    sql = (
+        f"SELECT rowid, patient_id, ts, snippet({FTS_TABLE}, 0, '{_MARK_OPEN}', '{_MARK_CLOSE}', '…', 16), "
+        f"bm25({FTS_TABLE}) FROM {FTS_TABLE} WHERE {' AND '.join(where)} ORDER BY rank LIMIT :limit OFFSET :offset"
+    )
+    started = time.perf_counter()
+    rows = db.execute(text(sql), params).all()
+    took = (time.perf_counter() - started) * 1000
+    results = [
+        {"kind": _KIND_OF[rowid % 2], "id": rowid // 2, "patient_id": pid, "time": ts,
+         "snippet": _highlight(snip), "score": round(-score, 3)}
+        for rowid, pid, ts, snip, score in rows
+    ]
+    return {"results": results, "took_ms": round(took, 2)}
+
+
+if __name__ == "__main__":
+    from database import engine
+
+    parser = argparse.ArgumentParser(description="Full-text search index")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("rebuild", help="rebuild the index from all logs and histories")
+    args = parser.parse_args()
+    if args.command == "rebuild":
+        with engine.begin() as conn:
+            print(f"indexed {rebuild(conn)} notes")
@@ -0,0 +1,60 @@
+# seed.py
+import argparse
+
+from sqlalchemy.orm import Session
+
+import changes
+import search  # noqa: F401  (its before_commit hook indexes the seeded notes)
+from database import SessionLocal
+from models import Doctor, History, Log, Patient, PatientModule
+from vitals import record_vitals, vitals_of
+
+
+# Sample patient, notes and doctor for a fresh database. Does nothing once any
+# patient exists, so it is safe to run on every deploy.
+def seed(db: Session) -> bool:
+    if db.query(Patient.id).first() is not None:
+        return False
+    p_liao = Patient(name="Liao")
+    db.add(p_liao)
+    db.add(PatientModule(patient=p_liao, name="Heart Monitoring Model"))
+    histories = [
+        History(content="2025-08-01: Diagnosis - Heart check normal", patient=p_liao),
+        History(content="2025-08-15: ECG - Minor arrhythmia", patient=p_liao)
+    ]
+    db.add_all(histories)
+    logs = [
+        Log(content="2025-09-01: Heart rate 72", patient=p_liao),
+        Log(content="2025-09-02: Heart rate 75", patient=p_liao),
+        Log(content="2025-09-03: Heart rate 80", patient=p_liao),
+        Log(content="2025-10-29: Heart rate 76", patient=p_liao)
+    ]
+    db.add_all(logs)
+    if db.query(Doctor.id).first() is None:
+        db.add(Doctor(name="Doctor Wu"))
+    db.flush()
+    for log in logs:
+        record_vitals(log)
+    db.flush()
+    # recorded like any other write, so the search index picks the notes up
+    for h in histories:
+        changes.record(db, "history", "add", p_liao.id, patient=p_liao.name, id=h.id, content=h.content,
+                       timestamp=h.created_at)
+    for log in logs:
+        changes.record(db, "log", "add", p_liao.id, patient=p_liao.name, id=log.id, content=log.content,
+                       timestamp=log.timestamp, vitals=vitals_of(log.vitals))
+    db.commit()
+    return True
+
+
+def run() -> bool:
+    db = SessionLocal()
+    try:
+        return seed(db)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    argparse.ArgumentParser(description="Seed sample data into an empty database").parse_args()
+    print("seeded sample data" if run() else "database already has patients, nothing to seed")
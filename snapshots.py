@@ -0,0 +1,324 @@
+# snapshots.py
+import argparse
+import datetime
+import gzip
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import orjson
+from sqlalchemy import select
+from sqlalchemy.orm import Session, aliased
+
+from database import upsert, upsert_supported
+from models import History, Log, Patient, PatientGeneration, ReportSnapshot
+from statecache import load_states
+
+try:
+    import brotli
+except ImportError:  # optional; gzip only without it
+    brotli = None
+
+# Materialized per-patient reports for /api/reports. A snapshot is the
+# patient's report (metrics, last log, modules, newest SNAPSHOT_ROWS logs and
+# histories) serialized once with orjson and stored as a blob, stamped with
+# the patient's data generation it was read at. Every commit that touches a
+# patient moves that generation on (changes.py), so a snapshot is current
+# exactly when its generation matches - checked in the same query that reads
+# the blob, from any worker, whoever made the change.
+#
+# After a local write the builder thread rebuilds the touched patients'
+# snapshots in the background; a reader that still finds one missing or
+# behind builds it inline (and hands it to the builder to store), so a stale
+# report is never served.
+#
+#   python snapshots.py rebuild            build every patient's snapshot
+#   python snapshots.py rebuild --stale    only missing / out-of-date ones
+SNAPSHOT_ROWS = int(os.environ.get("MEDICALWEB_SNAPSHOT_ROWS", "50"))
+BUILD_BATCH = 200  # patients per build query round
+BUILD_WAIT = 0.2  # seconds the builder lets changes pile up
+COMPRESS_MIN_BYTES = 1024
+
+# report fields a client can select (?fields=metrics,logs); "patient" is always sent
+FIELDS = ("metrics", "last_log", "modules", "logs", "history", "built_at")
+
+log = logging.getLogger(__name__)
+
+
+def _generations(db: Session, patient_ids: List[int]) -> Dict[int, int]:
+    return dict(db.execute(select(PatientGeneration.patient_id, PatientGeneration.generation)
+                           .where(PatientGeneration.patient_id.in_(patient_ids))).all())
+
+
+# patient_id -> newest `rows` (id, ts, content) of the model, newest first, in
+# one query: each patient's ids come from a LIMIT seek on its (patient_id, ts)
+# index, like queries.latest_log_id_for
+def _newest(db: Session, model, ts_col, content_col, patient_ids: List[int], rows: int) -> Dict[int, List[Tuple]]:
+    newer = aliased(model)
+    newest_ids = (
+        select(newer.id)
+        .where(newer.patient_id == Patient.id)
+        .order_by(getattr(newer, ts_col.key).desc(), newer.id.desc())
+        .limit(rows)
+    )
+    stmt = (
+        select(model.patient_id, model.id, ts_col, content_col)
+        .join(Patient, model.id.in_(newest_ids))
+        .where(Patient.id.in_(patient_ids))
+        .order_by(model.patient_id, ts_col.desc(), model.id.desc())
+    )
+    out: Dict[int, List[Tuple]] = {}
+    for pid, i, ts, content in db.execute(stmt).all():
+        out.setdefault(pid, []).append((i, ts, content))
+    return out
+
+
+# {patient_id: (generation, body)} read from the current rows. The generation
+# is read first in the same transaction, so a change racing the build leaves
+# the snapshot stamped older than the data it missed.
+def build(db: Session, patient_ids: Iterable[int], rows: int = SNAPSHOT_ROWS) -> Dict[int, Tuple[int, bytes]]:
+    ids = list(patient_ids)
+    out: Dict[int, Tuple[int, bytes]] = {}
+    for i in range(0, len(ids), BUILD_BATCH):
+        part = ids[i:i + BUILD_BATCH]
+        generations = _generations(db, part)
+        states = load_states(db, part)
+        now = datetime.datetime.now().replace(microsecond=0)
+        logs = _newest(db, Log, Log.timestamp, Log.content, part, rows)
+        history = _newest(db, History, History.created_at, History.content, part, rows)
+        for pid, state in states.items():
+            body = {
+                "patient": state["name"],
+                "metrics": state["metrics"],
+                "last_log": state["last_log"],
+                "modules": state["modules"],
+                "logs": [{"id": i, "timestamp": ts, "content": c} for i, ts, c in logs.get(pid, [])],
+                "history": [{"id": i, "timestamp": ts, "summary": c} for i, ts, c in history.get(pid, [])],
+                "built_at": now,
+            }
+            out[pid] = (generations.get(pid, 0), orjson.dumps(body))
+        db.rollback()  # end the read transaction between rounds
+    return out
+
+
+# Write built snapshots; an older build never replaces a newer one.
+# Called from a write op; the writer commits.
+def store(db: Session, built: Dict[int, Tuple[int, bytes]]):
+    if not built or not upsert_supported(db.connection()):
+        return  # reports are then built per request
+    stmt = upsert(db.connection(), ReportSnapshot)
+    ex = stmt.excluded
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["patient_id"],
+        set_={"generation": ex.generation, "built_at": ex.built_at, "body": ex.body},
+        where=ReportSnapshot.generation <= ex.generation,
+    )
+    now = datetime.datetime.now()
+    db.execute(stmt, [{"patient_id": pid, "generation": g, "built_at": now, "body": body}
+                      for pid, (g, body) in built.items()])
+
+
+# {patient_id: body} of the snapshots that are current; missing or stale
+# patients are left out
+def read(db: Session, patient_ids: List[int]) -> Dict[int, bytes]:
+    if not patient_ids:
+        return {}
+    stmt = (
+        select(ReportSnapshot.patient_id, ReportSnapshot.generation, PatientGeneration.generation, ReportSnapshot.body)
+        .outerjoin(PatientGeneration, PatientGeneration.patient_id == ReportSnapshot.patient_id)
+        .where(ReportSnapshot.patient_id.in_(patient_ids))
+    )
+    return {pid: body for pid, built, current, body in db.execute(stmt).all() if built >= (current or 0)}
+
+
+# Patients whose snapshot is missing or behind their data
+def stale(db: Session) -> List[int]:
+    stmt = (
+        select(Patient.id)
+        .outerjoin(ReportSnapshot, ReportSnapshot.patient_id == Patient.id)
+        .outerjoin(PatientGeneration, PatientGeneration.patient_id == Patient.id)
+        .where((ReportSnapshot.patient_id.is_(None)) | (ReportSnapshot.generation < PatientGeneration.generation))
+        .order_by(Patient.id)
+    )
+    return list(db.scalars(stmt).all())
+
+
+# JSON document {"<key>": {name: report, ...}, **extra} from stored bodies. With
+# no field selection the blobs are spliced in as they are, without parsing.
+def render(bodies: List[Tuple[str, bytes]], fields: Optional[List[str]] = None,
+           extra: Optional[Dict[str, Any]] = None, key: str = "reports",
+           merge: Optional[Dict[str, Dict[str, Any]]] = None) -> bytes:
+    if fields is None and not merge:
+        parts = [orjson.dumps(name) + b":" + body for name, body in bodies]
+        doc = b'{"' + key.encode() + b'":{' + b",".join(parts) + b"}"
+    else:
+        reports = {}
+        for name, body in bodies:
+            report = orjson.loads(body)
+            if fields is not None:
+                report = {k: report[k] for k in ("patient", *fields) if k in report}
+            if merge and name in merge:
+                report.update(merge[name])
+            reports[name] = report
+        doc = orjson.dumps({key: reports})[:-1]
+    if extra:
+        doc += b"," + orjson.dumps(extra)[1:-1]
+    return doc + b"}"
+
+
+# ?fields=metrics,logs -> ["metrics", "logs"] (None = everything); unknown
+# names raise ValueError. `also` are extra names the caller handles itself.
+def parse_fields(text: Optional[str], also: Tuple[str, ...] = ()) -> Optional[List[str]]:
+    if not text:
+        return None
+    names = [f.strip() for f in text.split(",") if f.strip()]
+    unknown = [f for f in names if f not in FIELDS and f not in also]
+    if unknown:
+        raise ValueError(f"unknown fields {unknown}, expected some of {list(FIELDS + also)}")
+    return names
+
+
+# Content-Encoding for the client's Accept-Encoding: brotli when available
+# and accepted, else gzip, else None
+def negotiate(accept_encoding: str) -> Optional[str]:
+    accepted = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.partition(";")
+        params = params.strip()
+        try:
+            accepted[name.strip()] = float(params[2:]) if params.startswith("q=") else 1.0
+        except ValueError:
+            accepted[name.strip()] = 0.0
+    if brotli is not None and accepted.get("br", 0) > 0:
+        return "br"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+
+# (body, Content-Encoding or None); small bodies are sent as they are
+def compress(body: bytes, encoding: Optional[str]) -> Tuple[bytes, Optional[str]]:
+    if encoding is None or len(body) < COMPRESS_MIN_BYTES:
+        return body, None
+    if encoding == "br":
+        return brotli.compress(body, quality=4), "br"
+    return gzip.compress(body, compresslevel=5), "gzip"
+
+
+# Rebuilds the snapshots of patients changed by this process off the request
+# path and stores them through the write queue (submit(op) -> future)
+class SnapshotBuilder:
+    def __init__(self, session_factory, submit: Callable, wait: float = BUILD_WAIT):
+        self.session_factory = session_factory
+        self.submit = submit
+        self.wait = wait
+        self._dirty: set = set()
+        self._built: Dict[int, Tuple[int, bytes]] = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+        self.stats = {"queued": 0, "built": 0, "stored": 0, "failed": 0}
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="report-snapshots", daemon=True)
+            self._thread.start()
+
+    # Build and store what is already queued, then stop
+    def stop(self, timeout: float = 10.0):
+        with self._cond:
+            if not self._running:
+                return
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+    # changes.subscribe() listener (local_only: the committing process rebuilds)
+    def apply(self, changes: List[Dict[str, Any]]):
+        ids = {c["patient_id"] for c in changes if c["patient_id"] is not None}
+        if ids:
+            self._queue(ids, {})
+
+    # Snapshots a reader built inline, to be stored
+    def keep(self, built: Dict[int, Tuple[int, bytes]]):
+        if built:
+            self._queue((), built)
+
+    def _queue(self, ids: Iterable[int], built: Dict[int, Tuple[int, bytes]]):
+        self.start()
+        with self._cond:
+            for pid in ids:
+                self._dirty.add(pid)
+                self._built.pop(pid, None)  # rebuilt anyway
+                self.stats["queued"] += 1
+            for pid, snap in built.items():
+                if pid not in self._dirty:
+                    self._built[pid] = snap
+                    self.stats["queued"] += 1
+            self._cond.notify()
+
+    def _take(self) -> Optional[Tuple[List[int], Dict[int, Tuple[int, bytes]]]]:
+        with self._cond:
+            while self._running and not self._dirty and not self._built:
+                self._cond.wait()
+            if not self._dirty and not self._built:
+                return None
+        if self._running:
+            time.sleep(self.wait)  # let a burst of writes coalesce
+        with self._cond:
+            dirty, self._dirty = sorted(self._dirty), set()
+            built, self._built = self._built, {}
+            return dirty, built
+
+    def _run(self):
+        while True:
+            work = self._take()
+            if work is None:
+                return
+            dirty, built = work
+            try:
+                if dirty:
+                    db = self.session_factory()
+                    try:
+                        built.update(build(db, dirty))
+                    finally:
+                        db.close()
+                    self.stats["built"] += len(dirty)
+                self.submit(lambda db: store(db, built)).result()
+                self.stats["stored"] += len(built)
+            except Exception:
+                # readers rebuild inline whatever was not stored
+                self.stats["failed"] += 1
+                log.exception("report snapshot rebuild failed")
+
+
+def rebuild(session_factory, only_stale: bool = False, batch: int = 1000) -> int:
+    db = session_factory()
+    try:
+        ids = stale(db) if only_stale else list(db.scalars(select(Patient.id).order_by(Patient.id)).all())
+        for i in range(0, len(ids), batch):
+            built = build(db, ids[i:i + batch])
+            store(db, built)
+            db.commit()
+        return len(ids)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    from database import SessionLocal
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(description="Materialized report snapshots")
+    sub = parser.add_subparsers(dest="command", required=True)
+    r = sub.add_parser("rebuild", help="build report snapshots")
+    r.add_argument("--stale", action="store_true", help="only missing or out-of-date snapshots")
+    args = parser.parse_args()
+    started = time.perf_counter()
+    n = rebuild(SessionLocal, args.stale)
+    print(f"built {n} snapshots in {time.perf_counter() - started:.1f}s")
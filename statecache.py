@@ -0,0 +1,198 @@
+# statecache.py
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional
+
+import orjson
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+import metrics
+from models import Patient
+from queries import latest_homecare, latest_logs, modules_of
+from vitals import metrics_from_vital
+
+STATE_CACHE_ENTRIES = int(os.environ.get("MEDICALWEB_STATE_CACHE_ENTRIES", "10000"))
+STATE_CACHE_BYTES = int(os.environ.get("MEDICALWEB_STATE_CACHE_BYTES", "0"))  # 0 = no byte cap
+
+
+def _homecare_info(r) -> Optional[Dict[str, Any]]:
+    if r is None:
+        return None
+    return {"requested_at": r.requested_at.strftime("%Y-%m-%d %H:%M:%S"), "status": r.status, "reason": r.reason,
+            "note": r.note}
+
+
+# Derived per-patient state the dashboards show:
+#   {"patient_id", "name", "metrics", "last_log", "last_log_key": (timestamp, id) | None,
+#    "homecare": latest request info | None, "modules": [...]}
+# Loaded in a fixed number of queries for any number of patients.
+@metrics.timed("patient_states")
+def load_states(db: Session, patient_ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+    ids = list(patient_ids)
+    if not ids:
+        return {}
+    names = dict(db.execute(select(Patient.id, Patient.name).where(Patient.id.in_(ids))).all())
+    logs = latest_logs(db, names)
+    requests = latest_homecare(db, names)
+    modules = modules_of(db, names.values())
+    states = {}
+    for pid, name in names.items():
+        last = logs.get(pid)
+        states[pid] = {
+            "patient_id": pid,
+            "name": name,
+            "metrics": metrics_from_vital(last.vitals if last else None),
+            "last_log": last.content if last else None,
+            "last_log_key": (last.timestamp, last.id) if last else None,
+            "homecare": _homecare_info(requests.get(pid)),
+            "modules": list(modules.get(name, [])),
+        }
+    return states
+
+
+# Bounded LRU of patient states, kept current from the committed-change feed:
+# a new newest log or homecare request is written into the cached entry,
+# anything that can't be applied in place (edits, deletes, emergencies) drops
+# the entry so the next read reloads it. A load that raced with a change to
+# the same patient is not cached.
+class StateCache:
+    def __init__(self, max_entries: int = STATE_CACHE_ENTRIES, max_bytes: int = STATE_CACHE_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._sizes: Dict[int, int] = {}
+        self._bytes = 0
+        self._ids: Dict[str, int] = {}
+        self._changed: Dict[int, int] = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "updates": 0, "invalidations": 0}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def bytes(self) -> int:
+        return self._bytes
+
+    def generation(self) -> int:
+        return self._generation
+
+    def patient_id(self, name: str) -> Optional[int]:
+        return self._ids.get(name)
+
+    # Cached states for ids; the ones not returned are misses
+    def get_many(self, patient_ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+        found = {}
+        with self._lock:
+            for pid in patient_ids:
+                state = self._entries.get(pid)
+                if state is None:
+                    self.stats["misses"] += 1
+                    continue
+                self._entries.move_to_end(pid)
+                self.stats["hits"] += 1
+                found[pid] = state
+        return found
+
+    # Store states loaded from a snapshot taken at `generation`
+    def put_many(self, states: Dict[int, Dict[str, Any]], generation: int):
+        with self._lock:
+            for pid, state in states.items():
+                self._ids[state["name"]] = pid
+                if self._changed.get(pid, 0) > generation:
+                    continue
+                self._store(pid, state)
+            self._evict()
+
+    def invalidate(self, patient_id: int):
+        with self._lock:
+            self._generation += 1
+            self._changed[patient_id] = self._generation
+            self._discard(patient_id)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._sizes.clear()
+            self._bytes = 0
+            # loads started before the clear must not come back
+            self._changed = {pid: self._generation for pid in self._ids.values()}
+
+    # changes.subscribe() listener (runs in the committing thread)
+    def apply(self, changes: List[Dict[str, Any]]):
+        with self._lock:
+            for c in changes:
+                pid = c["patient_id"]
+                if c.get("patient"):
+                    self._ids[c["patient"]] = pid
+                self._generation += 1
+                self._changed[pid] = self._generation
+                state = self._entries.get(pid)
+                if state is None:
+                    continue
+                updated = self._updated(state, c)
+                if updated is None:
+                    self._discard(pid)
+                    self.stats["invalidations"] += 1
+                elif updated is not state:
+                    self._store(pid, updated)
+                    self.stats["updates"] += 1
+            self._evict()
+
+    # New state for an in-place change, the same state if it is unaffected,
+    # None if it has to be reloaded
+    def _updated(self, state: Dict[str, Any], c: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        if c["kind"] == "log" and c["action"] == "add" and c.get("timestamp") is not None:
+            key = (c["timestamp"], c["id"])
+            if state["last_log_key"] is not None and key < state["last_log_key"]:
+                return state
+            return {**state, "last_log": c["content"], "last_log_key": key,
+                    "metrics": metrics_from_vital(c.get("vitals"))}
+        if c["kind"] == "homecare" and c["action"] == "add" and c.get("requested_at") is not None:
+            info = {"requested_at": c["requested_at"].strftime("%Y-%m-%d %H:%M:%S"),
+                    "status": c["status"], "reason": c["reason"], "note": None}
+            return {**state, "homecare": info}
+        if c["kind"] == "modules":
+            return {**state, "modules": list(c["modules"])}
+        if c["kind"] == "history":
+            return state
+        return None
+
+    def _store(self, pid: int, state: Dict[str, Any]):
+        self._discard(pid)
+        size = len(orjson.dumps(state))
+        self._entries[pid] = state
+        self._sizes[pid] = size
+        self._bytes += size
+
+    def _discard(self, pid: int):
+        if self._entries.pop(pid, None) is not None:
+            self._bytes -= self._sizes.pop(pid)
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries
+                                 or (self.max_bytes and self._bytes > self.max_bytes)):
+            pid, _ = self._entries.popitem(last=False)
+            self._bytes -= self._sizes.pop(pid)
+            self.stats["evictions"] += 1
+
+
+patient_states = StateCache()
+
+
+# States for the given patients: memory first, one batched load for the misses
+async def get_states(db: AsyncSession, patient_ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+    ids = list(patient_ids)
+    states = patient_states.get_many(ids)
+    missing = [pid for pid in ids if pid not in states]
+    if missing:
+        generation = patient_states.generation()
+        loaded = await db.run_sync(load_states, missing)
+        patient_states.put_many(loaded, generation)
+        states.update(loaded)
+    return states
@@ -0,0 +1,56 @@
+# tests/conftest.py
+import os
+import sys
+import tempfile
+import uuid
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# One throwaway SQLite file for the whole run. database.py reads the URL when
+# it is imported, so this has to happen before any app module is loaded.
+_TMP = tempfile.mkdtemp(prefix="medicalweb-tests-")
+DB_PATH = os.path.join(_TMP, "test.db")
+os.environ["MEDICALWEB_DATABASE_URL"] = f"sqlite:///{DB_PATH}"
+os.environ["MEDICALWEB_WARM_TRENDS"] = "0"
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)  # templates/ and static/ are found relative to the app
+
+import database  # noqa: E402
+import migrations  # noqa: E402
+
+migrations.upgrade(database.engine)
+
+
+@pytest.fixture
+def db():
+    session = database.SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+# A new patient per test (the database is shared by the whole run)
+@pytest.fixture
+def patient(db):
+    from models import Patient
+
+    p = Patient(name=f"T{uuid.uuid4().hex[:10]}")
+    db.add(p)
+    db.commit()
+    return p
+
+
+# The app with its lifespan running, logged in as the built-in doctor
+@pytest.fixture(scope="session")
+def doctor():
+    from fastapi.testclient import TestClient
+
+    import MedicalWeb
+
+    with TestClient(MedicalWeb.app) as client:
+        r = client.post("/login", data={"username": "DoctorWu", "password": "DDDDDDDD"}, follow_redirects=False)
+        assert r.status_code == 302
+        yield client
@@ -0,0 +1,65 @@
+# tests/test_detector.py
+import datetime
+
+import pytest
+from sqlalchemy import select
+
+import database
+from detector import EmergencyDetector
+from models import EmergencyEvent
+from writer import WriteBehindQueue
+
+
+@pytest.fixture
+def queue():
+    q = WriteBehindQueue(database.SessionLocal)
+    yield q
+    q.stop()
+
+
+def _reading(patient_id, minutes_ago, **values):
+    t = (datetime.datetime.now() - datetime.timedelta(minutes=minutes_ago)).replace(second=0, microsecond=0)
+    return {"kind": "log", "action": "add", "patient_id": patient_id, "timestamp": t,
+            "content": f"{t:%Y-%m-%d %H:%M}: reading", "vitals": {**values, "measured_at": t}}
+
+
+# Feed each batch separately and wait for it to be evaluated, then for the
+# alerts to commit
+def _run(detector, queue, *batches):
+    for batch in batches:
+        detector.apply(batch)
+        detector.stop()
+    queue.stop()
+
+
+def _events(db, patient_id):
+    return list(db.scalars(select(EmergencyEvent.event).where(EmergencyEvent.patient_id == patient_id)
+                           .order_by(EmergencyEvent.id)))
+
+
+def test_rise_is_detected_across_batches(db, patient, queue):
+    detector = EmergencyDetector(queue.submit_threadsafe)
+    _run(detector, queue, [_reading(patient.id, 6, heart_rate=70)], [_reading(patient.id, 1, heart_rate=115)])
+    assert detector.stats["batches"] == 2
+    assert _events(db, patient.id) == ["心率驟升 (heart_rate 70 → 115 bpm)"]
+
+
+def test_fall_outside_its_window_is_not_an_alert(db, patient, queue):
+    detector = EmergencyDetector(queue.submit_threadsafe)
+    _run(detector, queue, [_reading(patient.id, 30, bp_systolic=150, bp_diastolic=90)],
+         [_reading(patient.id, 5, bp_systolic=100, bp_diastolic=70)])
+    assert _events(db, patient.id) == []
+
+
+def test_repeat_within_dedupe_window_is_suppressed(db, patient, queue):
+    detector = EmergencyDetector(queue.submit_threadsafe)
+    _run(detector, queue, [_reading(patient.id, 3, heart_rate=150)], [_reading(patient.id, 2, heart_rate=155)])
+    assert detector.stats["suppressed"] == 1
+    assert _events(db, patient.id) == ["心率過高 (heart_rate 150 bpm)"]
+
+
+def test_old_reading_is_backfill(db, patient, queue):
+    detector = EmergencyDetector(queue.submit_threadsafe)
+    _run(detector, queue, [_reading(patient.id, 24 * 60, heart_rate=180)])
+    assert detector.stats["skipped_old"] == 1
+    assert _events(db, patient.id) == []
@@ -0,0 +1,42 @@
+# tests/test_homecare.py
+import homecare
+from models import HomecareRequest
+
+
+def _request(db, patient, status="pending"):
+    r = HomecareRequest(patient_id=patient.id, reason="needs home visits", status=status)
+    db.add(r)
+    db.commit()
+    return r.id
+
+
+def test_transition_reports_conflicts_and_missing_ids(db, patient):
+    fresh = _request(db, patient)
+    stale = _request(db, patient)
+    approved = _request(db, patient, "approved")
+
+    result = homecare.transition(db, [(fresh, 0), (stale, 3), (approved, 0), (999999, 0)], "approved", "DoctorWu")
+    db.commit()
+
+    assert result["updated"] == [{"id": fresh, "status": "approved", "version": 1}]
+    assert sorted(result["conflicts"], key=lambda c: c["id"]) == [
+        {"id": stale, "status": "pending", "version": 0},
+        {"id": approved, "status": "approved", "version": 0},
+    ]
+    assert result["missing"] == [999999]
+    row = db.get(HomecareRequest, fresh)
+    assert (row.status, row.version, row.reviewed_by) == ("approved", 1, "DoctorWu")
+    assert db.get(HomecareRequest, stale).status == "pending"
+
+
+def test_second_doctor_gets_409_with_the_current_state(doctor, db, patient):
+    rid = _request(db, patient)
+
+    first = doctor.post("/api/homecare/transition", json={"status": "approved", "items": [{"id": rid, "version": 0}]})
+    assert first.status_code == 200
+    assert first.json()["updated"] == [{"id": rid, "status": "approved", "version": 1}]
+
+    second = doctor.post("/api/homecare/transition", json={"status": "rejected", "items": [{"id": rid, "version": 0}]})
+    assert second.status_code == 409
+    assert second.json()["conflicts"] == [{"id": rid, "status": "approved", "version": 1}]
+    assert second.json()["updated"] == []
@@ -0,0 +1,32 @@
+# tests/test_statecache.py
+import datetime
+
+from statecache import StateCache, load_states
+
+
+def _log_added(patient_id, content):
+    return {"kind": "log", "action": "add", "patient_id": patient_id, "id": 1, "content": content,
+            "timestamp": datetime.datetime.now(), "vitals": {}}
+
+
+def test_load_that_raced_a_change_is_not_cached(db, patient):
+    cache = StateCache()
+    generation = cache.generation()
+    loaded = load_states(db, [patient.id])
+    cache.apply([_log_added(patient.id, "written during the load")])
+    cache.put_many(loaded, generation)
+    assert cache.get_many([patient.id]) == {}
+
+    # loaded after the change: kept
+    generation = cache.generation()
+    cache.put_many(load_states(db, [patient.id]), generation)
+    assert cache.get_many([patient.id])[patient.id]["name"] == patient.name
+
+
+def test_change_to_another_patient_does_not_block_the_load(db, patient):
+    cache = StateCache()
+    generation = cache.generation()
+    loaded = load_states(db, [patient.id])
+    cache.apply([_log_added(patient.id + 1000000, "someone else")])
+    cache.put_many(loaded, generation)
+    assert patient.id in cache.get_many([patient.id])
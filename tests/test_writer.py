@@ -0,0 +1,95 @@
+# tests/test_writer.py
+import threading
+
+import pytest
+from sqlalchemy import create_engine, event, select
+from sqlalchemy.orm import sessionmaker
+
+import database
+from models import Log
+from writer import QueueFull, WriteBehindQueue
+
+
+def _add_log(patient_id, text):
+    def op(db):
+        db.add(Log(patient_id=patient_id, content=text))
+    return op
+
+
+def _contents(db, patient_id):
+    return sorted(db.scalars(select(Log.content).where(Log.patient_id == patient_id)))
+
+
+def test_failed_op_in_a_group_is_replayed_alone(db, patient):
+    q = WriteBehindQueue(database.SessionLocal, flush_interval=0.2)
+
+    def bad(session):
+        session.add(Log(patient_id=patient.id, content="bad"))
+        raise ValueError("boom")
+
+    try:
+        futures = [q.submit_threadsafe(_add_log(patient.id, "a")), q.submit_threadsafe(bad),
+                   q.submit_threadsafe(_add_log(patient.id, "b"))]
+        futures[0].result(5)
+        futures[2].result(5)
+        with pytest.raises(ValueError):
+            futures[1].result(5)
+    finally:
+        q.stop()
+    assert q.stats["replays"] == 1
+    assert q.stats["failed"] == 1
+    assert _contents(db, patient.id) == ["a", "b"]
+
+
+def test_full_queue_rejects_normal_ops_but_not_urgent_ones(db, patient):
+    q = WriteBehindQueue(database.SessionLocal, max_pending=1, put_timeout=0.05)
+    release = threading.Event()
+    try:
+        blocker = q.submit_threadsafe(lambda session: release.wait(5))
+        with pytest.raises(QueueFull):
+            q.submit_threadsafe(_add_log(patient.id, "rejected"))
+        urgent = q.submit_threadsafe(_add_log(patient.id, "urgent"), urgent=True)
+        release.set()
+        blocker.result(5)
+        urgent.result(5)
+    finally:
+        release.set()
+        q.stop()
+    assert q.stats["rejected"] == 1
+    assert _contents(db, patient.id) == ["urgent"]
+
+
+def test_full_queue_answers_503(doctor, monkeypatch, db, patient):
+    import MedicalWeb
+
+    q = WriteBehindQueue(database.SessionLocal, max_pending=1, put_timeout=0.05)
+    release = threading.Event()
+    blocker = q.submit_threadsafe(lambda session: release.wait(5))
+    monkeypatch.setattr(MedicalWeb, "write_queue", q)
+    try:
+        r = doctor.post(f"/add_log/{patient.name}", data={"log_text": "Heart rate 80"}, follow_redirects=False)
+    finally:
+        release.set()
+        blocker.result(5)
+        q.stop()
+    assert r.status_code == 503
+    assert r.headers["retry-after"] == "1"
+    assert _contents(db, patient.id) == []
+
+
+def test_urgent_lane_puts_synchronous_back():
+    # one pooled connection, so both ops run on the same SQLite connection
+    engine = create_engine(database.DATABASE_URL, pool_size=1, max_overflow=0)
+    event.listen(engine, "connect", database._apply_sqlite_pragmas)
+    q = WriteBehindQueue(sessionmaker(bind=engine))
+
+    def level(session):
+        return session.connection().exec_driver_sql("PRAGMA synchronous").scalar()
+
+    try:
+        assert q.submit_threadsafe(level, urgent=True).result(5) == 2  # FULL
+        assert q.submit_threadsafe(level).result(5) == 1  # NORMAL again
+    finally:
+        q.stop()
+        engine.dispose()
+    assert q.stats["urgent_commits"] == 1
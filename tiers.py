@@ -0,0 +1,463 @@
+# tiers.py
+import argparse
+import datetime
+import gzip
+import os
+import uuid
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import orjson
+from sqlalchemy import delete, func, select
+from sqlalchemy.orm import Session
+
+import changes
+from database import upsert, upsert_supported
+from models import ArchiveSegment, Log, Patient, Vital, VitalRollup
+from vitals import parse_measured_at, parse_vitals
+
+# Tiered vitals storage. Raw readings (vitals rows) stay in the hot table for
+# HOT_DAYS; `compact()` moves older ones out:
+#   - into per-minute, hourly and daily rollups (vital_rollups), kept for
+#     ROLLUP_DAYS per resolution (daily forever)
+#   - into gzip NDJSON archive files (archive_segments), re-readable with
+#     read_archive()
+# A patient's newest KEEP_LATEST readings always stay hot, so dashboards and
+# trend windows never reach into the cold tiers. series() picks the tier and
+# resolution for a time range and merges hot readings into the rollups.
+#
+# Only the vitals rows move; the logs they were parsed from stay where they
+# are and remain the source of truth. A log with readings in its text but no
+# vitals row is an archived reading: editing or deleting it rebuilds the
+# rollups of the days it touches from the archive (records.py), and
+# read_archive() drops or re-parses archived rows whose log was deleted or
+# edited since, so the segments themselves are never rewritten.
+#
+#   python tiers.py compact            run from cron, e.g. nightly
+#   python tiers.py series Liao --days 90
+HOT_DAYS = int(os.environ.get("MEDICALWEB_HOT_DAYS", "30"))
+KEEP_LATEST = int(os.environ.get("MEDICALWEB_HOT_KEEP_LATEST", "50"))
+ARCHIVE_DIR = os.environ.get("MEDICALWEB_ARCHIVE_DIR", "archive")
+SEGMENT_ROWS = int(os.environ.get("MEDICALWEB_ARCHIVE_SEGMENT_ROWS", "100000"))
+
+MINUTE, HOUR, DAY = 60, 3600, 86400
+RESOLUTIONS = {"minute": MINUTE, "hour": HOUR, "day": DAY}
+_NAMES = {v: k for k, v in RESOLUTIONS.items()}
+# resolution -> days kept (None = forever)
+ROLLUP_DAYS = {
+    MINUTE: int(os.environ.get("MEDICALWEB_MINUTE_ROLLUP_DAYS", "90")),
+    HOUR: int(os.environ.get("MEDICALWEB_HOUR_ROLLUP_DAYS", "730")),
+    DAY: None,
+}
+MAX_POINTS = 500
+METRICS = ("heart_rate", "bp_systolic", "bp_diastolic", "temperature")
+# SQLite text of a bucket's start, for aggregating hot rows in SQL
+_BUCKET_FORMAT = {MINUTE: "%Y-%m-%d %H:%M:00", HOUR: "%Y-%m-%d %H:00:00", DAY: "%Y-%m-%d 00:00:00"}
+
+
+def bucket_start(t: datetime.datetime, resolution: int) -> datetime.datetime:
+    if resolution == MINUTE:
+        return t.replace(second=0, microsecond=0)
+    if resolution == HOUR:
+        return t.replace(minute=0, second=0, microsecond=0)
+    return t.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _empty(patient_id: int, resolution: int, bucket: datetime.datetime) -> Dict[str, Any]:
+    row = {"resolution": resolution, "patient_id": patient_id, "bucket": bucket, "readings": 0}
+    for m in METRICS:
+        row.update({f"{m}_n": 0, f"{m}_sum": 0.0, f"{m}_min": None, f"{m}_max": None})
+    return row
+
+
+def _merge(into: Dict[str, Any], other: Dict[str, Any]):
+    into["readings"] += other["readings"]
+    for m in METRICS:
+        if not other[f"{m}_n"]:
+            continue
+        into[f"{m}_n"] += other[f"{m}_n"]
+        into[f"{m}_sum"] += other[f"{m}_sum"]
+        lo, hi = into[f"{m}_min"], into[f"{m}_max"]
+        into[f"{m}_min"] = other[f"{m}_min"] if lo is None else min(lo, other[f"{m}_min"])
+        into[f"{m}_max"] = other[f"{m}_max"] if hi is None else max(hi, other[f"{m}_max"])
+
+
+# Rollup rows for raw readings, at every resolution still retained for them
+def rollup(readings: List[Dict[str, Any]], now: datetime.datetime) -> List[Dict[str, Any]]:
+    buckets: Dict[Tuple[int, int, datetime.datetime], Dict[str, Any]] = {}
+    for res, days in ROLLUP_DAYS.items():
+        oldest = now - datetime.timedelta(days=days) if days is not None else None
+        for r in readings:
+            t = r["measured_at"]
+            if oldest is not None and t < oldest:
+                continue
+            key = (res, r["patient_id"], bucket_start(t, res))
+            b = buckets.get(key)
+            if b is None:
+                b = buckets[key] = _empty(r["patient_id"], res, key[2])
+            b["readings"] += 1
+            for m in METRICS:
+                v = r.get(m)
+                if v is None:
+                    continue
+                b[f"{m}_n"] += 1
+                b[f"{m}_sum"] += v
+                b[f"{m}_min"] = v if b[f"{m}_min"] is None else min(b[f"{m}_min"], v)
+                b[f"{m}_max"] = v if b[f"{m}_max"] is None else max(b[f"{m}_max"], v)
+    return list(buckets.values())
+
+
+# Add rollup rows to the stored ones (same bucket: counts and sums add up)
+def store_rollups(db, rows: List[Dict[str, Any]]):
+    if not rows:
+        return
+    conn = db.connection()
+    if not upsert_supported(conn):
+        raise NotImplementedError(f"vitals rollups need SQLite or PostgreSQL, not {conn.dialect.name}")
+    stmt = upsert(conn, VitalRollup)
+    ex = stmt.excluded
+    t = VitalRollup.__table__.c
+    # two-argument min()/max() are least()/greatest() on PostgreSQL
+    least, greatest = (func.least, func.greatest) if conn.dialect.name == "postgresql" else (func.min, func.max)
+    merged = {"readings": t.readings + ex.readings}
+    for m in METRICS:
+        lo, hi, elo, ehi = t[f"{m}_min"], t[f"{m}_max"], ex[f"{m}_min"], ex[f"{m}_max"]
+        merged.update({
+            f"{m}_n": t[f"{m}_n"] + ex[f"{m}_n"],
+            f"{m}_sum": t[f"{m}_sum"] + ex[f"{m}_sum"],
+            # SQLite's min()/max() return NULL if either side is NULL
+            f"{m}_min": least(func.coalesce(lo, elo), func.coalesce(elo, lo)),
+            f"{m}_max": greatest(func.coalesce(hi, ehi), func.coalesce(ehi, hi)),
+        })
+    stmt = stmt.on_conflict_do_update(index_elements=["resolution", "patient_id", "bucket"], set_=merged)
+    db.execute(stmt, rows)
+
+
+# ---------- compaction ----------
+
+def _write_segment(readings: List[Dict[str, Any]]) -> str:
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    first = min(r["measured_at"] for r in readings)
+    last = max(r["measured_at"] for r in readings)
+    path = os.path.join(ARCHIVE_DIR, f"vitals-{first:%Y%m%d}-{last:%Y%m%d}-{uuid.uuid4().hex[:8]}.ndjson.gz")
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb") as gz:
+            for r in readings:
+                gz.write(orjson.dumps(r) + b"\n")
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp, path)
+    return path
+
+
+def _flush(session_factory, readings: List[Dict[str, Any]], now: datetime.datetime) -> int:
+    path = _write_segment(readings)
+    db: Session = session_factory()
+    try:
+        store_rollups(db, rollup(readings, now))
+        db.add(ArchiveSegment(
+            path=path, rows=len(readings),
+            first_at=min(r["measured_at"] for r in readings), last_at=max(r["measured_at"] for r in readings),
+            min_patient_id=min(r["patient_id"] for r in readings), max_patient_id=max(r["patient_id"] for r in readings),
+        ))
+        ids = [r["log_id"] for r in readings]
+        for i in range(0, len(ids), 500):
+            db.execute(delete(Vital).where(Vital.log_id.in_(ids[i:i + 500])))
+        # one change per patient: caches and page versions move on, SSE
+        # clients can ignore the kind
+        for pid in sorted({r["patient_id"] for r in readings}):
+            changes.record(db, "archive", "delete", pid)
+        db.commit()
+    except Exception:
+        db.rollback()
+        os.remove(path)  # the segment row never committed, so nothing points at it
+        raise
+    finally:
+        db.close()
+    return len(readings)
+
+
+# Readings of a patient due to leave the hot table: older than cutoff and
+# not among the patient's newest KEEP_LATEST
+def _cold_readings(db: Session, patient_id: int, cutoff: datetime.datetime) -> List[Dict[str, Any]]:
+    newest_kept = db.scalar(
+        select(Vital.measured_at).where(Vital.patient_id == patient_id)
+        .order_by(Vital.measured_at.desc()).offset(KEEP_LATEST - 1).limit(1)
+    ) if KEEP_LATEST else None
+    if newest_kept is None and KEEP_LATEST:
+        return []  # fewer readings than KEEP_LATEST
+    until = min(cutoff, newest_kept) if newest_kept is not None else cutoff
+    rows = db.execute(
+        select(Vital.log_id, Vital.patient_id, Vital.measured_at, *[getattr(Vital, m) for m in METRICS],
+               Log.timestamp, Log.content)
+        .join(Log, Log.id == Vital.log_id)
+        .where(Vital.patient_id == patient_id, Vital.measured_at < until)
+        .order_by(Vital.measured_at)
+    ).all()
+    return [dict(r._mapping) for r in rows]
+
+
+# Move readings older than HOT_DAYS out of the hot table and prune expired
+# rollups. Commits once per archive segment, so it can be stopped and re-run.
+# A reading edited while its segment is being written keeps its old values in
+# the rollups until its log is edited again.
+def compact(session_factory, now: Optional[datetime.datetime] = None) -> Dict[str, int]:
+    now = now or datetime.datetime.now()
+    cutoff = now - datetime.timedelta(days=HOT_DAYS)
+    stats = {"patients": 0, "archived": 0, "segments": 0, "rollups_pruned": 0}
+    db: Session = session_factory()
+    try:
+        # only patients with a reading old enough to move
+        patient_ids = db.scalars(
+            select(Patient.id).where(select(Vital.log_id).where(Vital.patient_id == Patient.id,
+                                                                 Vital.measured_at < cutoff).exists())
+            .order_by(Patient.id)
+        ).all()
+        pending: List[Dict[str, Any]] = []
+        for pid in patient_ids:
+            readings = _cold_readings(db, pid, cutoff)
+            db.rollback()  # don't hold a read transaction across segments
+            if not readings:
+                continue
+            stats["patients"] += 1
+            pending.extend(readings)
+            if len(pending) >= SEGMENT_ROWS:
+                stats["archived"] += _flush(session_factory, pending, now)
+                stats["segments"] += 1
+                pending = []
+        if pending:
+            stats["archived"] += _flush(session_factory, pending, now)
+            stats["segments"] += 1
+        stats["rollups_pruned"] = prune_rollups(db, now)
+        db.commit()
+    finally:
+        db.close()
+    return stats
+
+
+def prune_rollups(db: Session, now: datetime.datetime) -> int:
+    pruned = 0
+    for res, days in ROLLUP_DAYS.items():
+        if days is not None:
+            oldest = now - datetime.timedelta(days=days)
+            pruned += db.execute(delete(VitalRollup).where(VitalRollup.resolution == res,
+                                                           VitalRollup.bucket < oldest)).rowcount
+    return pruned
+
+
+# Archived rows checked against their logs as they are now: deleted logs
+# drop out, edited ones are re-parsed
+def _current(db: Session, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    ids = [r["log_id"] for r in rows]
+    contents: Dict[int, str] = {}
+    for i in range(0, len(ids), 500):
+        contents.update(db.execute(select(Log.id, Log.content).where(Log.id.in_(ids[i:i + 500]))).all())
+    out = []
+    for r in rows:
+        content = contents.get(r["log_id"])
+        if content is None:
+            continue
+        if content != r["content"]:
+            values = parse_vitals(content)
+            if not values:
+                continue
+            r.update({m: values.get(m) for m in METRICS}, content=content,
+                     measured_at=parse_measured_at(content) or r["timestamp"])
+        out.append(r)
+    return out
+
+
+# Archived raw readings of a patient, oldest segment first
+def read_archive(db: Session, patient_id: int, since: Optional[datetime.datetime] = None,
+                 until: Optional[datetime.datetime] = None) -> Iterator[Dict[str, Any]]:
+    stmt = select(ArchiveSegment.path).where(ArchiveSegment.min_patient_id <= patient_id,
+                                             ArchiveSegment.max_patient_id >= patient_id)
+    if since:
+        stmt = stmt.where(ArchiveSegment.last_at >= since)
+    if until:
+        stmt = stmt.where(ArchiveSegment.first_at < until)
+    for path in db.scalars(stmt.order_by(ArchiveSegment.first_at)).all():
+        rows = []
+        with gzip.open(path, "rb") as f:
+            for line in f:
+                r = orjson.loads(line)
+                if r["patient_id"] != patient_id:
+                    continue
+                r["measured_at"] = datetime.datetime.fromisoformat(r["measured_at"])
+                r["timestamp"] = datetime.datetime.fromisoformat(r["timestamp"])
+                rows.append(r)
+        for r in _current(db, rows):
+            if (since and r["measured_at"] < since) or (until and r["measured_at"] >= until):
+                continue
+            yield r
+
+
+# Logs among ids whose readings are in the archive -> (patient_id, measured_at)
+def archived_readings(db: Session, ids: List[int]) -> Dict[int, Tuple[int, datetime.datetime]]:
+    rows = db.execute(
+        select(Log.id, Log.patient_id, Log.content, Log.timestamp)
+        .where(Log.id.in_(ids), ~select(Vital.log_id).where(Vital.log_id == Log.id).exists())
+    ).all()
+    return {r.id: (r.patient_id, parse_measured_at(r.content) or r.timestamp)
+            for r in rows if parse_vitals(r.content)}
+
+
+# Recompute the stored rollups of whole days from the archive, after archived
+# readings were edited or deleted. days: {(patient_id, date)}. Reads the
+# segments of each day, so it is meant for the occasional correction.
+def rebuild_rollups(db: Session, days, now: Optional[datetime.datetime] = None) -> int:
+    now = now or datetime.datetime.now()
+    rows = 0
+    for pid, day in sorted(days):
+        start = datetime.datetime.combine(day, datetime.time())
+        end = start + datetime.timedelta(days=1)
+        db.execute(delete(VitalRollup).where(VitalRollup.patient_id == pid, VitalRollup.bucket >= start,
+                                             VitalRollup.bucket < end))
+        buckets = rollup(list(read_archive(db, pid, start, end)), now)
+        store_rollups(db, buckets)
+        rows += len(buckets)
+    return rows
+
+
+# ---------- reading the tiers ----------
+
+# None = raw readings; otherwise the finest rollup that keeps the range under
+# max_points buckets and is still retained at `since`
+def pick_resolution(since: Optional[datetime.datetime], until: datetime.datetime, now: datetime.datetime,
+                    max_points: int = MAX_POINTS) -> Optional[int]:
+    if since is None:
+        return DAY
+    span = (until - since).total_seconds()
+    if since >= now - datetime.timedelta(days=HOT_DAYS) and span / MINUTE <= max_points:
+        return None
+    for res, days in ROLLUP_DAYS.items():
+        if span / res <= max_points and (days is None or since >= now - datetime.timedelta(days=days)):
+            return res
+    return DAY
+
+
+def _hot_buckets(db: Session, patient_id: int, resolution: int, since, until) -> List[Dict[str, Any]]:
+    if db.get_bind().dialect.name == "postgresql":
+        bucket = func.date_trunc(_NAMES[resolution], Vital.measured_at).label("bucket")
+    else:
+        bucket = func.strftime(_BUCKET_FORMAT[resolution], Vital.measured_at).label("bucket")
+    cols = [bucket, func.count().label("readings")]
+    for m in METRICS:
+        c = getattr(Vital, m)
+        cols += [func.count(c).label(f"{m}_n"), func.coalesce(func.sum(c), 0).label(f"{m}_sum"),
+                 func.min(c).label(f"{m}_min"), func.max(c).label(f"{m}_max")]
+    stmt = select(*cols).where(Vital.patient_id == patient_id, Vital.measured_at < until)
+    if since:
+        stmt = stmt.where(Vital.measured_at >= since)
+    rows = []
+    for r in db.execute(stmt.group_by(bucket)).all():
+        row = dict(r._mapping)
+        if isinstance(row["bucket"], str):
+            row["bucket"] = datetime.datetime.fromisoformat(row["bucket"])
+        rows.append(row)
+    return rows
+
+
+def _point(b: Dict[str, Any]) -> Dict[str, Any]:
+    p = {"t": b["bucket"].isoformat(), "readings": b["readings"]}
+    for m in METRICS:
+        n = b[f"{m}_n"]
+        if n:
+            p[m] = {"min": b[f"{m}_min"], "avg": round(b[f"{m}_sum"] / n, 2), "max": b[f"{m}_max"], "n": n}
+    return p
+
+
+# A patient's vitals over [since, until): raw readings for short recent
+# ranges, else buckets from the rollups merged with hot readings
+#   {"resolution": "raw" | "minute" | "hour" | "day", "points": [...]}
+def series(db: Session, patient_id: int, since: Optional[datetime.datetime] = None,
+           until: Optional[datetime.datetime] = None, max_points: int = MAX_POINTS) -> Dict[str, Any]:
+    now = datetime.datetime.now()
+    until = until or now
+    res = pick_resolution(since, until, now, max_points)
+    if res is None:
+        stmt = (select(Vital.measured_at, *[getattr(Vital, m) for m in METRICS])
+                .where(Vital.patient_id == patient_id, Vital.measured_at >= since, Vital.measured_at < until)
+                .order_by(Vital.measured_at))
+        points = []
+        for r in db.execute(stmt).all():
+            p = {"t": r.measured_at.isoformat()}
+            p.update({m: getattr(r, m) for m in METRICS if getattr(r, m) is not None})
+            points.append(p)
+        return {"resolution": "raw", "points": points}
+    stmt = select(VitalRollup).where(VitalRollup.resolution == res, VitalRollup.patient_id == patient_id,
+                                     VitalRollup.bucket < until)
+    if since:
+        stmt = stmt.where(VitalRollup.bucket >= bucket_start(since, res))
+    buckets: Dict[datetime.datetime, Dict[str, Any]] = {}
+    for r in db.scalars(stmt).all():
+        buckets[r.bucket] = {c.key: getattr(r, c.key) for c in VitalRollup.__table__.columns}
+    for b in _hot_buckets(db, patient_id, res, since, until):
+        if b["bucket"] in buckets:
+            _merge(buckets[b["bucket"]], b)
+        else:
+            buckets[b["bucket"]] = b
+    return {"resolution": _NAMES[res], "points": [_point(buckets[k]) for k in sorted(buckets)]}
+
+
+# min/avg/max per metric over a whole series
+def summarize(s: Dict[str, Any]) -> Dict[str, Any]:
+    out: Dict[str, Any] = {}
+    for m in METRICS:
+        lo = hi = None
+        total = n = 0.0
+        for p in s["points"]:
+            v = p.get(m)
+            if v is None:
+                continue
+            if isinstance(v, dict):
+                # bucket: weight the average by how many readings it holds
+                w = v["n"]
+                lo = v["min"] if lo is None else min(lo, v["min"])
+                hi = v["max"] if hi is None else max(hi, v["max"])
+                total += v["avg"] * w
+                n += w
+            else:
+                lo = v if lo is None else min(lo, v)
+                hi = v if hi is None else max(hi, v)
+                total += v
+                n += 1
+        if n:
+            out[m] = {"min": lo, "avg": round(total / n, 2), "max": hi}
+    return {"resolution": s["resolution"], "metrics": out}
+
+
+if __name__ == "__main__":
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Tiered vitals storage")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("compact", help="archive and roll up readings older than MEDICALWEB_HOT_DAYS")
+    sr = sub.add_parser("series", help="print a patient's vitals from the right tier")
+    sr.add_argument("patient")
+    sr.add_argument("--days", type=int, default=7)
+    sr.add_argument("--points", type=int, default=MAX_POINTS)
+    ar = sub.add_parser("archived", help="print a patient's archived readings as NDJSON")
+    ar.add_argument("patient")
+    ar.add_argument("--since", type=datetime.date.fromisoformat)
+    ar.add_argument("--until", type=datetime.date.fromisoformat)
+    args = parser.parse_args()
+
+    if args.command == "compact":
+        print(compact(SessionLocal))
+    else:
+        db = SessionLocal()
+        try:
+            pid = db.scalar(select(Patient.id).where(Patient.name == args.patient))
+            if pid is None:
+                parser.error(f"unknown patient {args.patient!r}")
+            if args.command == "series":
+                since = datetime.datetime.now() - datetime.timedelta(days=args.days)
+                print(orjson.dumps(series(db, pid, since, max_points=args.points), option=orjson.OPT_INDENT_2).decode())
+            else:
+                since = datetime.datetime.combine(args.since, datetime.time()) if args.since else None
+                until = datetime.datetime.combine(args.until, datetime.time()) if args.until else None
+                for r in read_archive(db, pid, since, until):
+                    print(orjson.dumps(r).decode())
+        finally:
+            db.close()
@@ -0,0 +1,158 @@
+# vitals.py
+import argparse
+import datetime
+import re
+from typing import Any, Dict, Optional
+
+from sqlalchemy import insert, select
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+from models import ArchiveSegment, Log, Vital
+
+# Log lines look like "2025-09-01: Heart rate 72" / "2025-09-01 08:00: BP 120/80, Temp 36.6"
+_DATE_PREFIX = re.compile(r"^\s*(\d{4}-\d{2}-\d{2}(?:[ T]\d{2}:\d{2}(?::\d{2})?)?)\s*:")
+_HEART_RATE = re.compile(r"Heart rate\s*[:=]?\s*(\d+)", re.IGNORECASE)
+_BP = re.compile(r"\bBP\s*[:=]?\s*(\d+)\s*/\s*(\d+)", re.IGNORECASE)
+_TEMP = re.compile(r"Temp(?:erature)?\s*[:=]?\s*(\d+(?:\.\d+)?)", re.IGNORECASE)
+
+
+def parse_measured_at(content: str) -> Optional[datetime.datetime]:
+    m = _DATE_PREFIX.match(content or "")
+    if not m:
+        return None
+    text = m.group(1).replace("T", " ")
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return datetime.datetime.strptime(text, fmt)
+        except ValueError:
+            pass
+    return None
+
+
+# "2025-09-01 08:00: ..." -> True, "2025-09-01: ..." (stored at midnight) -> False
+def has_time_of_day(content: str) -> bool:
+    m = _DATE_PREFIX.match(content or "")
+    return bool(m) and len(m.group(1)) > 10
+
+
+# Typed vitals found in one log line; empty dict when the line has no readings
+def parse_vitals(content: str) -> Dict[str, Any]:
+    content = content or ""
+    values: Dict[str, Any] = {}
+    m = _HEART_RATE.search(content)
+    if m:
+        values["heart_rate"] = int(m.group(1))
+    m = _BP.search(content)
+    if m:
+        values["bp_systolic"] = int(m.group(1))
+        values["bp_diastolic"] = int(m.group(2))
+    m = _TEMP.search(content)
+    if m:
+        values["temperature"] = float(m.group(1))
+    return values
+
+
+# Column values for a vitals row, or None when the log carries no readings
+def vital_row(log_id, patient_id, content, timestamp) -> Optional[Dict[str, Any]]:
+    values = parse_vitals(content)
+    if not values:
+        return None
+    # every row carries the same keys so batches go through one executemany
+    values = {k: values.get(k) for k in ("heart_rate", "bp_systolic", "bp_diastolic", "temperature")}
+    values.update(
+        log_id=log_id,
+        patient_id=patient_id,
+        measured_at=parse_measured_at(content) or timestamp or datetime.datetime.now(),
+    )
+    return values
+
+
+# Parse-on-write: call after creating or editing a Log, before commit
+def record_vitals(log: Log):
+    values = parse_vitals(log.content)
+    if not values:
+        log.vitals = None
+        return
+    if log.vitals is None:
+        log.vitals = Vital()
+    v = log.vitals
+    v.patient_id = log.patient_id
+    v.heart_rate = values.get("heart_rate")
+    v.bp_systolic = values.get("bp_systolic")
+    v.bp_diastolic = values.get("bp_diastolic")
+    v.temperature = values.get("temperature")
+    v.measured_at = parse_measured_at(log.content) or log.timestamp or datetime.datetime.now()
+
+
+# Non-empty typed readings of a vital row / Vital, for change events
+def vitals_of(v) -> Dict[str, Any]:
+    if v is None:
+        return {}
+    get = v.get if isinstance(v, dict) else (lambda k: getattr(v, k))
+    values = {k: get(k) for k in ("heart_rate", "bp_systolic", "bp_diastolic", "temperature", "measured_at")}
+    return {k: val for k, val in values.items() if val is not None}
+
+
+# Same shape the templates always received from the old string parser
+# (v is a Vital, a vital row dict or a vitals_of() dict)
+def metrics_from_vital(v) -> Dict[str, Any]:
+    values = vitals_of(v)
+    metrics = {}
+    if "heart_rate" in values:
+        metrics["heart_rate"] = values["heart_rate"]
+    if "bp_systolic" in values and "bp_diastolic" in values:
+        metrics["bp"] = f"{values['bp_systolic']}/{values['bp_diastolic']}"
+    if "temperature" in values:
+        metrics["temp"] = values["temperature"]
+    return metrics
+
+
+# One chunk of the backfill: parse logs after last_id that have no vitals row yet.
+# db is a Session or a Connection. Returns (new last_id or None when done, rows written).
+def backfill_chunk(db, last_id: int, chunk_size: int):
+    rows = db.execute(
+        select(Log.id, Log.patient_id, Log.content, Log.timestamp)
+        .where(Log.id > last_id)
+        .order_by(Log.id)
+        .limit(chunk_size)
+    ).all()
+    if not rows:
+        return None, 0
+    done = set(db.execute(select(Vital.log_id).where(Vital.log_id.in_([r.id for r in rows]))).scalars())
+    batch = [vital_row(r.id, r.patient_id, r.content, r.timestamp) for r in rows if r.id not in done]
+    batch = [b for b in batch if b]
+    if batch:
+        db.execute(insert(Vital), batch)
+    return rows[-1].id, len(batch)
+
+
+# One-off backfill: walk logs by id in chunks so memory stays bounded
+def backfill_vitals(chunk_size: int = 1000) -> int:
+    written = 0
+    last_id = 0
+    while last_id is not None:
+        db: Session = SessionLocal()
+        try:
+            last_id, n = backfill_chunk(db, last_id, chunk_size)
+            db.commit()
+            written += n
+        finally:
+            db.close()
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Vitals maintenance")
+    sub = parser.add_subparsers(dest="command", required=True)
+    bf = sub.add_parser("backfill", help="parse existing logs into the vitals table")
+    bf.add_argument("--chunk-size", type=int, default=1000)
+    args = parser.parse_args()
+    if args.command == "backfill":
+        db = SessionLocal()
+        archived = db.scalar(select(ArchiveSegment.id).limit(1))
+        db.close()
+        if archived is not None:
+            # archived readings have no vitals row but their logs are still here
+            parser.error("readings were already archived by tiers.py compact; backfilling would bring them back")
+        print(f"backfilled {backfill_vitals(args.chunk_size)} vitals rows")
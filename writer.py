@@ -0,0 +1,167 @@
+# writer.py
+import asyncio
+import concurrent.futures
+import threading
+import time
+from collections import deque
+from typing import Any, Callable
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+# An op is fn(db) -> result. It may run more than once (a failed group is replayed
+# op by op), so it must only touch the session it is given and never commit.
+WriteOp = Callable[[Session], Any]
+
+
+class QueueFull(Exception):
+    pass
+
+
+# Single background writer that drains an in-process queue and commits ops in
+# groups, so concurrent requests share one commit (and one fsync) and the event
+# loop never waits on SQLite. Urgent ops (emergencies) skip the line, are never
+# rejected for backpressure, and commit on their own with synchronous=FULL.
+class WriteBehindQueue:
+    def __init__(self, session_factory, max_pending: int = 10000, batch_size: int = 256,
+                 flush_interval: float = 0.005, put_timeout: float = 2.0):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._normal = deque()
+        self._urgent = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+        self.stats = {"ops": 0, "commits": 0, "urgent_commits": 0, "replays": 0, "failed": 0, "rejected": 0}
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+            self._thread.start()
+
+    # Stop accepting work and wait for everything already queued to commit
+    def stop(self, timeout: float = 10.0):
+        with self._cond:
+            if not self._running:
+                return
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+    def pending(self) -> int:
+        return len(self._normal) + len(self._urgent)
+
+    # Thread-safe submit for non-async callers; returns a concurrent Future
+    def submit_threadsafe(self, op: WriteOp, urgent: bool = False) -> concurrent.futures.Future:
+        if not urgent and not self._slots.acquire(timeout=self.put_timeout):
+            self.stats["rejected"] += 1
+            raise QueueFull("write queue is full")
+        return self._enqueue(op, urgent)
+
+    def _enqueue(self, op: WriteOp, urgent: bool) -> concurrent.futures.Future:
+        fut = concurrent.futures.Future()
+        self.start()
+        with self._cond:
+            (self._urgent if urgent else self._normal).append((op, fut, urgent))
+            self._cond.notify()
+        return fut
+
+    # Await the op's commit without blocking the event loop. A full queue makes
+    # the caller wait up to put_timeout for room, then raises QueueFull.
+    async def submit(self, op: WriteOp, urgent: bool = False) -> Any:
+        if urgent or self._slots.acquire(blocking=False):
+            fut = self._enqueue(op, urgent)
+        else:
+            loop = asyncio.get_running_loop()
+            fut = await loop.run_in_executor(None, self.submit_threadsafe, op)
+        return await asyncio.wrap_future(fut)
+
+    def _take(self):
+        with self._cond:
+            while self._running and not self._urgent and not self._normal:
+                self._cond.wait()
+            if self._urgent:
+                return [self._urgent.popleft()]
+            if not self._normal:
+                return None
+            # give concurrent writers a moment to join this group
+            deadline = time.monotonic() + self.flush_interval
+            while self._running and len(self._normal) < self.batch_size and not self._urgent:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self._cond.wait(left)
+            if self._urgent:
+                return [self._urgent.popleft()]
+            return [self._normal.popleft() for _ in range(min(self.batch_size, len(self._normal)))]
+
+    def _run(self):
+        while True:
+            batch = self._take()
+            if batch is None:
+                return
+            try:
+                self._commit_group(batch)
+            finally:
+                for _, _, urgent in batch:
+                    if not urgent:
+                        self._slots.release()
+
+    def _commit_group(self, batch):
+        durable = batch[0][2]
+        db = self.session_factory()
+        try:
+            if durable:
+                _force_full_sync(db)
+            results = [op(db) for op, _, _ in batch]
+            db.commit()
+        except Exception as exc:
+            db.rollback()
+            if len(batch) == 1:
+                self.stats["failed"] += 1
+                _resolve(batch[0][1], exc=exc)
+                return
+            # one bad op must not sink the others: replay them one at a time
+            self.stats["replays"] += 1
+            for item in batch:
+                self._commit_group([item])
+            return
+        finally:
+            db.close()
+        self.stats["ops"] += len(batch)
+        self.stats["urgent_commits" if durable else "commits"] += 1
+        for (_, fut, _), res in zip(batch, results):
+            _resolve(fut, res)
+
+
+def _resolve(fut: concurrent.futures.Future, result=None, exc=None):
+    if fut.done():
+        return
+    if exc is not None:
+        fut.set_exception(exc)
+    else:
+        fut.set_result(result)
+
+
+# Durable lane: run this transaction with synchronous=FULL on SQLite. The
+# connection's previous level is put back when it returns to the pool.
+def _force_full_sync(db: Session):
+    conn = db.connection()
+    if conn.dialect.name != "sqlite":
+        return
+    if not event.contains(conn.engine, "checkin", _restore_sync):
+        event.listen(conn.engine, "checkin", _restore_sync)
+    conn.info["restore_synchronous"] = conn.exec_driver_sql("PRAGMA synchronous").scalar()
+    conn.exec_driver_sql("PRAGMA synchronous=FULL")
+
+
+def _restore_sync(dbapi_connection, connection_record):
+    level = connection_record.info.pop("restore_synchronous", None)
+    if level is not None:
+        dbapi_connection.execute(f"PRAGMA synchronous={int(level)}")